@@ -1,10 +1,21 @@
 from dataclasses import dataclass, field
-import os
-from queue import Queue
-from typing import Dict, List
+from queue import Empty, Full, Queue
+import threading
+from typing import Dict, Iterable, List
 
 from requests import Response
 
+from audio.audio_stream import AudioStream
+from common.metrics import METRICS
+from common.result_store import ResultStore
+
+# How long workers block waiting for a task before re-checking their stop event.
+TASK_WAIT_TIMEOUT = 0.5
+# Max tasks waiting for a worker. Producers block while a queue is full.
+MAX_PENDING_AUDIO_TO_TEXT_TASKS = 64
+MAX_PENDING_TEXT_TO_AUDIO_TASKS = 16
+# Synthesized results waiting to be played, used when audio is played as it is synthesized.
+MAX_UNPLAYED_TEXT_TO_AUDIO_RESULTS = 4
 
 @dataclass(frozen=True)
 class SpeechToTextTask:
@@ -27,7 +38,8 @@ class TextToSpeechTask:
 @dataclass
 class TextToSpeechResult:
     task: TextToSpeechTask
-    raw_response: Response
+    # None if the request failed or the result was served from cache.
+    raw_response: Response | None
 
 
 @dataclass
@@ -36,6 +48,8 @@ class TextToSpeechResultChatTTS(TextToSpeechResult):
     file_urls: List[str] = field(default_factory=list)
 
     def __post_init__(self):
+        if self.raw_response is None:
+            return
         response = self.raw_response.json()
         if response["msg"] == "ok":
             self.file_paths, self.file_urls = [
@@ -46,35 +60,66 @@ class TextToSpeechResultChatTTS(TextToSpeechResult):
 @dataclass
 class TextToSpeechResultMeloTTS(TextToSpeechResult):
     content: bytes | None = field(default=None)
+    # Set instead of content when the body is streamed, see TTSServiceMeloTTS.stream_audio.
+    audio_stream: AudioStream | None = field(default=None)
 
     def __post_init__(self):
-        if self.raw_response.status_code == 200:
+        if (
+            self.audio_stream is None
+            and self.raw_response is not None
+            and self.raw_response.status_code == 200
+        ):
             self.content = self.raw_response.content
 
 
 @dataclass
 class AudioManager:
     # Buffer for audio to be processed. We pop up the front element to process.
-    audio_to_text_tasks: Queue[SpeechToTextTask] = field(default_factory=Queue)
+    audio_to_text_tasks: Queue[SpeechToTextTask] = field(
+        default_factory=lambda: Queue(maxsize=MAX_PENDING_AUDIO_TO_TEXT_TASKS)
+    )
     # Buffer for audio processed. We use id to consume the text. Afterwards, we remove it.
-    #   {id: SpeechToTextTask, ...}
-    audio_to_text_results: Dict[str, SpeechToTextResult] = field(default_factory=dict)
+    #   {id: SpeechToTextResult, ...}
+    audio_to_text_results: ResultStore = field(
+        default_factory=lambda: ResultStore(ttl=600.0, max_entries=1024)
+    )
     # Buffer for text to be processed. We pop up the front element to process.
-    text_to_audio_tasks: Queue[TextToSpeechTask] = field(default_factory=Queue)
+    text_to_audio_tasks: Queue[TextToSpeechTask] = field(
+        default_factory=lambda: Queue(maxsize=MAX_PENDING_TEXT_TO_AUDIO_TASKS)
+    )
     # Buffer for text processed. We use id to consume the text. Afterwards, we remove it.
-    text_to_audio_results: Dict[str, TextToSpeechResult] = field(default_factory=dict)
+    #   {id: TextToSpeechResult, ...}
+    text_to_audio_results: ResultStore = field(
+        default_factory=lambda: ResultStore(
+            ttl=600.0, max_bytes=256 * 1024 * 1024, size_of=_text_to_audio_result_size
+        )
+    )
+    # Ids of cancelled text to audio tasks. Workers skip them and nobody waits for them.
+    cancelled_text_to_audio_tasks: ResultStore = field(
+        default_factory=lambda: ResultStore(ttl=600.0, max_entries=4096)
+    )
+    # Notified whenever a result is saved, so consumers can block instead of polling.
+    results_condition: threading.Condition = field(
+        default_factory=threading.Condition, repr=False
+    )
+    # Workers take no new text to audio task while this many results wait to be played,
+    # so synthesis keeps pace with playback. Only set it if results are cleaned up once
+    # played, workers would wait forever otherwise. None synthesizes as fast as possible.
+    max_unplayed_text_to_audio_results: int | None = None
 
     def add_audio_to_text_task(self, task: SpeechToTextTask) -> None:
         self.audio_to_text_tasks.put(task)
 
-    def get_audio_to_text_task(self) -> None | SpeechToTextResult:
-        if self.has_pending_audio_to_text_tasks():
-            return self.audio_to_text_tasks.get()
-        else:
-            return None
+    def get_audio_to_text_task(
+        self, timeout: float | None = None
+    ) -> None | SpeechToTextTask:
+        # Non-blocking when timeout is None, otherwise wait up to timeout seconds.
+        return _get_from_queue(self.audio_to_text_tasks, timeout=timeout)
 
     def save_audio_to_text_result(self, result: SpeechToTextResult) -> None:
-        self.audio_to_text_results[result.task.task_id] = result
+        with self.results_condition:
+            self.audio_to_text_results[result.task.task_id] = result
+            self.results_condition.notify_all()
         self.audio_to_text_tasks.task_done()
 
     def has_pending_audio_to_text_tasks(self) -> bool:
@@ -93,28 +138,70 @@ class AudioManager:
         if task_id in self.audio_to_text_results:
             return self.audio_to_text_results[task_id].text
 
-    def clean_up_audio_to_text_task(self, result: SpeechToTextResult) -> None:
-        # Delete audio file.
-        filepath = result.task.filepath
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        task_id = result.task.task_id
-        if task_id in self.audio_to_text_results:
-            del self.audio_to_text_results[task_id]
+    def wait_for_audio_to_text_result(
+        self, task_id: str, timeout: float | None = None
+    ) -> SpeechToTextResult | None:
+        # Block until the result is saved. Returns None on timeout.
+        with self.results_condition:
+            self.results_condition.wait_for(
+                lambda: task_id in self.audio_to_text_results, timeout=timeout
+            )
+            return self.audio_to_text_results.get(task_id)
 
-    def add_text_to_audio_task(self, task: TextToSpeechTask) -> None:
-        self.text_to_audio_tasks.put(task)
-
-    def get_text_to_audio_task(self) -> None | TextToSpeechTask:
-        if self.has_pending_text_to_audio_tasks():
-            return self.text_to_audio_tasks.get()
-        else:
-            return
+    def clean_up_audio_to_text_task(self, result: SpeechToTextResult) -> None:
+        # Release the result, and with it the recorded audio of its task.
+        with self.results_condition:
+            self.audio_to_text_results.pop(result.task.task_id)
+
+    def add_text_to_audio_task(
+        self, task: TextToSpeechTask, timeout: float | None = None
+    ) -> bool:
+        # Block while the queue is full, at most timeout seconds if given.
+        # Returns False if the task was not added.
+        if self.text_to_audio_tasks.full():
+            METRICS.increment("backpressure.tts_tasks")
+        try:
+            self.text_to_audio_tasks.put(task, timeout=timeout)
+            return True
+        except Full:
+            return False
+
+    def get_text_to_audio_task(
+        self, timeout: float | None = None
+    ) -> None | TextToSpeechTask:
+        # Non-blocking when timeout is None, otherwise wait up to timeout seconds.
+        # Cancelled tasks are dropped here, so they never reach the backend.
+        if not self._wait_for_unplayed_results(timeout):
+            return None
+        while (
+            task := _get_from_queue(self.text_to_audio_tasks, timeout=timeout)
+        ) is not None and self.is_text_to_audio_task_cancelled(task.task_id):
+            self.text_to_audio_tasks.task_done()
+            METRICS.increment("cancelled.tts")
+        return task
 
     def save_text_to_audio_result(self, result: TextToSpeechResult) -> None:
-        self.text_to_audio_results[result.task.task_id] = result
+        with self.results_condition:
+            if self.is_text_to_audio_task_cancelled(result.task.task_id):
+                # Synthesized while being cancelled, nobody will play it.
+                METRICS.increment("cancelled.tts_results")
+                _cancel_audio_stream(result)
+            else:
+                self.text_to_audio_results[result.task.task_id] = result
+                self.results_condition.notify_all()
         self.text_to_audio_tasks.task_done()
 
+    def cancel_text_to_audio_tasks(self, task_ids: Iterable[str]) -> None:
+        # Drop queued tasks and unplayed results, and wake up consumers waiting for them.
+        with self.results_condition:
+            for task_id in task_ids:
+                self.cancelled_text_to_audio_tasks[task_id] = True
+                _cancel_audio_stream(self.text_to_audio_results.pop(task_id))
+            self.results_condition.notify_all()
+
+    def is_text_to_audio_task_cancelled(self, task_id: str) -> bool:
+        return task_id in self.cancelled_text_to_audio_tasks
+
     def has_pending_text_to_audio_tasks(self) -> bool:
         return self.num_pending_text_to_audio_tasks() > 0
 
@@ -133,9 +220,64 @@ class AudioManager:
         else:
             return None
 
+    def wait_for_text_to_audio_result(
+        self, task_id: str, timeout: float | None = None
+    ) -> None | TextToSpeechResult:
+        # Block until the result is saved. Returns None on timeout or if the task is cancelled.
+        with self.results_condition:
+            self.results_condition.wait_for(
+                lambda: task_id in self.text_to_audio_results
+                or self.is_text_to_audio_task_cancelled(task_id),
+                timeout=timeout,
+            )
+            return self.text_to_audio_results.get(task_id)
+
     def clean_up_text_to_audio_task(self, result: TextToSpeechResult) -> None:
-        # Delete audio file.
+        # Release the result and its audio.
         # TODO: how to clean up generated audio file in another docker container?
-        task_id = result.task.task_id
-        if task_id in self.text_to_audio_results:
-            del self.text_to_audio_results[task_id]
+        with self.results_condition:
+            self.text_to_audio_results.pop(result.task.task_id)
+            # Wakes up workers waiting for results to be played.
+            self.results_condition.notify_all()
+
+    def _wait_for_unplayed_results(self, timeout: float | None) -> bool:
+        # Backpressure from playback. Returns False if too many results still wait to be played.
+        limit = self.max_unplayed_text_to_audio_results
+        if limit is None:
+            return True
+        with self.results_condition:
+            if len(self.text_to_audio_results) < limit:
+                return True
+            METRICS.increment("backpressure.tts_results")
+            return self.results_condition.wait_for(
+                lambda: len(self.text_to_audio_results) < limit,
+                timeout=0 if timeout is None else timeout,
+            )
+
+    def result_store_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            "audio_to_text_results": self.audio_to_text_results.stats(),
+            "text_to_audio_results": self.text_to_audio_results.stats(),
+        }
+
+
+def _text_to_audio_result_size(result: TextToSpeechResult) -> int:
+    # Melo results hold the audio, ChatTTS results only urls.
+    content = getattr(result, "content", None)
+    return len(content) if content is not None else 0
+
+
+def _cancel_audio_stream(result: TextToSpeechResult | None) -> None:
+    # Stops the worker still downloading a streamed result.
+    audio_stream = getattr(result, "audio_stream", None)
+    if audio_stream is not None:
+        audio_stream.cancel()
+
+
+def _get_from_queue(queue: Queue, timeout: float | None = None):
+    try:
+        if timeout is None:
+            return queue.get_nowait()
+        return queue.get(timeout=timeout)
+    except Empty:
+        return None
@@ -0,0 +1,297 @@
+from dataclasses import dataclass
+import io
+from queue import Queue
+import threading
+from typing import Callable, Dict, Iterable, Tuple
+
+import pyaudio
+from pydub import AudioSegment
+
+from audio.audio_stream import AudioStream
+from audio.wav import PcmFormat, WavStreamParser, parse_wav
+from common.metrics import METRICS
+
+# Marks the end of the decode and pcm queues.
+_STOP = None
+
+
+@dataclass
+class AudioPlayer:
+    """
+    Long lived playback engine with a single output stream.
+    Audio is decoded in the background and appended to a pcm queue, which an output
+    thread writes to the stream back to back, so consecutive chunks play without gaps.
+    The stream is only reopened when the pcm format changes.
+    Streamed chunks are split into pieces as they arrive, only the last piece of a
+    chunk completes it.
+    """
+
+    # Frames written per stream.write call. Bounds how long stop/clear take to apply.
+    frames_per_write: int = 1024
+    output_device_index: int | None = None
+
+    def __post_init__(self):
+        # Items carry an optional callback, called when the chunk starts playing, and
+        # the generation they were enqueued in. pcm items are pieces of a chunk, with
+        # a flag marking the last piece.
+        self._decode_queue: Queue[
+            Tuple[bytes | AudioStream, Callable | None, int] | None
+        ] = Queue()
+        self._pcm_queue: Queue[
+            Tuple[PcmFormat, memoryview, Callable | None, int, bool] | None
+        ] = Queue()
+        # Incremented by clear. Chunks of older generations are dropped.
+        self._generation = 0
+        # Number of chunks enqueued but not completely played yet.
+        self._pending = 0
+        self._pending_condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._pyaudio: pyaudio.PyAudio | None = None
+        self._stream: pyaudio.Stream | None = None
+        self._stream_format: PcmFormat | None = None
+        # Stream the decode thread is reading, cancelled by clear.
+        self._decoding_stream: AudioStream | None = None
+        # Times the output ran dry while chunks were still waiting to be decoded.
+        self.underruns = 0
+        self.chunks_played = 0
+        self.chunks_dropped = 0
+        self.bytes_played = 0
+        self._decode_thread = threading.Thread(target=self._decode_loop, daemon=True)
+        self._output_thread = threading.Thread(target=self._output_loop, daemon=True)
+        self._decode_thread.start()
+        self._output_thread.start()
+
+    def enqueue(
+        self, content: bytes, on_start: Callable[[], None] | None = None
+    ) -> None:
+        # Append audio to the playback queue. Wav content is used as is, other formats are decoded.
+        # on_start is called when the chunk starts playing.
+        with self._pending_condition:
+            self._pending += 1
+            generation = self._generation
+        self._decode_queue.put((content, on_start, generation))
+
+    def enqueue_stream(
+        self, audio_stream: AudioStream, on_start: Callable[[], None] | None = None
+    ) -> None:
+        # Like enqueue, for audio still downloading. Wav audio starts playing once its
+        # first frames arrive, other formats are decoded when the stream ends.
+        with self._pending_condition:
+            self._pending += 1
+            generation = self._generation
+        self._decode_queue.put((audio_stream, on_start, generation))
+
+    def queue_depth(self) -> int:
+        # Number of chunks waiting to be played, including the one playing.
+        with self._pending_condition:
+            return self._pending
+
+    def wait_until_done(self, timeout: float | None = None) -> bool:
+        # Block until everything enqueued has been played. Returns False on timeout.
+        with self._pending_condition:
+            return self._pending_condition.wait_for(
+                lambda: self._pending == 0, timeout=timeout
+            )
+
+    def wait_until_queue_below(
+        self, depth: int, timeout: float | None = None
+    ) -> bool:
+        # Block until fewer than depth chunks wait to be played, e.g. before
+        # enqueueing more. Returns False on timeout.
+        with self._pending_condition:
+            return self._pending_condition.wait_for(
+                lambda: self._pending < depth, timeout=timeout
+            )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_depth": self.queue_depth(),
+            "underruns": self.underruns,
+            "chunks_played": self.chunks_played,
+            "chunks_dropped": self.chunks_dropped,
+            "bytes_played": self.bytes_played,
+        }
+
+    def clear(self) -> None:
+        # Stop the chunk playing now and drop everything enqueued, e.g. when the user
+        # interrupts the answer. Chunks enqueued afterwards play as usual.
+        with self._pending_condition:
+            self._generation += 1
+            audio_stream, self._decoding_stream = self._decoding_stream, None
+        if audio_stream is not None:
+            # Unblocks the decode thread and stops the download.
+            audio_stream.cancel()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.clear()
+        self._decode_queue.put(_STOP)
+        self._pcm_queue.put(_STOP)
+        self._decode_thread.join()
+        self._output_thread.join()
+        self._close_stream()
+        if self._pyaudio is not None:
+            self._pyaudio.terminate()
+            self._pyaudio = None
+
+    def _decode_loop(self) -> None:
+        while (item := self._decode_queue.get()) is not _STOP:
+            content, on_start, generation = item
+            if generation != self._generation:
+                self._drop_chunk()
+                continue
+            if isinstance(content, AudioStream):
+                self._decode_stream(content, on_start, generation)
+                continue
+            try:
+                self._pcm_queue.put((*self._decode(content), on_start, generation, True))
+            except Exception as e:
+                print(f"Error decoding audio: {e}")
+                self._done_chunk()
+
+    def _decode_stream(
+        self, audio_stream: AudioStream, on_start: Callable | None, generation: int
+    ) -> None:
+        # Parses the wav header once, then queues pcm frames as they arrive.
+        with self._pending_condition:
+            if generation != self._generation:
+                audio_stream.cancel()
+            self._decoding_stream = audio_stream
+        parser = WavStreamParser()
+        pieces = iter(audio_stream)
+        # Kept until the header is parsed, for the fallback to a complete decode.
+        header_pieces = []
+        try:
+            for data in pieces:
+                if parser.pcm_format is None:
+                    header_pieces.append(data)
+                pcm = parser.feed(data)
+                if pcm:
+                    self._pcm_queue.put(
+                        (parser.pcm_format, memoryview(pcm), on_start, generation, False)
+                    )
+                    on_start = None
+            if audio_stream.cancelled:
+                self._drop_chunk()
+            elif parser.pcm_format is not None:
+                self._pcm_queue.put(
+                    (parser.pcm_format, memoryview(b""), on_start, generation, True)
+                )
+            else:
+                # Empty or too short for a wav header.
+                self._done_chunk()
+        except ValueError:
+            # Not wav, decode the whole body once it has arrived.
+            self._decode_complete_stream(
+                [*header_pieces, *pieces], audio_stream, on_start, generation
+            )
+        except Exception as e:
+            print(f"Error decoding audio: {e}")
+            audio_stream.cancel()
+            self._done_chunk()
+        finally:
+            with self._pending_condition:
+                if self._decoding_stream is audio_stream:
+                    self._decoding_stream = None
+
+    def _decode_complete_stream(
+        self,
+        pieces: Iterable[bytes],
+        audio_stream: AudioStream,
+        on_start: Callable | None,
+        generation: int,
+    ) -> None:
+        try:
+            content = b"".join(pieces)
+            if audio_stream.cancelled:
+                self._drop_chunk()
+                return
+            self._pcm_queue.put((*self._decode(content), on_start, generation, True))
+        except Exception as e:
+            print(f"Error decoding audio: {e}")
+            self._done_chunk()
+
+    def _decode(self, content: bytes) -> Tuple[PcmFormat, memoryview]:
+        parsed = parse_wav(content)
+        if parsed is not None:
+            return parsed
+        audio = AudioSegment.from_file(io.BytesIO(content))
+        pcm_format = PcmFormat(
+            sample_rate=audio.frame_rate,
+            channels=audio.channels,
+            sample_width=audio.sample_width,
+        )
+        return pcm_format, memoryview(audio.raw_data)
+
+    def _output_loop(self) -> None:
+        while True:
+            if self._pcm_queue.empty() and self.queue_depth() > 0:
+                self.underruns += 1
+            item = self._pcm_queue.get()
+            if item is _STOP:
+                return
+            pcm_format, pcm, on_start, generation, last = item
+            if generation != self._generation:
+                if last:
+                    self._drop_chunk()
+                continue
+            try:
+                if on_start is not None:
+                    on_start()
+                if not self._write(pcm_format, pcm, generation):
+                    if last:
+                        self.chunks_dropped += 1
+                        METRICS.increment("cancelled.playback_chunks")
+                elif last:
+                    self.chunks_played += 1
+            except Exception as e:
+                print(f"Error playing audio: {e}")
+            finally:
+                if last:
+                    self._done_chunk()
+
+    def _write(self, pcm_format: PcmFormat, pcm: memoryview, generation: int) -> bool:
+        # Returns False if interrupted by stop or clear.
+        stream = self._open_stream(pcm_format)
+        step = self.frames_per_write * pcm_format.frame_size
+        for start in range(0, len(pcm), step):
+            if self._stop_event.is_set() or generation != self._generation:
+                return False
+            frames = pcm[start : start + step]
+            stream.write(frames)
+            self.bytes_played += len(frames)
+        return True
+
+    def _open_stream(self, pcm_format: PcmFormat) -> pyaudio.Stream:
+        if self._stream is not None and self._stream_format == pcm_format:
+            return self._stream
+        self._close_stream()
+        if self._pyaudio is None:
+            self._pyaudio = pyaudio.PyAudio()
+        self._stream = self._pyaudio.open(
+            format=self._pyaudio.get_format_from_width(pcm_format.sample_width),
+            channels=pcm_format.channels,
+            rate=pcm_format.sample_rate,
+            output=True,
+            output_device_index=self.output_device_index,
+            frames_per_buffer=self.frames_per_write,
+        )
+        self._stream_format = pcm_format
+        return self._stream
+
+    def _close_stream(self) -> None:
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+            self._stream_format = None
+
+    def _drop_chunk(self) -> None:
+        self.chunks_dropped += 1
+        METRICS.increment("cancelled.playback_chunks")
+        self._done_chunk()
+
+    def _done_chunk(self) -> None:
+        with self._pending_condition:
+            self._pending -= 1
+            self._pending_condition.notify_all()
@@ -0,0 +1,48 @@
+from dataclasses import dataclass
+from queue import Queue
+import threading
+from typing import Iterator
+
+# Marks the end of the stream.
+_END = None
+
+
+@dataclass
+class AudioStream:
+    """
+    Audio arriving in pieces, e.g. a streamed http response body. A producer thread
+    writes pieces and closes the stream, a single consumer iterates them as they
+    arrive. Either side can cancel, which ends the iteration and tells the producer
+    to stop reading.
+    """
+
+    def __post_init__(self):
+        self._queue: Queue[bytes | None] = Queue()
+        self._cancelled = threading.Event()
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> None:
+        if data and not self._cancelled.is_set():
+            self.bytes_written += len(data)
+            self._queue.put(data)
+
+    def close(self) -> None:
+        self._queue.put(_END)
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        self._queue.put(_END)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def __iter__(self) -> Iterator[bytes]:
+        while (data := self._queue.get()) is not _END:
+            if self._cancelled.is_set():
+                return
+            yield data
+
+    def read(self) -> bytes:
+        # The whole body, for consumers that cannot use it incrementally.
+        return b"".join(self)
@@ -0,0 +1,130 @@
+from dataclasses import dataclass
+import io
+from typing import Tuple
+import wave
+
+import numpy as np
+import speech_recognition as sr
+
+from audio.wav import PcmFormat, parse_wav
+from common.metrics import METRICS
+
+# Little endian sample types by sample width. 8 bit wav is unsigned.
+SAMPLE_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+@dataclass(frozen=True)
+class SpeechPreprocessConfig:
+    # Whisper style models work on 16 kHz mono, anything above is uploaded for nothing.
+    sample_rate: int = 16000
+    # Length of the frames the energy detector classifies as speech or silence.
+    frame_seconds: float = 0.02
+    # Frames louder than the noise floor by this many dB are speech.
+    speech_margin_db: float = 12.0
+    # Frames quieter than this are never speech, even in a silent room.
+    min_speech_db: float = -50.0
+    # Audio kept before the first and after the last speech frame.
+    padding_seconds: float = 0.2
+    # Encode as FLAC instead of wav. Needs the flac converter of speech_recognition.
+    flac: bool = False
+
+
+def pcm_to_mono(pcm_format: PcmFormat, pcm: memoryview) -> np.ndarray | None:
+    # Float samples in [-1, 1], channels averaged. None for unsupported sample widths.
+    dtype = SAMPLE_DTYPES.get(pcm_format.sample_width)
+    if dtype is None:
+        return None
+    samples = np.frombuffer(pcm, dtype=np.dtype(dtype).newbyteorder("<")).astype(np.float32)
+    if pcm_format.sample_width == 1:
+        samples = (samples - 128.0) / 128.0
+    else:
+        samples /= float(2 ** (8 * pcm_format.sample_width - 1))
+    if pcm_format.channels > 1:
+        samples = samples.reshape(-1, pcm_format.channels).mean(axis=1)
+    return samples
+
+
+def detect_speech(
+    samples: np.ndarray, sample_rate: int, config: SpeechPreprocessConfig
+) -> Tuple[int, int] | None:
+    """
+    Return (start, end) sample indices of the speech in samples, padded by
+    config.padding_seconds, or None if there is no speech.
+    Frames are classified by their energy relative to the noise floor, estimated as
+    a low percentile of all frame energies.
+    """
+    frame_length = max(int(sample_rate * config.frame_seconds), 1)
+    num_frames = len(samples) // frame_length
+    if num_frames == 0:
+        return None
+    frames = samples[: num_frames * frame_length].reshape(num_frames, frame_length)
+    energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+    noise_floor_db = np.percentile(energy_db, 10)
+    threshold_db = max(noise_floor_db + config.speech_margin_db, config.min_speech_db)
+    speech_frames = np.flatnonzero(energy_db > threshold_db)
+    if len(speech_frames) == 0:
+        return None
+    padding = int(sample_rate * config.padding_seconds)
+    start = max(speech_frames[0] * frame_length - padding, 0)
+    end = min((speech_frames[-1] + 1) * frame_length + padding, len(samples))
+    return start, end
+
+
+def resample(samples: np.ndarray, sample_rate: int, target_sample_rate: int) -> np.ndarray:
+    if sample_rate == target_sample_rate or len(samples) == 0:
+        return samples
+    if target_sample_rate < sample_rate:
+        # Windowed sinc low pass below the new Nyquist frequency against aliasing.
+        cutoff = 0.45 * target_sample_rate / sample_rate
+        taps = np.arange(-32, 33)
+        kernel = 2 * cutoff * np.sinc(2 * cutoff * taps) * np.hamming(len(taps))
+        samples = np.convolve(samples, (kernel / kernel.sum()).astype(np.float32), mode="same")
+    num_samples = int(len(samples) * target_sample_rate / sample_rate)
+    positions = np.arange(num_samples) * (sample_rate / target_sample_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def encode_wav(samples: np.ndarray, sample_rate: int) -> bytes:
+    # 16 bit mono wav.
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def preprocess_speech(
+    data: bytes | None, config: SpeechPreprocessConfig = SpeechPreprocessConfig()
+) -> bytes | None:
+    """
+    Trim leading and trailing silence from recorded wav audio and convert it to 16 bit
+    mono at config.sample_rate, optionally FLAC encoded, to cut upload size and speech
+    to text work. Audio that cannot be parsed is returned unchanged.
+    """
+    if data is None:
+        return None
+    parsed = parse_wav(data)
+    samples = pcm_to_mono(*parsed) if parsed is not None else None
+    if samples is None:
+        return data
+    sample_rate = parsed[0].sample_rate
+    speech = detect_speech(samples, sample_rate, config)
+    if speech is not None:
+        # Without speech, upload everything and let speech to text decide.
+        samples = samples[speech[0] : speech[1]]
+    samples = resample(samples, sample_rate, config.sample_rate)
+    content = encode_wav(samples, config.sample_rate)
+    if config.flac:
+        try:
+            content = sr.AudioData(
+                parse_wav(content)[1].tobytes(), config.sample_rate, 2
+            ).get_flac_data()
+        except OSError as e:
+            print(f"Error encoding flac, uploading wav: {e}")
+    METRICS.increment("stt.upload_bytes", len(content))
+    METRICS.increment("stt.upload_bytes_saved", len(data) - len(content))
+    print(f"INFO: speech audio {len(data)} -> {len(content)} bytes")
+    return content
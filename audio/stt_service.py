@@ -3,10 +3,24 @@ import io
 import os
 import threading
 from math import e
-import time
 from typing import Tuple
-from openai import OpenAI
-from audio.audio_manager import AudioManager, SpeechToTextResult, SpeechToTextTask
+from openai import APIError, AsyncOpenAI, OpenAI
+from common.admission import AdmissionLimits, Overloaded
+from common.backend_pool import BackendPool, alease_backend, lease_backend
+from common.hedging import HedgePolicy
+from common.http_session import (
+    DEFAULT_HTTP_SESSION_CONFIG,
+    HttpSessionConfig,
+    create_async_httpx_client,
+    create_httpx_client,
+)
+from common.metrics import METRICS
+from audio.audio_manager import (
+    TASK_WAIT_TIMEOUT,
+    AudioManager,
+    SpeechToTextResult,
+    SpeechToTextTask,
+)
 
 
 @dataclass(frozen=True)
@@ -15,35 +29,140 @@ class STTService:
     url: str = "http://192.168.1.26:8000/v1"
     model_name: str = "Systran/faster-distil-whisper-large-v3"
     stop_event: threading.Event = field(default_factory=threading.Event)
-    client: OpenAI = OpenAI(api_key="dummy key", base_url=url)
+    # The client keeps a pool of keep-alive connections to the backend.
+    # Created from url if not given.
+    client: OpenAI | None = None
+    # Used by aconvert. Created from url if not given.
+    async_client: AsyncOpenAI | None = None
+    # Routes each request to one of several backends instead of url.
+    backend_pool: BackendPool | None = None
+    # Sends a second request if the first one is slow, the first transcript wins.
+    hedge: HedgePolicy | None = None
+    # Concurrency and rate limits per backend. None sends requests right away.
+    admission: AdmissionLimits | None = None
+    # Connection pool size and timeouts of the clients created from url.
+    http_config: HttpSessionConfig = DEFAULT_HTTP_SESSION_CONFIG
+
+    def __post_init__(self):
+        # Clients of the pool's backends, sharing the connection pools of client and async_client.
+        object.__setattr__(self, "_clients", {})
+        if self.client is None:
+            client = OpenAI(
+                api_key="dummy key",
+                base_url=self.url,
+                http_client=create_httpx_client(self.http_config),
+            )
+            object.__setattr__(self, "client", client)
+        if self.async_client is None:
+            async_client = AsyncOpenAI(
+                api_key="dummy key",
+                base_url=self.url,
+                http_client=create_async_httpx_client(self.http_config),
+            )
+            object.__setattr__(self, "async_client", async_client)
 
     def run(self):
         while not self.stop_event.is_set():
-            if self.audio_manager.has_pending_audio_to_text_tasks():
-                task = self.audio_manager.get_audio_to_text_task()
+            task = self.audio_manager.get_audio_to_text_task(timeout=TASK_WAIT_TIMEOUT)
+            if task is not None:
                 self.audio_manager.save_audio_to_text_result(
                     SpeechToTextResult(task=task, text=self.convert(task))
                 )
 
     def convert(self, task: SpeechToTextTask, lang="en") -> str | None:
         try:
-            audio_file = io.BytesIO(task.audio_data)
-            transcript = self.client.audio.transcriptions.create(
-                model=self.model_name,
-                file=audio_file,
-                language=lang,
-            )
-            return transcript.text
-        except Exception as e:
+            if self.hedge is None:
+                return self._convert_once(task, lang)
+            return self.hedge.call(lambda: self._convert_once(task, lang))
+        except Overloaded as e:
             print(f"Error converting audio to text: {e}")
             return None
 
+    def _convert_once(self, task: SpeechToTextTask, lang: str) -> str | None:
+        with lease_backend(self.backend_pool, self.url, limits=self.admission) as lease:
+            try:
+                audio_file = io.BytesIO(task.audio_data)
+                audio_file.name = _audio_file_name(task.audio_data)
+                with METRICS.timer("backend.stt", backend=lease.url):
+                    transcript = self._client(lease.url).audio.transcriptions.create(
+                        model=self.model_name,
+                        file=audio_file,
+                        language=lang,
+                    )
+                return transcript.text
+            except APIError as e:
+                # Connection, timeout or http status errors count against the backend.
+                print(f"Error converting audio to text: {e}")
+                METRICS.increment("backend.stt.errors", backend=lease.url)
+                lease.fail()
+                return None
+            except Exception as e:
+                # e.g. a malformed task, the backend is not to blame.
+                print(f"Error converting audio to text: {e}")
+                return None
+
+    async def aconvert(self, task: SpeechToTextTask, lang="en") -> str | None:
+        try:
+            if self.hedge is None:
+                return await self._aconvert_once(task, lang)
+            return await self.hedge.acall(lambda: self._aconvert_once(task, lang))
+        except Overloaded as e:
+            print(f"Error converting audio to text: {e}")
+            return None
+
+    async def _aconvert_once(self, task: SpeechToTextTask, lang: str) -> str | None:
+        async with alease_backend(
+            self.backend_pool, self.url, limits=self.admission
+        ) as lease:
+            try:
+                audio_file = io.BytesIO(task.audio_data)
+                audio_file.name = _audio_file_name(task.audio_data)
+                with METRICS.timer("backend.stt", backend=lease.url):
+                    transcript = await self._client(
+                        lease.url, asynchronous=True
+                    ).audio.transcriptions.create(
+                        model=self.model_name,
+                        file=audio_file,
+                        language=lang,
+                    )
+                return transcript.text
+            except APIError as e:
+                # Connection, timeout or http status errors count against the backend.
+                print(f"Error converting audio to text: {e}")
+                METRICS.increment("backend.stt.errors", backend=lease.url)
+                lease.fail()
+                return None
+            except Exception as e:
+                # e.g. a malformed task, the backend is not to blame.
+                print(f"Error converting audio to text: {e}")
+                return None
+
+    def _client(self, url: str, asynchronous: bool = False) -> OpenAI | AsyncOpenAI:
+        client = self.async_client if asynchronous else self.client
+        if url == self.url:
+            return client
+        key = (url, asynchronous)
+        if key not in self._clients:
+            self._clients[key] = client.with_options(base_url=url)
+        return self._clients[key]
+
     def stop(self):
         self.stop_event.set()
+        if self.backend_pool is not None:
+            self.backend_pool.stop()
+
+
+def _audio_file_name(audio_data: bytes) -> str:
+    # The backend tells formats apart by file extension.
+    return "speech.flac" if audio_data[:4] == b"fLaC" else "speech.wav"
 
 
-def start_stt(audio_manager: AudioManager) -> Tuple[STTService, threading.Thread]:
-    stt_service = STTService(audio_manager)
+def start_stt(
+    audio_manager: AudioManager, url: str | None = None
+) -> Tuple[STTService, threading.Thread]:
+    stt_service = (
+        STTService(audio_manager) if url is None else STTService(audio_manager, url=url)
+    )
     thread = threading.Thread(target=stt_service.run)
     thread.start()
     return stt_service, thread
@@ -66,8 +185,6 @@ if __name__ == "__main__":
             audio_data = wav_file.read()
         task = SpeechToTextTask(task_id=str(i), audio_data=audio_data)
         audio_manager.add_audio_to_text_task(task)
-        while not audio_manager.has_audio_to_text_results(task=task):
-            time.sleep(1)
-        text = audio_manager.get_audio_to_text_result(task_id=task.task_id)
-        print(f"speech to text result: {text}")
+        result = audio_manager.wait_for_audio_to_text_result(task_id=task.task_id)
+        print(f"speech to text result: {result.text}")
     stop_stt(stt_service=stt_service, thread=thread)
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import hashlib
+import os
+import threading
+from typing import Dict
+
+
+def normalize_text(text: str) -> str:
+    # Collapse whitespace, so the same sentence from different answers maps to the same key.
+    return " ".join(text.split())
+
+
+@dataclass
+class TTSCache:
+    """
+    Content addressed cache for synthesized audio.
+    Entries live in an in-memory LRU and, if disk_dir is set, in a second LRU on disk.
+    Both tiers are bounded by total bytes. Thread safe, so tts workers can share one cache.
+    """
+
+    memory_max_bytes: int = 64 * 1024 * 1024
+    disk_dir: str | None = field(
+        default_factory=lambda: os.path.join(
+            os.path.expanduser("~"), ".cache", "assistant", "tts"
+        )
+    )
+    disk_max_bytes: int = 512 * 1024 * 1024
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        # { key: content } in least recently used order.
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        # { key: size } in least recently used order.
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(text: str, language: str, speaker_id: str, service_type: str) -> str:
+        raw_key = "\x00".join([normalize_text(text), language, speaker_id, service_type])
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+            if key in self._disk:
+                try:
+                    with open(self._disk_path(key), "rb") as f:
+                        content = f.read()
+                except OSError:
+                    self._remove_from_disk(key)
+                else:
+                    self._disk.move_to_end(key)
+                    # Keep the disk order across restarts.
+                    os.utime(self._disk_path(key))
+                    self.disk_hits += 1
+                    self._put_in_memory(key, content)
+                    return content
+            self.misses += 1
+            return None
+
+    def put(self, key: str, content: bytes) -> None:
+        with self._lock:
+            self._put_in_memory(key, content)
+            if self.disk_dir is not None and key not in self._disk:
+                self._put_on_disk(key, content)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _put_in_memory(self, key: str, content: bytes) -> None:
+        if len(content) > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = content
+        self._memory_bytes += len(content)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.evictions += 1
+
+    def _put_on_disk(self, key: str, content: bytes) -> None:
+        if len(content) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing tts cache entry: {e}")
+            return
+        self._disk[key] = len(content)
+        self._disk_bytes += len(content)
+        while self._disk_bytes > self.disk_max_bytes:
+            evicted_key = next(iter(self._disk))
+            self._remove_from_disk(evicted_key)
+            self.evictions += 1
+
+    def _remove_from_disk(self, key: str) -> None:
+        self._disk_bytes -= self._disk.pop(key)
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.wav")
+
+    def _load_disk_index(self) -> None:
+        # Rebuild the disk LRU from a previous run, oldest modified first.
+        entries = []
+        for filename in os.listdir(self.disk_dir):
+            if not filename.endswith(".wav"):
+                continue
+            stat = os.stat(os.path.join(self.disk_dir, filename))
+            entries.append((stat.st_mtime, filename[: -len(".wav")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
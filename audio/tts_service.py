@@ -1,18 +1,36 @@
+from contextlib import ExitStack
 from dataclasses import dataclass, field
 from enum import Enum
 import json
 import threading
-import time
 from typing import Any, Dict, List, Tuple
 from openai import audio
+import httpx
 import requests
 from audio.audio_manager import (
+    TASK_WAIT_TIMEOUT,
     AudioManager,
     TextToSpeechResultChatTTS,
     TextToSpeechResultMeloTTS,
     TextToSpeechTask,
 )
+from audio.audio_stream import AudioStream
+from audio.tts_cache import TTSCache
+from common.admission import AdmissionLimits, Overloaded
+from common.backend_pool import (
+    BackendLease,
+    BackendPool,
+    alease_backend,
+    lease_backend,
+)
+from common.hedging import HedgePolicy
 from audio.util import play_audio
+from common.metrics import METRICS
+from common.http_session import (
+    DEFAULT_HTTP_SESSION_CONFIG,
+    HttpSessionConfig,
+    get_session,
+)
 
 
 class TTSServiceType(Enum):
@@ -24,6 +42,8 @@ class TTSServiceType(Enum):
 class TTSService:
     audio_manager: AudioManager
     stop_event: threading.Event = field(default_factory=threading.Event)
+    # Connection pool size and timeouts of the keep-alive session shared per backend.
+    http_config: HttpSessionConfig = field(default=DEFAULT_HTTP_SESSION_CONFIG)
 
     def run(self):
         raise NotImplemented("run not implemented")
@@ -52,34 +72,35 @@ class TTSServiceChatTTS(TTSService):
 
     def run(self):
         while not self.stop_event.is_set():
-            if self.audio_manager.has_pending_text_to_audio_tasks():
-                task = self.audio_manager.get_text_to_audio_task()
-                if task is not None:
-                    raw_response = self.convert(task)
-                    self.audio_manager.save_text_to_audio_result(
-                        TextToSpeechResultChatTTS(task, raw_response)
-                    )
-
-    def convert(self, task: TextToSpeechTask) -> requests.Response:
+            task = self.audio_manager.get_text_to_audio_task(timeout=TASK_WAIT_TIMEOUT)
+            if task is not None:
+                raw_response = self.convert(task)
+                self.audio_manager.save_text_to_audio_result(
+                    TextToSpeechResultChatTTS(task, raw_response)
+                )
+
+    def convert(self, task: TextToSpeechTask) -> requests.Response | None:
         try:
-            raw_response = requests.post(
-                self.url,
-                data={
-                    "text": task.text,
-                    "prompt": "",
-                    "voice": self.voice,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "top_k": self.top_k,
-                    "skip_refine": self.skip_refine,
-                    "custom_voice": self.custom_voice,
-                },
-            )
+            with METRICS.timer("backend.tts", backend=self.url):
+                raw_response = get_session(self.url, self.http_config).post(
+                    self.url,
+                    timeout=self.http_config.timeout,
+                    data={
+                        "text": task.text,
+                        "prompt": "",
+                        "voice": self.voice,
+                        "temperature": self.temperature,
+                        "top_p": self.top_p,
+                        "top_k": self.top_k,
+                        "skip_refine": self.skip_refine,
+                        "custom_voice": self.custom_voice,
+                    },
+                )
             return raw_response
         except Exception as e:
             print(f"Error converting text to audio: {e}")
-            print(f"raw response: {raw_response}")
-            return {"code": 1, "msg": "error", "error": e}
+            METRICS.increment("backend.tts.errors", backend=self.url)
+            return None
 
     def stop(self):
         self.stop_event.set()
@@ -94,57 +115,326 @@ class TTSServiceMeloTTS(TTSService):
     url: str = "http://192.168.1.26:9966/convert/tts"
     language: str = field(default="EN")
     speaker_id: str = field(default="EN-US")
+    # Synthesized audio cache, shared by all workers. None disables caching.
+    cache: TTSCache | None = field(default=None)
+    # Hand results to consumers as soon as the response headers arrive and stream the
+    # body into result.audio_stream, so playback can start before synthesis finishes.
+    stream_audio: bool = field(default=False)
+    # Bytes read from the response body at a time when streaming.
+    stream_chunk_bytes: int = field(default=8192)
+    # Routes each request to one of several backends instead of url. Shared by all workers.
+    backend_pool: BackendPool | None = field(default=None)
+    # Sends a second request if the first one is slow, the first response wins.
+    # Shared by all workers, so the hedge delay is based on all their latencies.
+    hedge: HedgePolicy | None = field(default=None)
+    # Concurrency and rate limits per backend. None sends requests right away.
+    admission: AdmissionLimits | None = field(default=None)
 
     def run(self):
         while not self.stop_event.is_set():
-            if self.audio_manager.has_pending_text_to_audio_tasks():
-                task = self.audio_manager.get_text_to_audio_task()
-                if task is not None:
-                    raw_response = self.convert(task)
-                    self.audio_manager.save_text_to_audio_result(
-                        TextToSpeechResultMeloTTS(task, raw_response)
-                    )
+            task = self.audio_manager.get_text_to_audio_task(timeout=TASK_WAIT_TIMEOUT)
+            if task is None:
+                continue
+            if self.stream_audio:
+                self.synthesize_streaming(task)
             else:
-                time.sleep(0.1)
+                self.audio_manager.save_text_to_audio_result(self.synthesize(task))
+
+    def synthesize(self, task: TextToSpeechTask) -> TextToSpeechResultMeloTTS:
+        # Serve from cache if possible, otherwise call the backend and cache the audio.
+        if self.cache is None:
+            return TextToSpeechResultMeloTTS(task, self.convert(task))
+        key = self._cache_key(task)
+        content = self.cache.get(key)
+        if content is not None:
+            return TextToSpeechResultMeloTTS(task, raw_response=None, content=content)
+        result = TextToSpeechResultMeloTTS(task, self.convert(task))
+        if result.content is not None:
+            self.cache.put(key, result.content)
+        return result
 
-    def convert(self, task: TextToSpeechTask) -> requests.Response:
+    def synthesize_streaming(self, task: TextToSpeechTask) -> None:
+        """
+        Like synthesize, but the result is saved once the response headers arrive and
+        the body is copied into its audio_stream while it downloads. Returns when the
+        body has been read, or the consumer cancelled the stream.
+        """
+        key = self._cache_key(task) if self.cache is not None else None
+        if key is not None and (content := self.cache.get(key)) is not None:
+            self.audio_manager.save_text_to_audio_result(
+                TextToSpeechResultMeloTTS(task, raw_response=None, content=content)
+            )
+            return
+        # Only the wait for the headers is hedged, the body is read from the winner.
         try:
-            raw_response = requests.post(
-                self.url,
-                data=json.dumps(
-                    {
-                        "text": task.text,
-                        "language": self.language,
-                        "speaker_id": self.speaker_id,
-                    }
-                ),
-                headers={"Content-Type": "application/json"},
+            if self.hedge is None:
+                raw_response, lease, leases = self._open_stream(task)
+            else:
+                raw_response, lease, leases = self.hedge.call(
+                    lambda: self._open_stream(task),
+                    discard=_close_stream,
+                    succeeded=lambda opened: _is_ok(opened[0]),
+                )
+        except Overloaded as e:
+            print(f"Error converting text to audio: {e}")
+            self.audio_manager.save_text_to_audio_result(
+                TextToSpeechResultMeloTTS(task, raw_response=None)
+            )
+            return
+        with leases:
+            self._stream_result(task, raw_response, lease, key)
+
+    def _open_stream(
+        self, task: TextToSpeechTask
+    ) -> Tuple[requests.Response | None, BackendLease, ExitStack]:
+        # The backend counts as busy until the returned stack is closed, after the body is read.
+        leases = ExitStack()
+        lease = leases.enter_context(
+            lease_backend(self.backend_pool, self.url, limits=self.admission)
+        )
+        return self._post(task, lease, stream=True), lease, leases
+
+    def _stream_result(
+        self,
+        task: TextToSpeechTask,
+        raw_response: requests.Response | None,
+        lease: BackendLease,
+        key: str | None,
+    ) -> None:
+        if raw_response is None or raw_response.status_code != 200:
+            self.audio_manager.save_text_to_audio_result(
+                TextToSpeechResultMeloTTS(task, raw_response)
             )
+            return
+        audio_stream = AudioStream()
+        self.audio_manager.save_text_to_audio_result(
+            TextToSpeechResultMeloTTS(task, raw_response, audio_stream=audio_stream)
+        )
+        # Only buffered when the complete audio has to be cached.
+        chunks = [] if key is not None else None
+        try:
+            with METRICS.timer("backend.tts.body", backend=lease.url):
+                for chunk in raw_response.iter_content(self.stream_chunk_bytes):
+                    if audio_stream.cancelled or self.stop_event.is_set():
+                        METRICS.increment("cancelled.tts_streams")
+                        return
+                    audio_stream.write(chunk)
+                    if chunks is not None:
+                        chunks.append(chunk)
+            if chunks is not None:
+                self.cache.put(key, b"".join(chunks))
+        except Exception as e:
+            print(f"Error streaming audio: {e}")
+            METRICS.increment("backend.tts.errors", backend=lease.url)
+            lease.fail()
+        finally:
+            audio_stream.close()
+            # Closing an unfinished response drops the connection, the backend stops sending.
+            raw_response.close()
+
+    async def asynthesize(
+        self, task: TextToSpeechTask, client: httpx.AsyncClient
+    ) -> TextToSpeechResultMeloTTS:
+        # Same as synthesize, for the asyncio pipeline.
+        key = self._cache_key(task) if self.cache is not None else None
+        if key is not None and (content := self.cache.get(key)) is not None:
+            return TextToSpeechResultMeloTTS(task, raw_response=None, content=content)
+        content = await self.aconvert(task, client)
+        if key is not None and content is not None:
+            self.cache.put(key, content)
+        return TextToSpeechResultMeloTTS(task, raw_response=None, content=content)
+
+    def convert(
+        self, task: TextToSpeechTask, stream: bool = False
+    ) -> requests.Response | None:
+        # With stream, returns once the headers arrive and the body is left unread.
+        try:
+            if self.hedge is None:
+                return self._leased_post(task, stream)
+            return self.hedge.call(
+                lambda: self._leased_post(task, stream),
+                discard=_close_response,
+                succeeded=_is_ok,
+            )
+        except Overloaded as e:
+            print(f"Error converting text to audio: {e}")
+            return None
+
+    def _leased_post(
+        self, task: TextToSpeechTask, stream: bool
+    ) -> requests.Response | None:
+        with lease_backend(self.backend_pool, self.url, limits=self.admission) as lease:
+            return self._post(task, lease, stream)
+
+    def _post(
+        self, task: TextToSpeechTask, lease: BackendLease, stream: bool
+    ) -> requests.Response | None:
+        try:
+            with METRICS.timer(
+                "backend.tts.first_byte" if stream else "backend.tts", backend=lease.url
+            ):
+                raw_response = get_session(lease.url, self.http_config).post(
+                    lease.url,
+                    timeout=self.http_config.timeout,
+                    data=json.dumps(self._payload(task)),
+                    headers={"Content-Type": "application/json"},
+                    stream=stream,
+                )
+            if raw_response.status_code >= 500:
+                lease.fail()
             return raw_response
         except Exception as e:
             print(f"Error converting text to audio: {e}")
-            print(f"raw response: {raw_response}")
-            return {"code": 1, "msg": "error", "error": e}
+            METRICS.increment("backend.tts.errors", backend=lease.url)
+            lease.fail()
+            return None
+
+    async def aconvert(
+        self, task: TextToSpeechTask, client: httpx.AsyncClient
+    ) -> bytes | None:
+        try:
+            if self.hedge is None:
+                return await self._apost(task, client)
+            # The slower request is cancelled, which closes its connection.
+            return await self.hedge.acall(lambda: self._apost(task, client))
+        except Overloaded as e:
+            print(f"Error converting text to audio: {e}")
+            return None
+
+    async def _apost(
+        self, task: TextToSpeechTask, client: httpx.AsyncClient
+    ) -> bytes | None:
+        async with alease_backend(
+            self.backend_pool, self.url, limits=self.admission
+        ) as lease:
+            try:
+                with METRICS.timer("backend.tts", backend=lease.url):
+                    response = await client.post(lease.url, json=self._payload(task))
+                if response.status_code == 200:
+                    return response.content
+                print(f"Error converting text to audio: status {response.status_code}")
+                if response.status_code >= 500:
+                    lease.fail()
+            except Exception as e:
+                print(f"Error converting text to audio: {e}")
+                lease.fail()
+            METRICS.increment("backend.tts.errors", backend=lease.url)
+            return None
+
+    def _payload(self, task: TextToSpeechTask) -> Dict[str, str]:
+        return {
+            "text": task.text,
+            "language": self.language,
+            "speaker_id": self.speaker_id,
+        }
+
+    def _cache_key(self, task: TextToSpeechTask) -> str:
+        return TTSCache.make_key(
+            text=task.text,
+            language=self.language,
+            speaker_id=self.speaker_id,
+            service_type=TTSServiceType.MELO_TTS.name,
+        )
 
     def stop(self):
         self.stop_event.set()
+        if self.backend_pool is not None:
+            self.backend_pool.stop()
 
 
-def start_tts(
+def _is_ok(raw_response: requests.Response | None) -> bool:
+    return raw_response is not None and raw_response.status_code == 200
+
+
+def _close_response(raw_response: requests.Response | None) -> None:
+    if raw_response is not None:
+        raw_response.close()
+
+
+def _close_stream(
+    opened: Tuple[requests.Response | None, BackendLease, ExitStack]
+) -> None:
+    raw_response, _, leases = opened
+    _close_response(raw_response)
+    leases.close()
+
+
+def create_tts_service(
     audio_manager: AudioManager,
     tts_service_type: TTSServiceType = TTSServiceType.CHAT_TTS,
-) -> Tuple[TTSService, threading.Thread]:
+    url: str | None = None,
+    cache: TTSCache | None = None,
+    stream_audio: bool = False,
+    backend_pool: BackendPool | None = None,
+    hedge: HedgePolicy | None = None,
+    admission: AdmissionLimits | None = None,
+) -> TTSService:
+    kwargs = {}
+    if url is not None:
+        kwargs["url"] = url
     if tts_service_type == TTSServiceType.CHAT_TTS:
-        tts_service = TTSServiceChatTTS(audio_manager)
+        # ChatTTS returns urls of files on the server, there is no audio to cache.
+        return TTSServiceChatTTS(audio_manager, **kwargs)
     elif tts_service_type == TTSServiceType.MELO_TTS:
-        tts_service = TTSServiceMeloTTS(audio_manager)
+        return TTSServiceMeloTTS(
+            audio_manager,
+            cache=cache,
+            stream_audio=stream_audio,
+            backend_pool=backend_pool,
+            hedge=hedge,
+            admission=admission,
+            **kwargs,
+        )
     else:
         raise Exception(f"TTSServiceType: {tts_service_type.Name} not supported")
+
+
+def start_tts(
+    audio_manager: AudioManager,
+    tts_service_type: TTSServiceType = TTSServiceType.CHAT_TTS,
+) -> Tuple[TTSService, threading.Thread]:
+    tts_service = create_tts_service(audio_manager, tts_service_type)
     thread = threading.Thread(target=tts_service.run)
     thread.start()
     return tts_service, thread
 
 
+def start_tts_pool(
+    audio_manager: AudioManager,
+    tts_service_type: TTSServiceType = TTSServiceType.CHAT_TTS,
+    num_workers: int = 1,
+    urls: List[str] | None = None,
+    cache: TTSCache | None = None,
+    stream_audio: bool = False,
+    backend_pool: BackendPool | None = None,
+    hedge: HedgePolicy | None = None,
+    admission: AdmissionLimits | None = None,
+) -> List[Tuple[TTSService, threading.Thread]]:
+    """
+    Start num_workers tts services consuming audio_manager.text_to_audio_tasks in parallel.
+    Workers are assigned to urls round robin, unless they share a MeloTTS backend_pool,
+    which sends every request to the least busy backend. Results are keyed by task id,
+    so consumers reassemble them in the original order by waiting on task ids in order.
+    """
+    urls = urls or [None]
+    services = []
+    for i in range(num_workers):
+        tts_service = create_tts_service(
+            audio_manager,
+            tts_service_type,
+            url=urls[i % len(urls)],
+            cache=cache,
+            stream_audio=stream_audio,
+            backend_pool=backend_pool,
+            hedge=hedge,
+            admission=admission,
+        )
+        thread = threading.Thread(target=tts_service.run)
+        thread.start()
+        services.append((tts_service, thread))
+    return services
+
+
 def stop_tts(tts_service: TTSService, thread: threading.Thread) -> None:
     tts_service.stop()
     thread.join()
@@ -188,8 +478,7 @@ if __name__ == "__main__":
         print(f"processing {i}th text: {text}")
         task = TextToSpeechTask(task_id=str(i), text=text)
         audio_manager.add_text_to_audio_task(task)
-        while not audio_manager.has_text_to_audio_results(task=task):
-            time.sleep(1)
+        audio_manager.wait_for_text_to_audio_result(task_id=task.task_id)
         if tts_service_type == TTSServiceType.CHAT_TTS:
             example_play_audio_chat_tts(audio_manager=audio_manager, task=task)
         elif tts_service_type == TTSServiceType.MELO_TTS:
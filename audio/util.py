@@ -1,15 +1,25 @@
+from contextlib import contextmanager
 import io
-import requests
+import threading
+from typing import Any, Iterator
 from pydub import AudioSegment
 from pydub.playback import play
 import speech_recognition as sr
 
+from common.http_session import (
+    DEFAULT_HTTP_SESSION_CONFIG,
+    HttpSessionConfig,
+    get_session,
+)
+
 # pydub relies on ffmpeg: brew install ffmpeg
 speech_recognizer = sr.Recognizer()
 
 
-def fetch_audio_from_url(url):
-    response = requests.get(url)
+def fetch_audio_from_url(
+    url, http_config: HttpSessionConfig = DEFAULT_HTTP_SESSION_CONFIG
+):
+    response = get_session(url, http_config).get(url, timeout=http_config.timeout)
     if response.status_code == 200:
         return response.content
     else:
@@ -35,12 +45,79 @@ def play_audio(url: str | None, content: bytes | None = None) -> None:
         print(f"Error playing audio: {str(e)}")
 
 
+class RecordingStopped(Exception):
+    # Recording was stopped through its stop_event, e.g. the user barged in.
+    pass
+
+
+class _StoppableStream:
+    # Wraps a microphone stream, so that listening raises RecordingStopped at the next
+    # chunk read once stop_event is set, instead of waiting for the user to stop speaking.
+    # Once end_event is set the stream reads as silence, so listening ends as if the
+    # user stopped speaking and keeps what was said so far. Nothing said by then stops
+    # the recording after max_end_silence seconds of silence.
+
+    def __init__(
+        self,
+        stream: Any,
+        stop_event: threading.Event | None,
+        end_event: threading.Event | None,
+        sample_width: int,
+        sample_rate: int,
+        max_end_silence: float = 2.0,
+    ):
+        self._stream = stream
+        self._stop_event = stop_event
+        self._end_event = end_event
+        self._sample_width = sample_width
+        self._max_end_silence_frames = int(max_end_silence * sample_rate)
+        self._end_silence_frames = 0
+
+    def read(self, size: int) -> bytes:
+        if self._stop_event is not None and self._stop_event.is_set():
+            raise RecordingStopped()
+        if self._end_event is not None and self._end_event.is_set():
+            self._end_silence_frames += size
+            if self._end_silence_frames > self._max_end_silence_frames:
+                raise RecordingStopped()
+            return b"\0" * size * self._sample_width
+        return self._stream.read(size)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._stream, name)
+
+
+@contextmanager
+def _recording_source(
+    device_index,
+    stop_event: threading.Event | None,
+    end_event: threading.Event | None = None,
+) -> Iterator[sr.Microphone]:
+    with sr.Microphone(device_index=device_index) as source:
+        if stop_event is not None or end_event is not None:
+            source.stream = _StoppableStream(
+                source.stream,
+                stop_event,
+                end_event,
+                sample_width=source.SAMPLE_WIDTH,
+                sample_rate=source.SAMPLE_RATE,
+            )
+        yield source
+
+
 def record_audio(
-    device_index=None, duration=None, engery_threshold=300, pause_threshold=0.8
+    device_index=None,
+    duration=None,
+    engery_threshold=300,
+    pause_threshold=0.8,
+    stop_event: threading.Event | None = None,
+    end_event: threading.Event | None = None,
 ) -> bytes | None:
+    # Returns None if recording failed or was stopped through stop_event. Setting
+    # end_event ends the recording like a pause, e.g. the user pressed the hotkey.
     speech_recognizer.energy_threshold = engery_threshold
     speech_recognizer.pause_threshold = pause_threshold
-    with sr.Microphone(device_index=device_index) as source:
+    with _recording_source(device_index, stop_event, end_event) as source:
         print(f"Recording...")
         try:
             if duration:
@@ -51,10 +128,56 @@ def record_audio(
                 audio = speech_recognizer.listen(source)  # Record until silence
             print("Recording finished.")
             return audio.get_wav_data()
+        except RecordingStopped:
+            print("INFO: recording stopped")
+            return None
         except Exception as e:
             print(f"Error recording audio: {e}")
             return None
 
+
+def record_audio_segments(
+    device_index=None,
+    engery_threshold=300,
+    segment_pause_threshold=0.3,
+    pause_threshold=0.8,
+    max_segment_duration=10,
+    stop_event: threading.Event | None = None,
+    end_event: threading.Event | None = None,
+) -> Iterator[bytes]:
+    """
+    Record until silence like record_audio, but yield wav segments while recording.
+    A segment ends after a short pause (segment_pause_threshold) or max_segment_duration
+    seconds. Recording ends once the pause reaches pause_threshold, or end_event is set,
+    or right away once stop_event is set.
+    """
+    segment_recognizer = sr.Recognizer()
+    segment_recognizer.energy_threshold = engery_threshold
+    segment_recognizer.pause_threshold = segment_pause_threshold
+    segment_recognizer.non_speaking_duration = segment_pause_threshold
+    # A segment already ends with segment_pause_threshold seconds of silence.
+    end_of_speech_timeout = max(pause_threshold - segment_pause_threshold, 0.05)
+    with _recording_source(device_index, stop_event, end_event) as source:
+        print(f"Recording...")
+        timeout = None
+        while True:
+            try:
+                audio = segment_recognizer.listen(
+                    source, timeout=timeout, phrase_time_limit=max_segment_duration
+                )
+            except sr.WaitTimeoutError:
+                # No new phrase started, the user stopped speaking.
+                break
+            except RecordingStopped:
+                print("INFO: recording stopped")
+                break
+            except Exception as e:
+                print(f"Error recording audio: {e}")
+                break
+            timeout = end_of_speech_timeout
+            yield audio.get_wav_data()
+        print("Recording finished.")
+
 if __name__ == "__main__":
     microphone_names = sr.Microphone.list_microphone_names()
     for index, name in enumerate(microphone_names):
@@ -0,0 +1,114 @@
+from dataclasses import dataclass
+import struct
+from typing import Tuple
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+@dataclass(frozen=True)
+class PcmFormat:
+    sample_rate: int
+    channels: int
+    # Bytes per sample, e.g. 2 for 16 bit audio.
+    sample_width: int
+
+    @property
+    def frame_size(self) -> int:
+        return self.channels * self.sample_width
+
+    @property
+    def bytes_per_second(self) -> int:
+        return self.sample_rate * self.frame_size
+
+
+def parse_wav(data: bytes) -> Tuple[PcmFormat, memoryview] | None:
+    """
+    Parse a PCM wav file without copying it.
+    Returns the format and a view on the sample data, or None if data is not PCM wav.
+    """
+    view = memoryview(data)
+    try:
+        header = _read_header(view)
+    except ValueError:
+        return None
+    if header is None:
+        return None
+    pcm_format, body, chunk_size = header
+    # Streamed wav files may declare a bogus size, so clamp to what we have.
+    end = min(body + chunk_size, len(view))
+    end -= (end - body) % pcm_format.frame_size
+    return pcm_format, view[body:end]
+
+
+@dataclass
+class WavStreamParser:
+    """
+    Incremental parse_wav for wav audio arriving in pieces, e.g. a streamed http body.
+    The header is parsed once, after that feed only splits off whole frames.
+    """
+
+    # Give up on finding the data chunk after this many bytes.
+    max_header_bytes: int = 64 * 1024
+
+    def __post_init__(self):
+        self.pcm_format: PcmFormat | None = None
+        self._header = bytearray()
+        # Bytes of an incomplete frame, kept for the next feed.
+        self._partial = b""
+
+    def feed(self, data: bytes) -> bytes:
+        """
+        Add the next piece and return the whole pcm frames available so far, which may
+        be empty. Raises ValueError if the stream is not PCM wav.
+        """
+        if self.pcm_format is None:
+            self._header += data
+            header = _read_header(memoryview(self._header))
+            if header is None:
+                if len(self._header) > self.max_header_bytes:
+                    raise ValueError("no wav data chunk found")
+                return b""
+            # The declared data size is ignored, streamed wav files often do not know it.
+            self.pcm_format, body, _ = header
+            data, self._header = bytes(self._header[body:]), bytearray()
+        if self._partial:
+            data = self._partial + data
+        end = len(data) - len(data) % self.pcm_format.frame_size
+        self._partial = data[end:]
+        return data[:end]
+
+
+def _read_header(view: memoryview) -> Tuple[PcmFormat, int, int] | None:
+    """
+    Return the format, offset and declared size of the data chunk, or None if view
+    ends before the data chunk. Raises ValueError if view is not PCM wav.
+    """
+    if len(view) < 12:
+        return None
+    if view[0:4] != b"RIFF" or view[8:12] != b"WAVE":
+        raise ValueError("not a wav file")
+    pcm_format, offset = None, 12
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset : offset + 4])
+        (chunk_size,) = struct.unpack_from("<I", view, offset + 4)
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            if body + 16 > len(view):
+                return None
+            audio_format, channels, sample_rate = struct.unpack_from("<HHI", view, body)
+            (bits_per_sample,) = struct.unpack_from("<H", view, body + 14)
+            if audio_format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE):
+                raise ValueError(f"unsupported wav format {audio_format}")
+            pcm_format = PcmFormat(
+                sample_rate=sample_rate,
+                channels=channels,
+                sample_width=bits_per_sample // 8,
+            )
+        elif chunk_id == b"data":
+            if pcm_format is None:
+                raise ValueError("wav data chunk before fmt chunk")
+            return pcm_format, body, chunk_size
+        # Chunks are padded to an even size.
+        offset = body + chunk_size + (chunk_size & 1)
+    return None
@@ -0,0 +1,88 @@
+"""
+Measure llm throughput against the number of backends behind a BackendPool, using
+local fake ollama servers that each serve one request at a time, like one GPU box.
+With --kill-after, one backend is stopped during the run to show it being ejected.
+
+    python -m benchmark.backend_pool_benchmark --num-requests 24 --backends 1 2 4
+    python -m benchmark.backend_pool_benchmark --backends 3 --kill-after 2
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import List, Tuple
+
+from benchmark.fake_servers import FakeOllamaServer
+from common.backend_pool import BackendPool
+from llm.llm_manager import LlmGenerationTask, LlmManager
+from llm.llm_service import LLMService
+
+
+def run_requests(
+    args: argparse.Namespace, servers: List[FakeOllamaServer]
+) -> Tuple[float, int, BackendPool]:
+    pool = BackendPool(
+        urls=[server.url for server in servers],
+        health_check_interval=args.health_check_interval,
+        eject_seconds=args.eject_seconds,
+    ).start()
+    llm_service = LLMService(LlmManager(), ollama_base_url=servers[0].url, backend_pool=pool)
+    failures = 0
+
+    def generate(i: int) -> None:
+        nonlocal failures
+        # A different context per request, so affinity does not pin them to one backend.
+        task = LlmGenerationTask(task_id=str(i), context=f"document {i}", question="summarize")
+        try:
+            list(llm_service.convert(task))
+        except Exception as e:
+            print(f"Error generating response {i}: {e}")
+            failures += 1
+
+    if args.kill_after is not None:
+        killer = threading.Timer(args.kill_after, servers[-1].stop)
+        killer.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(generate, range(args.num_requests)))
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    return elapsed, failures, pool
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-requests", type=int, default=24)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--backends", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--health-check-interval", type=float, default=1.0)
+    parser.add_argument("--eject-seconds", type=float, default=5.0)
+    # Seconds into each run at which the last backend is stopped.
+    parser.add_argument("--kill-after", type=float, default=None)
+    args = parser.parse_args()
+
+    print(f"{'backends':>8} {'seconds':>8} {'req/s':>8} {'failed':>8}  requests per backend")
+    for num_backends in args.backends:
+        servers = [
+            FakeOllamaServer(
+                latency=args.latency, tokens_per_second=args.tokens_per_second
+            ).start()
+            for _ in range(num_backends)
+        ]
+        try:
+            elapsed, failures, pool = run_requests(args, servers)
+        finally:
+            for server in servers:
+                server.stop()
+        per_backend = [backend["requests"] for backend in pool.stats()]
+        print(
+            f"{num_backends:>8} {elapsed:>8.2f} {args.num_requests / elapsed:>8.2f} "
+            f"{failures:>8}  {per_backend}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+End to end benchmark against local fake STT, LLM and TTS servers, so results are
+reproducible without GPU servers.
+
+Scenarios:
+    turns     full ContextManager turns, with replayed speech, a fixed clipboard
+              context and simulated playback. Reports time to first audio and
+              per stage latency.
+    barge-in  the same turns, each interrupted while the answer plays. Reports how
+              long cancelling takes and the cancelled work.
+    services  each service called on its own, reports backend latencies.
+
+    python -m benchmark.e2e_benchmark turns --num-turns 10 --tokens-per-second 30
+    python -m benchmark.e2e_benchmark turns --fresh-context --context-chars 40000
+    python -m benchmark.e2e_benchmark turns --tts-stream-chunk-seconds 0.5 --tts-chars-per-second 50
+    python -m benchmark.e2e_benchmark turns --response-repeats 10 --tokens-per-second 1000
+    python -m benchmark.e2e_benchmark barge-in --tokens-per-second 10
+    python -m benchmark.e2e_benchmark services --num-requests 20
+
+CPU usage is for the whole process, fake servers included.
+"""
+
+import argparse
+from contextlib import contextmanager
+import itertools
+import resource
+import threading
+import time
+from typing import Dict, Iterator, List
+
+from queue import Queue
+
+from audio.audio_manager import AudioManager, SpeechToTextTask, TextToSpeechTask
+from audio.stt_service import STTService
+from audio.tts_service import TTSServiceMeloTTS
+from benchmark.fake_servers import (
+    DEFAULT_LLM_RESPONSE,
+    FakeMeloTTSServer,
+    FakeOllamaServer,
+    FakeTranscriptionServer,
+    make_wav,
+)
+from common.metrics import METRICS, PERCENTILES
+from llm.llm_manager import LlmGenerationTask, LlmManager
+from llm.llm_service import LLMService
+
+CONTEXT_PARAGRAPH = (
+    "The service runs on three application servers behind a load balancer. Each "
+    "server handles requests independently and keeps a local cache of recent results. "
+    "Deployments roll out one server at a time, so the service stays available.\n\n"
+)
+
+
+@contextmanager
+def measure_cpu(usage: Dict[str, float]) -> Iterator[None]:
+    # Fills usage with wall seconds, cpu seconds and cpu utilization of one core.
+    start_wall = time.perf_counter()
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        yield
+    finally:
+        end = resource.getrusage(resource.RUSAGE_SELF)
+        usage["wall_seconds"] = time.perf_counter() - start_wall
+        usage["cpu_seconds"] = (end.ru_utime - start.ru_utime) + (
+            end.ru_stime - start.ru_stime
+        )
+        usage["cpu_percent"] = 100 * usage["cpu_seconds"] / max(usage["wall_seconds"], 1e-9)
+
+
+@contextmanager
+def measure_buffered_audio(context_manager, peaks: Dict[str, int]) -> Iterator[None]:
+    # Samples synthesized audio waiting to be played, fills peaks with the maxima.
+    peaks.update(results=0, bytes=0, player=0)
+    done = threading.Event()
+
+    def _sample():
+        results = context_manager.audio_manager.text_to_audio_results
+        while not done.wait(0.01):
+            peaks["results"] = max(peaks["results"], len(results))
+            peaks["bytes"] = max(peaks["bytes"], results.total_bytes)
+            peaks["player"] = max(peaks["player"], context_manager.audio_player.queue_depth())
+
+    sampler = threading.Thread(target=_sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+
+
+def print_report(prefixes: List[str], usage: Dict[str, float]) -> None:
+    histograms = METRICS.snapshot()["histograms"]
+    header = f"{'name':<48} {'count':>6}" + "".join(f" {f'p{p} ms':>9}" for p in PERCENTILES)
+    print(header)
+    for name, histogram in sorted(histograms.items()):
+        if not any(name.startswith(prefix) for prefix in prefixes):
+            continue
+        row = f"{name:<48} {histogram['count']:>6}"
+        row += "".join(f" {histogram[f'p{p}'] * 1000:>9.1f}" for p in PERCENTILES)
+        print(row)
+    print(
+        f"wall {usage['wall_seconds']:.2f}s, cpu {usage['cpu_seconds']:.2f}s "
+        f"({usage['cpu_percent']:.0f}% of one core)"
+    )
+
+
+def start_servers(args: argparse.Namespace):
+    return (
+        FakeTranscriptionServer(latency=args.stt_latency).start(),
+        FakeOllamaServer(
+            latency=args.llm_latency,
+            tokens_per_second=args.tokens_per_second,
+            response=" ".join([DEFAULT_LLM_RESPONSE] * args.response_repeats),
+        ).start(),
+        FakeMeloTTSServer(
+            latency=args.tts_latency,
+            chars_per_second=args.tts_chars_per_second,
+            max_concurrency=args.tts_concurrency,
+            stream_chunk_seconds=args.tts_stream_chunk_seconds,
+        ).start(),
+    )
+
+
+def start_context_manager(args: argparse.Namespace, servers):
+    # Imported here, the context manager needs the audio device libraries.
+    from benchmark.simulated_audio import SimulatedAudioPlayer
+    from audio.tts_service import TTSServiceType
+    from context.context_manager import ContextManager, start_services
+
+    stt_server, llm_server, tts_server = servers
+    num_segments = max(int(args.speech_seconds / args.segment_seconds), 1)
+    segment = make_wav(args.segment_seconds)
+
+    def replay_speech():
+        # Segments become available at the pace they would be spoken.
+        for _ in range(num_segments):
+            time.sleep(args.segment_seconds)
+            yield segment
+
+    context = CONTEXT_PARAGRAPH * max(args.context_chars // len(CONTEXT_PARAGRAPH), 1)
+    pastes = itertools.count()
+
+    def paste():
+        # A new document every turn, so nothing of it is cached by the llm backend yet.
+        if args.fresh_context:
+            return f"Document {next(pastes)}\n\n{context}"
+        return context
+
+    context_manager = ContextManager(
+        streaming_audio_to_text=True,
+        multi_turn=args.multi_turn,
+        record_segments=replay_speech,
+        speculative_prefill=not args.no_prefill,
+        max_queued_chunks=None if args.no_backpressure else 3,
+    )
+    if args.no_backpressure:
+        context_manager.audio_manager = AudioManager(
+            text_to_audio_tasks=Queue(), max_unplayed_text_to_audio_results=None
+        )
+    context_manager.text_manager.paste = paste
+    context_manager.audio_player.stop()
+    context_manager.audio_player = SimulatedAudioPlayer(speed=args.playback_speed)
+    services = start_services(
+        context_manager=context_manager,
+        tts_service_type=TTSServiceType.MELO_TTS,
+        num_tts_workers=args.tts_workers,
+        tts_urls=[tts_server.url],
+        stt_urls=[stt_server.url],
+        llm_urls=[llm_server.url],
+        stream_tts_audio=not args.no_tts_streaming,
+        hedge_percentile=args.hedge_percentile,
+    )
+    return context_manager, services
+
+
+def run_turns(args: argparse.Namespace) -> None:
+    from context.context_manager import stop_services
+
+    servers = start_servers(args)
+    context_manager, services = start_context_manager(args, servers)
+    usage = {}
+    peaks = {}
+    try:
+        with measure_cpu(usage), measure_buffered_audio(context_manager, peaks):
+            for _ in range(args.num_turns):
+                context_manager.start_conversation()
+    finally:
+        stop_services(services=services)
+        context_manager.clear()
+        for server in servers:
+            server.stop()
+    print_report(["turn.", "turn_stage.", "backend."], usage)
+    for name, value in sorted(METRICS.snapshot()["counters"].items()):
+        if name.startswith(("stt.", "llm.", "turn_stage.", "hedge.")):
+            print(f"{name}: {value}")
+    llm_server = servers[1]
+    print(
+        f"llm prompt chars prefilled: {llm_server.prefilled_chars}, "
+        f"cached: {llm_server.cached_chars}"
+    )
+    print(
+        f"peak unplayed tts results: {peaks['results']}, {peaks['bytes']} bytes, "
+        f"peak chunks queued in player: {peaks['player']}"
+    )
+    # Consumed results are released, only the last clipboard copies are kept.
+    for name, stats in context_manager.result_store_stats().items():
+        print(f"{name}: {stats}")
+
+
+def run_barge_in(args: argparse.Namespace) -> None:
+    # Every turn is interrupted barge_in_after seconds after speech ends, like a user
+    # pressing the hotkey while the answer plays. Reports how fast turns stop and how
+    # much backend work was cancelled.
+    from context.context_manager import stop_services
+
+    servers = start_servers(args)
+    llm_server = servers[1]
+    context_manager, services = start_context_manager(args, servers)
+    usage = {}
+    try:
+        with measure_cpu(usage):
+            for _ in range(args.num_turns):
+                conversation = threading.Thread(target=context_manager.start_conversation)
+                conversation.start()
+                time.sleep(args.speech_seconds + args.barge_in_after)
+                cancel_start = time.perf_counter()
+                context_manager.cancel_conversation()
+                conversation.join()
+                METRICS.observe("turn.cancel", time.perf_counter() - cancel_start)
+    finally:
+        stop_services(services=services)
+        context_manager.clear()
+        for server in servers:
+            server.stop()
+    print_report(["turn.cancel", "backend."], usage)
+    for name, value in sorted(METRICS.snapshot()["counters"].items()):
+        if name.startswith("cancelled."):
+            print(f"{name}: {value}")
+    print(f"llm streams aborted: {llm_server.num_disconnects}")
+
+
+def run_services(args: argparse.Namespace) -> None:
+    stt_server, llm_server, tts_server = start_servers(args)
+    audio_manager = AudioManager()
+    stt_service = STTService(audio_manager, url=stt_server.url)
+    tts_service = TTSServiceMeloTTS(audio_manager, url=tts_server.url)
+    llm_service = LLMService(LlmManager(), ollama_base_url=llm_server.url)
+    audio = make_wav(args.speech_seconds)
+    usage = {}
+    try:
+        with measure_cpu(usage):
+            for i in range(args.num_requests):
+                stt_service.convert(SpeechToTextTask(task_id=f"stt_{i}", audio_data=audio))
+                task = LlmGenerationTask(
+                    task_id=f"llm_{i}", context=CONTEXT_PARAGRAPH, question=f"question {i}"
+                )
+                # Generate first, so llm timings do not include synthesis.
+                for j, response in enumerate(list(llm_service.convert(task))):
+                    tts_service.convert(TextToSpeechTask(task_id=f"tts_{i}_{j}", text=response))
+    finally:
+        for server in (stt_server, llm_server, tts_server):
+            server.stop()
+    print_report(["backend."], usage)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", choices=["turns", "barge-in", "services"])
+    parser.add_argument("--num-turns", type=int, default=5)
+    parser.add_argument("--num-requests", type=int, default=10)
+    parser.add_argument("--speech-seconds", type=float, default=4.0)
+    parser.add_argument("--segment-seconds", type=float, default=2.0)
+    parser.add_argument("--context-chars", type=int, default=4000)
+    parser.add_argument("--multi-turn", action="store_true")
+    # Paste a different context every turn, like a user asking about a new document.
+    parser.add_argument("--fresh-context", action="store_true")
+    # Do not prefill the context while the question is transcribed.
+    parser.add_argument("--no-prefill", action="store_true")
+    # Seconds after the end of speech at which barge-in interrupts the turn.
+    parser.add_argument("--barge-in-after", type=float, default=1.0)
+    # Playback time relative to the audio duration, 0 plays instantly.
+    parser.add_argument("--playback-speed", type=float, default=1.0)
+    parser.add_argument("--tts-workers", type=int, default=2)
+    parser.add_argument("--stt-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    # Times the fake llm answer is repeated, for long answers.
+    parser.add_argument("--response-repeats", type=int, default=1)
+    parser.add_argument("--tts-latency", type=float, default=0.05)
+    parser.add_argument("--tts-chars-per-second", type=float, default=500.0)
+    parser.add_argument("--tts-concurrency", type=int, default=2)
+    # Seconds of audio per piece the fake tts streams, unset sends the wav at once.
+    parser.add_argument("--tts-stream-chunk-seconds", type=float, default=None)
+    # Download the whole tts response before playing it.
+    parser.add_argument("--no-tts-streaming", action="store_true")
+    # Hedge stt and tts requests slower than this percentile of recent ones.
+    parser.add_argument("--hedge-percentile", type=float, default=None)
+    # Synthesize and queue audio for playback as fast as the backends allow.
+    parser.add_argument("--no-backpressure", action="store_true")
+    args = parser.parse_args()
+
+    if args.scenario == "turns":
+        run_turns(args)
+    elif args.scenario == "barge-in":
+        run_barge_in(args)
+    else:
+        run_services(args)
+
+
+if __name__ == "__main__":
+    main()
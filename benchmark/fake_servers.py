@@ -0,0 +1,287 @@
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Iterable
+import wave
+
+from audio.wav import parse_wav
+
+# Words with their trailing whitespace, streamed as one token each.
+TOKEN_PATTERN = re.compile(r"\S+\s*")
+
+DEFAULT_LLM_RESPONSE = (
+    "This page describes how the service is deployed. Requests first reach the load "
+    "balancer, which forwards them to one of the application servers. Each server keeps "
+    "a small cache of recent results, so repeated questions are answered quickly. "
+    "Configuration is read at startup, and changes require a restart. Logs are shipped "
+    "to a central store, where they are kept for thirty days."
+)
+
+
+def make_wav(duration: float, sample_rate: int = 44100) -> bytes:
+    # Silent 16 bit mono wav.
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(b"\x00\x00" * int(duration * sample_rate))
+    return buffer.getvalue()
+
+
+@dataclass
+class FakeServer:
+    """
+    Base class for local stand-in backends. Subclasses implement handle_post.
+    max_concurrency simulates a backend (e.g. one GPU) that only serves that many requests at once.
+    A stall_probability share of requests is delayed by stall_seconds, like a backend
+    hitting a slow path, to produce tail latency.
+    """
+
+    host: str = "127.0.0.1"
+    port: int = 0
+    max_concurrency: int = 1
+    stall_probability: float = 0.0
+    stall_seconds: float = 1.0
+
+    def __post_init__(self):
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.num_requests = 0
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server.num_requests += 1
+                with server._slots:
+                    if random.random() < server.stall_probability:
+                        time.sleep(server.stall_seconds)
+                    server.handle_post(self, body)
+
+            def do_GET(self):
+                server.handle_get(self)
+
+            def handle(self):
+                # Clients drop keep-alive connections of aborted streams, e.g. on barge-in.
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> "FakeServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def handle_post(self, handler: BaseHTTPRequestHandler, body: bytes) -> None:
+        raise NotImplementedError("handle_post not implemented")
+
+    def handle_get(self, handler: BaseHTTPRequestHandler) -> None:
+        send_response(handler, 200, b"ok", "text/plain")
+
+
+def send_response(
+    handler: BaseHTTPRequestHandler, status: int, content: bytes, content_type: str
+) -> None:
+    handler.send_response(status)
+    handler.send_header("Content-Type", content_type)
+    handler.send_header("Content-Length", str(len(content)))
+    handler.end_headers()
+    handler.wfile.write(content)
+
+
+def send_stream_response(
+    handler: BaseHTTPRequestHandler, status: int, chunks: Iterable[bytes], content_type: str
+) -> bool:
+    # Chunked transfer encoding, every chunk is flushed as soon as it is produced.
+    # Returns False if the client disconnected before the end of the stream.
+    handler.send_response(status)
+    handler.send_header("Content-Type", content_type)
+    handler.send_header("Transfer-Encoding", "chunked")
+    handler.end_headers()
+    try:
+        for chunk in chunks:
+            handler.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+            handler.wfile.flush()
+        handler.wfile.write(b"0\r\n\r\n")
+    except (BrokenPipeError, ConnectionResetError):
+        handler.close_connection = True
+        return False
+    return True
+
+
+@dataclass
+class FakeMeloTTSServer(FakeServer):
+    """
+    Stand-in for the MeloTTS /convert/tts endpoint. Each request takes
+    latency + len(text) / chars_per_second seconds and returns a silent wav
+    of audio_seconds_per_char * len(text) seconds.
+    With stream_chunk_seconds set, the wav is streamed in pieces of that much audio
+    instead, each sent as soon as it is synthesized, like a streaming tts backend.
+    """
+
+    latency: float = 0.05
+    chars_per_second: float = 500.0
+    audio_seconds_per_char: float = 0.06
+    sample_rate: int = 44100
+    stream_chunk_seconds: float | None = None
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.num_disconnects = 0
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/convert/tts"
+
+    def handle_post(self, handler: BaseHTTPRequestHandler, body: bytes) -> None:
+        text = json.loads(body or b"{}").get("text", "")
+        content = make_wav(
+            duration=self.audio_seconds_per_char * len(text),
+            sample_rate=self.sample_rate,
+        )
+        if self.stream_chunk_seconds is None:
+            time.sleep(self.latency + len(text) / self.chars_per_second)
+            send_response(handler, 200, content, "audio/wav")
+            return
+        time.sleep(self.latency)
+        if not send_stream_response(
+            handler, 200, self._synthesize_chunks(content, text), "audio/wav"
+        ):
+            self.num_disconnects += 1
+
+    def _synthesize_chunks(self, content: bytes, text: str) -> Iterable[bytes]:
+        pcm_format, pcm = parse_wav(content)
+        header = content[: len(content) - len(pcm)]
+        step = max(int(self.stream_chunk_seconds * pcm_format.sample_rate), 1)
+        step *= pcm_format.frame_size
+        num_chunks = max(-(-len(pcm) // step), 1)
+        synthesis_seconds = len(text) / self.chars_per_second / num_chunks
+        for start in range(0, max(len(pcm), 1), step):
+            time.sleep(synthesis_seconds)
+            yield (header if start == 0 else b"") + bytes(pcm[start : start + step])
+
+
+@dataclass
+class FakeTranscriptionServer(FakeServer):
+    """
+    Stand-in for an OpenAI compatible /v1/audio/transcriptions endpoint.
+    Each request takes latency + audio_seconds * processing_ratio seconds, where
+    audio_seconds is read from the uploaded wav, or estimated from the upload size
+    for other formats.
+    """
+
+    latency: float = 0.05
+    processing_ratio: float = 0.1
+    audio_bytes_per_second: int = 88200
+    text: str = "what is this page about"
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/v1"
+
+    def handle_post(self, handler: BaseHTTPRequestHandler, body: bytes) -> None:
+        parsed = parse_wav(body[max(body.find(b"RIFF"), 0) :])
+        if parsed is not None:
+            audio_seconds = len(parsed[1]) / parsed[0].bytes_per_second
+        else:
+            audio_seconds = len(body) / self.audio_bytes_per_second
+        time.sleep(self.latency + audio_seconds * self.processing_ratio)
+        content = json.dumps({"text": self.text}).encode("utf-8")
+        send_response(handler, 200, content, "application/json")
+
+
+@dataclass
+class FakeOllamaServer(FakeServer):
+    """
+    Stand-in for the ollama /api/chat endpoint, streaming ndjson like ollama does.
+    The first token arrives after latency + prompt characters / prefill_chars_per_second,
+    then response is streamed word by word at tokens_per_second, up to
+    options.num_predict tokens.
+    Like ollama, the last prompt is cached and only the characters after its common
+    prefix with the next prompt are prefilled.
+    """
+
+    latency: float = 0.1
+    prefill_chars_per_second: float = 20000.0
+    tokens_per_second: float = 50.0
+    response: str = DEFAULT_LLM_RESPONSE
+    model: str = "llama3"
+
+    def __post_init__(self):
+        super().__post_init__()
+        # Streams aborted by the client, e.g. on barge-in.
+        self.num_disconnects = 0
+        self._cache_lock = threading.Lock()
+        self.cached_prompt = ""
+        self.prefilled_chars = 0
+        self.cached_chars = 0
+
+    @property
+    def url(self) -> str:
+        return self.base_url
+
+    def handle_post(self, handler: BaseHTTPRequestHandler, body: bytes) -> None:
+        if handler.path != "/api/chat":
+            send_response(handler, 404, b"not found", "text/plain")
+            return
+        request = json.loads(body or b"{}")
+        prompt = "".join(
+            f"{message.get('role', '')}:{message.get('content', '')}\n"
+            for message in request.get("messages", [])
+        )
+        with self._cache_lock:
+            num_cached = len(os.path.commonprefix([prompt, self.cached_prompt]))
+            self.cached_prompt = prompt
+            self.cached_chars += num_cached
+            self.prefilled_chars += len(prompt) - num_cached
+        time.sleep(
+            self.latency + (len(prompt) - num_cached) / self.prefill_chars_per_second
+        )
+        num_predict = request.get("options", {}).get("num_predict")
+        if not send_stream_response(
+            handler, 200, self._stream(num_predict), "application/x-ndjson"
+        ):
+            self.num_disconnects += 1
+
+    def _stream(self, num_predict: int | None = None) -> Iterable[bytes]:
+        tokens = TOKEN_PATTERN.findall(self.response)
+        if num_predict is not None and num_predict >= 0:
+            tokens = tokens[:num_predict]
+        for index, token in enumerate(tokens):
+            if index > 0:
+                time.sleep(1 / self.tokens_per_second)
+            yield self._line(token, done=False)
+        yield self._line("", done=True)
+
+    def _line(self, content: str, done: bool) -> bytes:
+        message = {
+            "model": self.model,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+        }
+        return json.dumps(message).encode("utf-8") + b"\n"
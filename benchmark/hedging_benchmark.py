@@ -0,0 +1,138 @@
+"""
+Compare tts and stt latency percentiles with and without hedged requests, using two
+local fake backends of each service that stall on a share of requests.
+
+    python -m benchmark.hedging_benchmark --num-requests 500
+    python -m benchmark.hedging_benchmark --service stt --hedge-percentile 90
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import math
+import time
+from typing import Callable, List
+
+from audio.audio_manager import AudioManager, SpeechToTextTask, TextToSpeechTask
+from audio.stt_service import STTService
+from audio.tts_service import TTSServiceMeloTTS
+from benchmark.fake_servers import (
+    FakeMeloTTSServer,
+    FakeServer,
+    FakeTranscriptionServer,
+    make_wav,
+)
+from common.backend_pool import BackendPool
+from common.hedging import HedgePolicy
+
+TTS_TEXT = "Requests first reach the load balancer, which forwards them to a server."
+
+
+def percentile(latencies: List[float], percent: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[max(math.ceil(percent / 100 * len(latencies)) - 1, 0)]
+
+
+def create_servers(args: argparse.Namespace) -> List[FakeServer]:
+    server_class = FakeMeloTTSServer if args.service == "tts" else FakeTranscriptionServer
+    return [
+        server_class(
+            max_concurrency=args.concurrency,
+            stall_probability=args.stall_probability,
+            stall_seconds=args.stall_seconds,
+        ).start()
+        for _ in range(args.backends)
+    ]
+
+
+def create_request(
+    args: argparse.Namespace, servers: List[FakeServer], hedge: HedgePolicy | None
+) -> Callable[[int], bool]:
+    # Health checks are off, stalls should be hedged around rather than ejected.
+    pool = BackendPool(
+        urls=[server.url for server in servers], health_check_interval=None
+    )
+    if args.service == "tts":
+        tts_service = TTSServiceMeloTTS(
+            AudioManager(), url=servers[0].url, backend_pool=pool, hedge=hedge
+        )
+
+        def synthesize(i: int) -> bool:
+            raw_response = tts_service.convert(TextToSpeechTask(str(i), TTS_TEXT))
+            return raw_response is not None and raw_response.status_code == 200
+
+        return synthesize
+    stt_service = STTService(
+        AudioManager(), url=servers[0].url, backend_pool=pool, hedge=hedge
+    )
+    audio_data = make_wav(duration=2.0, sample_rate=16000)
+
+    def transcribe(i: int) -> bool:
+        return stt_service.convert(SpeechToTextTask(str(i), audio_data)) is not None
+
+    return transcribe
+
+
+def run(args: argparse.Namespace, hedge: HedgePolicy | None) -> None:
+    servers = create_servers(args)
+    request = create_request(args, servers, hedge)
+    latencies = []
+    failures = 0
+
+    def timed_request(i: int) -> None:
+        nonlocal failures
+        start = time.perf_counter()
+        if not request(i):
+            failures += 1
+        latencies.append(time.perf_counter() - start)
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(timed_request, range(args.num_requests)))
+    finally:
+        for server in servers:
+            server.stop()
+    # The first requests only fill the latency window the hedge delay is based on.
+    latencies = latencies[args.warmup :]
+    row = [percentile(latencies, percent) * 1000 for percent in (50, 95, 99)]
+    stats = hedge.stats() if hedge is not None else None
+    print(
+        f"{'on' if hedge else 'off':>6} "
+        + " ".join(f"{ms:>8.0f}" for ms in row)
+        + f" {max(latencies) * 1000:>8.0f} {failures:>7}"
+        + (
+            f" {stats['hedge_rate']:>6.1%} {stats['win_rate']:>6.1%}"
+            if stats is not None
+            else f" {'-':>6} {'-':>6}"
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--service", choices=["tts", "stt"], default="tts")
+    parser.add_argument("--num-requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--backends", type=int, default=2)
+    # Below 1 - hedge percentile, otherwise the hedge delay is the stall itself.
+    parser.add_argument("--stall-probability", type=float, default=0.03)
+    parser.add_argument("--stall-seconds", type=float, default=1.0)
+    parser.add_argument("--hedge-percentile", type=float, default=95.0)
+    parser.add_argument("--max-hedge-rate", type=float, default=0.1)
+    parser.add_argument("--warmup", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'hedge':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'failed':>7} {'hedged':>6} {'won':>6}")
+    run(args, hedge=None)
+    run(
+        args,
+        hedge=HedgePolicy(
+            name=args.service,
+            percentile=args.hedge_percentile,
+            min_samples=args.warmup,
+            max_hedge_rate=args.max_hedge_rate,
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Offer a local fake tts backend more requests per second than it can serve, like many
+conversations sharing one GPU box, with and without admission limits. Without them
+every request is queued, so latency grows for as long as the overload lasts. With them,
+requests beyond the backend's concurrency wait at most --max-wait and are then
+rejected, so admitted requests keep a bounded latency.
+
+    python -m benchmark.overload_benchmark --arrival-rate 40 --seconds 5
+    python -m benchmark.overload_benchmark --rate 15 --burst 4
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+import time
+from typing import List
+
+from audio.audio_manager import AudioManager, TextToSpeechTask
+from audio.tts_service import TTSServiceMeloTTS
+from benchmark.fake_servers import FakeMeloTTSServer
+from common.admission import AdmissionLimits
+from common.metrics import METRICS
+
+TTS_TEXT = "Requests first reach the load balancer, which forwards them to a server."
+
+
+def percentile(latencies: List[float], percent: float) -> float:
+    if not latencies:
+        return math.nan
+    latencies = sorted(latencies)
+    return latencies[max(math.ceil(percent / 100 * len(latencies)) - 1, 0)]
+
+
+def run(args: argparse.Namespace, admission: AdmissionLimits | None) -> None:
+    server = FakeMeloTTSServer(
+        max_concurrency=args.backend_concurrency, latency=args.latency
+    ).start()
+    tts_service = TTSServiceMeloTTS(AudioManager(), url=server.url, admission=admission)
+    latencies = []
+    failures = 0
+    in_flight = peak_in_flight = 0
+    lock = threading.Lock()
+
+    def request(i: int) -> None:
+        nonlocal failures, in_flight, peak_in_flight
+        with lock:
+            in_flight += 1
+            peak_in_flight = max(peak_in_flight, in_flight)
+        start = time.perf_counter()
+        raw_response = tts_service.convert(TextToSpeechTask(str(i), TTS_TEXT))
+        with lock:
+            in_flight -= 1
+            if raw_response is not None and raw_response.status_code == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                failures += 1
+
+    num_requests = int(args.arrival_rate * args.seconds)
+    rejected_key = f"admission.rejected|{server.url}"
+    rejected_before = METRICS.snapshot()["counters"].get(rejected_key, 0)
+    start = time.perf_counter()
+    try:
+        # Open loop: requests arrive on schedule, whether or not earlier ones finished.
+        with ThreadPoolExecutor(max_workers=num_requests) as executor:
+            for i in range(num_requests):
+                time.sleep(max(start + i / args.arrival_rate - time.perf_counter(), 0))
+                executor.submit(request, i)
+    finally:
+        server.stop()
+    elapsed = time.perf_counter() - start
+    rejected = METRICS.snapshot()["counters"].get(rejected_key, 0) - rejected_before
+    print(
+        f"{'on' if admission else 'off':>9} {len(latencies) / elapsed:>7.1f} "
+        + " ".join(f"{percentile(latencies, p) * 1000:>8.0f}" for p in (50, 95, 99))
+        + f" {failures:>7} {int(rejected):>8} {peak_in_flight:>9}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arrival-rate", type=float, default=40.0)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--backend-concurrency", type=int, default=2)
+    # Admission limits, max concurrency defaults to what the backend serves at once.
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    parser.add_argument("--rate", type=float, default=None)
+    parser.add_argument("--burst", type=int, default=1)
+    parser.add_argument("--max-wait", type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(
+        f"{'admission':>9} {'ok/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'failed':>7} {'rejected':>8} {'in flight':>9}"
+    )
+    run(args, admission=None)
+    run(
+        args,
+        admission=AdmissionLimits(
+            max_concurrency=args.max_concurrency or args.backend_concurrency,
+            rate=args.rate,
+            burst=args.burst,
+            max_wait=args.max_wait,
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Load test the conversation server with local fake stt, llm and tts backends. Opens
+--sessions concurrent websocket sessions, each with its own context, asking --turns
+spoken questions, and reports time from end of speech to first audio and to the end of
+the answer, as percentiles over all turns.
+
+    python -m benchmark.server_load_benchmark --sessions 200
+    python -m benchmark.server_load_benchmark --sessions 500 --num-llm-workers 128
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import math
+import multiprocessing
+from multiprocessing.connection import Connection
+import time
+from typing import List, Tuple
+
+import aiohttp
+from aiohttp import WSMsgType, web
+
+from benchmark.fake_servers import (
+    DEFAULT_LLM_RESPONSE,
+    FakeMeloTTSServer,
+    FakeOllamaServer,
+    FakeTranscriptionServer,
+    make_wav,
+)
+from common.metrics import METRICS
+from server.app import ConversationServer, create_server_pipeline
+from server.session import SessionStore
+
+
+def percentile(latencies: List[float], percent: float) -> float:
+    if not latencies:
+        return math.nan
+    latencies = sorted(latencies)
+    return latencies[max(math.ceil(percent / 100 * len(latencies)) - 1, 0)]
+
+
+async def ask(
+    ws: aiohttp.ClientWebSocketResponse, args: argparse.Namespace, segment: bytes
+) -> Tuple[float, float] | None:
+    # Speak in real time, then wait for the answer. Returns seconds from end of speech
+    # to first audio and to the end of the answer, None if the turn failed.
+    for _ in range(args.segments):
+        await ws.send_bytes(segment)
+        await asyncio.sleep(args.segment_seconds)
+    start = time.perf_counter()
+    await ws.send_json({"type": "end_of_speech"})
+    first_audio = None
+    async for message in ws:
+        if message.type == WSMsgType.BINARY:
+            first_audio = first_audio or time.perf_counter() - start
+        elif message.type == WSMsgType.TEXT:
+            message_type = message.json()["type"]
+            if message_type == "done" and first_audio is not None:
+                return first_audio, time.perf_counter() - start
+            if message_type in ("done", "error"):
+                return None
+        else:
+            return None
+    return None
+
+
+async def run_session(
+    index: int,
+    http: aiohttp.ClientSession,
+    base_url: str,
+    args: argparse.Namespace,
+    segment: bytes,
+    results: List[Tuple[float, float] | None],
+) -> None:
+    await asyncio.sleep(args.ramp_up * index / args.sessions)
+    context = f"Document {index}. " + DEFAULT_LLM_RESPONSE * args.context_repeats
+    num_turns = 0
+    try:
+        async with http.post(f"{base_url}/sessions", json={"context": context}) as resp:
+            if resp.status != 201:
+                results.extend([None] * args.turns)
+                return
+            session_id = (await resp.json())["session_id"]
+        async with http.ws_connect(f"{base_url}/sessions/{session_id}/ws") as ws:
+            for turn in range(args.turns):
+                if turn > 0:
+                    await asyncio.sleep(args.think_seconds)
+                try:
+                    result = await asyncio.wait_for(
+                        ask(ws, args, segment), timeout=args.turn_timeout
+                    )
+                except asyncio.TimeoutError:
+                    result = None
+                results.append(result)
+                num_turns += 1
+    except aiohttp.ClientError as e:
+        print(f"Error running session {index}: {e}")
+        results.extend([None] * (args.turns - num_turns))
+
+
+def serve_backends(args: argparse.Namespace, connection: Connection) -> None:
+    # Runs in its own process, so the backends do not compete with the server for the GIL.
+    servers = [
+        FakeTranscriptionServer(max_concurrency=args.backend_concurrency).start(),
+        FakeOllamaServer(
+            max_concurrency=args.backend_concurrency,
+            tokens_per_second=args.tokens_per_second,
+        ).start(),
+        FakeMeloTTSServer(
+            max_concurrency=args.backend_concurrency, sample_rate=16000
+        ).start(),
+    ]
+    connection.send([server.url for server in servers])
+    # Serve until the benchmark is done.
+    connection.recv()
+    for server in servers:
+        server.stop()
+
+
+def serve_conversations(
+    args: argparse.Namespace, urls: List[str], connection: Connection
+) -> None:
+    # The server gets a process of its own as well, clients do not slow it down.
+    async def _serve() -> None:
+        stt_url, llm_url, tts_url = urls
+        server = ConversationServer(
+            pipeline=create_server_pipeline(
+                stt_urls=[stt_url],
+                tts_urls=[tts_url],
+                llm_urls=[llm_url],
+                num_stt_workers=args.num_stt_workers,
+                num_llm_workers=args.num_llm_workers,
+                num_tts_workers=args.num_tts_workers,
+            ),
+            sessions=SessionStore(max_sessions=args.sessions),
+        )
+        runner = web.AppRunner(server.create_app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        connection.send(runner.addresses[0][1])
+        await asyncio.to_thread(connection.recv)
+        counters = METRICS.snapshot()["counters"]
+        await runner.cleanup()
+        connection.send(counters)
+
+    # The services log every request, keep the report readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(_serve())
+
+
+async def run(args: argparse.Namespace) -> None:
+    backend_connection, backend_child = multiprocessing.Pipe()
+    backends = multiprocessing.Process(
+        target=serve_backends, args=(args, backend_child), daemon=True
+    )
+    backends.start()
+    urls = backend_connection.recv()
+    server_connection, server_child = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=serve_conversations, args=(args, urls, server_child), daemon=True
+    )
+    server.start()
+    base_url = f"http://127.0.0.1:{server_connection.recv()}"
+    segment = make_wav(duration=args.segment_seconds, sample_rate=16000)
+    results: List[Tuple[float, float] | None] = []
+
+    start = time.perf_counter()
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as http:
+            await asyncio.gather(
+                *(
+                    run_session(i, http, base_url, args, segment, results)
+                    for i in range(args.sessions)
+                )
+            )
+    finally:
+        server_connection.send(None)
+        counters = server_connection.recv()
+        server.join()
+        backend_connection.send(None)
+        backends.join()
+    elapsed = time.perf_counter() - start
+
+    succeeded = [result for result in results if result is not None]
+    print(
+        f"sessions={args.sessions} turns={len(results)} failed={len(results) - len(succeeded)} "
+        f"turns/s={len(succeeded) / elapsed:.1f} elapsed={elapsed:.1f}s "
+        f"backpressure={int(counters.get('backpressure.pipeline', 0))}"
+    )
+    print(f"{'':>12} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, latencies in [
+        ("first audio", [first_audio for first_audio, _ in succeeded]),
+        ("turn", [turn for _, turn in succeeded]),
+    ]:
+        print(
+            f"{name:>12} "
+            + " ".join(f"{percentile(latencies, p) * 1000:>8.0f}" for p in (50, 95, 99))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=2)
+    # Sessions start evenly spread over this many seconds.
+    parser.add_argument("--ramp-up", type=float, default=2.0)
+    parser.add_argument("--think-seconds", type=float, default=1.0)
+    parser.add_argument("--segments", type=int, default=2)
+    parser.add_argument("--segment-seconds", type=float, default=1.0)
+    parser.add_argument("--context-repeats", type=int, default=5)
+    parser.add_argument("--turn-timeout", type=float, default=60.0)
+    parser.add_argument("--backend-concurrency", type=int, default=64)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--num-stt-workers", type=int, default=32)
+    parser.add_argument("--num-llm-workers", type=int, default=64)
+    parser.add_argument("--num-tts-workers", type=int, default=64)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+from dataclasses import dataclass
+from queue import Queue
+import threading
+from typing import Callable, Dict, Tuple
+
+from audio.audio_stream import AudioStream
+from audio.wav import PcmFormat, WavStreamParser, parse_wav
+from common.metrics import METRICS
+
+# Marks the end of the playback queue.
+_STOP = None
+
+
+@dataclass
+class SimulatedAudioPlayer:
+    """
+    Drop in replacement for AudioPlayer without an audio device. Chunks "play" for
+    their wav duration times speed, back to back, so playback timing matches a real
+    device. speed=0 skips the waiting. Streamed wav chunks start playing with their
+    first frames.
+    """
+
+    speed: float = 1.0
+
+    def __post_init__(self):
+        self._queue: Queue[
+            Tuple[bytes | AudioStream, Callable | None, int] | None
+        ] = Queue()
+        # Incremented by clear, chunks of older generations are dropped.
+        self._generation = 0
+        # Stream being played, cancelled by clear.
+        self._playing_stream: AudioStream | None = None
+        self._pending = 0
+        self._pending_condition = threading.Condition()
+        self.underruns = 0
+        self.chunks_played = 0
+        self.chunks_dropped = 0
+        self.bytes_played = 0
+        self._thread = threading.Thread(target=self._play_loop, daemon=True)
+        self._thread.start()
+
+    def enqueue(
+        self, content: bytes, on_start: Callable[[], None] | None = None
+    ) -> None:
+        with self._pending_condition:
+            self._pending += 1
+            generation = self._generation
+        self._queue.put((content, on_start, generation))
+
+    def enqueue_stream(
+        self, audio_stream: AudioStream, on_start: Callable[[], None] | None = None
+    ) -> None:
+        with self._pending_condition:
+            self._pending += 1
+            generation = self._generation
+        self._queue.put((audio_stream, on_start, generation))
+
+    def queue_depth(self) -> int:
+        with self._pending_condition:
+            return self._pending
+
+    def wait_until_done(self, timeout: float | None = None) -> bool:
+        with self._pending_condition:
+            return self._pending_condition.wait_for(
+                lambda: self._pending == 0, timeout=timeout
+            )
+
+    def wait_until_queue_below(
+        self, depth: int, timeout: float | None = None
+    ) -> bool:
+        with self._pending_condition:
+            return self._pending_condition.wait_for(
+                lambda: self._pending < depth, timeout=timeout
+            )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_depth": self.queue_depth(),
+            "underruns": self.underruns,
+            "chunks_played": self.chunks_played,
+            "chunks_dropped": self.chunks_dropped,
+            "bytes_played": self.bytes_played,
+        }
+
+    def clear(self) -> None:
+        with self._pending_condition:
+            self._generation += 1
+            audio_stream, self._playing_stream = self._playing_stream, None
+            self._pending_condition.notify_all()
+        if audio_stream is not None:
+            audio_stream.cancel()
+
+    def stop(self) -> None:
+        self.clear()
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _play_loop(self) -> None:
+        while True:
+            if self._queue.empty() and self.queue_depth() > 0:
+                self.underruns += 1
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            content, on_start, generation = item
+            try:
+                if generation != self._generation:
+                    self._drop_chunk(content)
+                    continue
+                if isinstance(content, AudioStream):
+                    played = self._play_stream(content, on_start, generation)
+                else:
+                    if on_start is not None:
+                        on_start()
+                    parsed = parse_wav(content)
+                    played = parsed is None or self._play_pcm(*parsed, generation)
+                if played:
+                    self.chunks_played += 1
+                else:
+                    self._drop_chunk(content)
+            finally:
+                with self._pending_condition:
+                    self._pending -= 1
+                    self._pending_condition.notify_all()
+
+    def _play_stream(
+        self, audio_stream: AudioStream, on_start: Callable | None, generation: int
+    ) -> bool:
+        with self._pending_condition:
+            if generation != self._generation:
+                audio_stream.cancel()
+            self._playing_stream = audio_stream
+        parser = WavStreamParser()
+        try:
+            for data in audio_stream:
+                pcm = parser.feed(data)
+                if not pcm:
+                    continue
+                if on_start is not None:
+                    on_start()
+                    on_start = None
+                if not self._play_pcm(parser.pcm_format, pcm, generation):
+                    return False
+            return not audio_stream.cancelled
+        except ValueError:
+            # Not wav, nothing to time the playback by.
+            audio_stream.read()
+            return True
+        finally:
+            with self._pending_condition:
+                if self._playing_stream is audio_stream:
+                    self._playing_stream = None
+
+    def _play_pcm(self, pcm_format: PcmFormat, pcm: bytes, generation: int) -> bool:
+        # Wakes up early on clear, like an interrupted write. Returns False if cleared.
+        with self._pending_condition:
+            interrupted = self._pending_condition.wait_for(
+                lambda: generation != self._generation,
+                timeout=len(pcm) / pcm_format.bytes_per_second * self.speed,
+            )
+        if not interrupted:
+            self.bytes_played += len(pcm)
+        return not interrupted
+
+    def _drop_chunk(self, content: bytes | AudioStream) -> None:
+        if isinstance(content, AudioStream):
+            content.cancel()
+        self.chunks_dropped += 1
+        METRICS.increment("cancelled.playback_chunks")
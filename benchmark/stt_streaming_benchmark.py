@@ -0,0 +1,68 @@
+"""
+Compare end-of-speech to transcript latency of batch and streaming speech to text,
+using a local fake transcription server. Microphone input is simulated by releasing
+segments at real-time pace.
+
+    python -m benchmark.stt_streaming_benchmark --speech-seconds 8 --segment-seconds 2
+"""
+
+import argparse
+import time
+from typing import List
+
+from audio.audio_manager import AudioManager, SpeechToTextTask
+from audio.stt_service import start_stt, stop_stt
+from benchmark.fake_servers import FakeTranscriptionServer, make_wav
+
+
+def run_turn(
+    audio_manager: AudioManager, turn: str, segments: List[bytes], segment_seconds: float
+) -> float:
+    # Returns seconds between end of speech and a complete transcript.
+    tasks = []
+    for index, segment in enumerate(segments):
+        time.sleep(segment_seconds)
+        task = SpeechToTextTask(task_id=f"{turn}_{index}", audio_data=segment)
+        audio_manager.add_audio_to_text_task(task)
+        tasks.append(task)
+    end_of_speech = time.perf_counter()
+    for task in tasks:
+        audio_manager.wait_for_audio_to_text_result(task_id=task.task_id)
+    return time.perf_counter() - end_of_speech
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--speech-seconds", type=float, default=8.0)
+    parser.add_argument("--segment-seconds", type=float, default=2.0)
+    parser.add_argument("--processing-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    server = FakeTranscriptionServer(processing_ratio=args.processing_ratio).start()
+    audio_manager = AudioManager()
+    stt_service, thread = start_stt(audio_manager=audio_manager, url=server.url)
+    try:
+        num_segments = max(int(args.speech_seconds / args.segment_seconds), 1)
+        # Batch: one upload after the whole utterance is recorded.
+        batch = run_turn(
+            audio_manager,
+            "batch",
+            [make_wav(args.speech_seconds)],
+            segment_seconds=args.speech_seconds,
+        )
+        # Streaming: segments are uploaded while the rest is still being recorded.
+        streaming = run_turn(
+            audio_manager,
+            "streaming",
+            [make_wav(args.segment_seconds)] * num_segments,
+            segment_seconds=args.segment_seconds,
+        )
+        print(f"batch:     {batch * 1000:8.1f} ms after end of speech")
+        print(f"streaming: {streaming * 1000:8.1f} ms after end of speech")
+    finally:
+        stop_stt(stt_service=stt_service, thread=thread)
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Measure tts throughput against worker count, using local fake MeloTTS servers.
+
+    python -m benchmark.tts_pool_benchmark --num-tasks 40 --workers 1 2 4 8 --backend-concurrency 4
+"""
+
+import argparse
+import time
+from typing import List
+
+from audio.audio_manager import AudioManager, TextToSpeechTask
+from audio.tts_service import TTSServiceType, start_tts_pool, stop_tts
+from benchmark.fake_servers import FakeMeloTTSServer
+
+SENTENCE = "Recording audio from a microphone using Python is tricky."
+
+
+def run_tts_pool(num_tasks: int, num_workers: int, urls: List[str]) -> float:
+    audio_manager = AudioManager()
+    services = start_tts_pool(
+        audio_manager=audio_manager,
+        tts_service_type=TTSServiceType.MELO_TTS,
+        num_workers=num_workers,
+        urls=urls,
+    )
+    tasks = [TextToSpeechTask(task_id=str(i), text=SENTENCE) for i in range(num_tasks)]
+    start = time.perf_counter()
+    for task in tasks:
+        audio_manager.add_text_to_audio_task(task)
+    # Consume in the original order, the same way playback does.
+    for task in tasks:
+        audio_manager.wait_for_text_to_audio_result(task_id=task.task_id)
+    elapsed = time.perf_counter() - start
+    for tts_service, thread in services:
+        stop_tts(tts_service=tts_service, thread=thread)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-tasks", type=int, default=40)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--num-backends", type=int, default=1)
+    parser.add_argument("--backend-concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.1)
+    args = parser.parse_args()
+
+    servers = [
+        FakeMeloTTSServer(
+            max_concurrency=args.backend_concurrency, latency=args.latency
+        ).start()
+        for _ in range(args.num_backends)
+    ]
+    urls = [server.url for server in servers]
+    try:
+        print(f"{'workers':>8} {'seconds':>8} {'tasks/s':>8}")
+        for num_workers in args.workers:
+            elapsed = run_tts_pool(args.num_tasks, num_workers, urls)
+            print(f"{num_workers:>8} {elapsed:>8.2f} {args.num_tasks / elapsed:>8.1f}")
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, Iterator, Tuple
+
+from common.metrics import METRICS, now
+
+# Seconds between admission attempts of coroutines, which cannot block on a lock.
+_ASYNC_POLL_INTERVAL = 0.01
+
+
+class Overloaded(Exception):
+    # A request was not admitted to a backend within AdmissionLimits.max_wait.
+    pass
+
+
+@dataclass(frozen=True)
+class AdmissionLimits:
+    # Max requests in flight per backend. None does not limit concurrency.
+    max_concurrency: int | None = None
+    # Requests started per second per backend, bursts of up to burst requests are
+    # allowed. None does not limit the rate.
+    rate: float | None = None
+    burst: int = 1
+    # Seconds a request waits for admission before it is rejected with Overloaded.
+    max_wait: float = 5.0
+
+
+@dataclass
+class TokenBucket:
+    """
+    Token bucket rate limiter: holds up to burst tokens, refilled at rate tokens per
+    second. Each request takes a token, or waits for one.
+    """
+
+    rate: float
+    burst: int = 1
+    clock: Callable[[], float] = field(default=time.monotonic, repr=False)
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = self.clock()
+
+    def try_acquire(self) -> float:
+        # Take a token. Returns 0 if one was taken, otherwise seconds until one is available.
+        with self._lock:
+            current = self.clock()
+            self._tokens = min(
+                self._tokens + (current - self._updated) * self.rate, self.burst
+            )
+            self._updated = current
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout: float | None = None) -> bool:
+        # Block until a token is taken. Returns False on timeout.
+        deadline = None if timeout is None else self.clock() + timeout
+        while (wait := self.try_acquire()) > 0:
+            if deadline is not None:
+                if self.clock() + wait > deadline:
+                    return False
+            time.sleep(wait)
+        return True
+
+
+@dataclass
+class BackendAdmission:
+    """
+    Admission control of one backend, shared by every service and conversation of the
+    process calling it. Requests beyond the backend's concurrency or rate limit wait,
+    and are rejected once they have waited max_wait, so an overloaded backend sheds
+    load instead of queueing requests without bound.
+    Waits are recorded as admission.wait, rejections as admission.rejected.
+    """
+
+    url: str
+    limits: AdmissionLimits
+
+    def __post_init__(self):
+        self._slots = (
+            threading.BoundedSemaphore(self.limits.max_concurrency)
+            if self.limits.max_concurrency is not None
+            else None
+        )
+        self._bucket = (
+            TokenBucket(rate=self.limits.rate, burst=self.limits.burst)
+            if self.limits.rate is not None
+            else None
+        )
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        start = now()
+        if self._slots is not None and not self._slots.acquire(
+            timeout=self.limits.max_wait
+        ):
+            self._reject(start)
+        try:
+            remaining = max(self.limits.max_wait - (now() - start), 0.0)
+            if self._bucket is not None and not self._bucket.acquire(timeout=remaining):
+                self._reject(start)
+            METRICS.observe("admission.wait", now() - start, backend=self.url)
+            yield
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    @asynccontextmanager
+    async def aadmit(self) -> AsyncIterator[None]:
+        # Same as admit, without blocking the event loop.
+        start = now()
+        if self._slots is not None:
+            while not self._slots.acquire(blocking=False):
+                if now() - start > self.limits.max_wait:
+                    self._reject(start)
+                await asyncio.sleep(_ASYNC_POLL_INTERVAL)
+        try:
+            if self._bucket is not None:
+                while (wait := self._bucket.try_acquire()) > 0:
+                    if now() - start + wait > self.limits.max_wait:
+                        self._reject(start)
+                    await asyncio.sleep(wait)
+            METRICS.observe("admission.wait", now() - start, backend=self.url)
+            yield
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    def _reject(self, start: float) -> None:
+        METRICS.increment("admission.rejected", backend=self.url)
+        raise Overloaded(
+            f"backend {self.url} overloaded, not admitted within {now() - start:.2f}s"
+        )
+
+
+# One admission per backend url and limits, shared by all threads.
+_admissions: Dict[Tuple[str, AdmissionLimits], BackendAdmission] = {}
+_admissions_lock = threading.Lock()
+
+
+def get_admission(url: str, limits: AdmissionLimits) -> BackendAdmission:
+    key = (url, limits)
+    with _admissions_lock:
+        admission = _admissions.get(key)
+        if admission is None:
+            admission = _admissions[key] = BackendAdmission(url=url, limits=limits)
+        return admission
@@ -0,0 +1,245 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List
+from urllib.parse import urlsplit
+
+import requests
+
+from common.admission import AdmissionLimits, Overloaded, get_admission
+from common.metrics import METRICS, now
+
+
+@dataclass
+class Backend:
+    url: str
+    in_flight: int = 0
+    consecutive_failures: int = 0
+    # Not routed to before this time, see common.metrics.now.
+    ejected_until: float = 0.0
+    # Ejections since the last successful request, sets how long the next one lasts.
+    num_ejections: int = 0
+    num_requests: int = 0
+    num_failures: int = 0
+
+
+@dataclass
+class BackendLease:
+    # The backend a request was routed to. Call fail if the backend failed the request,
+    # exceptions raised while the lease is held count as failures too.
+    url: str
+    failed: bool = False
+
+    def fail(self) -> None:
+        self.failed = True
+
+
+@dataclass
+class BackendPool:
+    """
+    Endpoints of one service, e.g. several GPU boxes running the same model.
+    Each request goes to the available backend with the fewest requests in flight.
+    Backends failing max_failures requests in a row, or a health probe, are ejected
+    for eject_seconds, doubled with every ejection in a row up to max_eject_seconds.
+    They are readmitted once a probe succeeds, or tried again once the time is up.
+    """
+
+    urls: List[str]
+    # Seconds between health probes of all backends. None disables probing.
+    health_check_interval: float | None = 5.0
+    # Probed with GET on the backend's scheme, host and port. Any response below 500 is healthy.
+    health_check_path: str = "/"
+    health_check_timeout: float = 2.0
+    max_failures: int = 2
+    eject_seconds: float = 5.0
+    max_eject_seconds: float = 60.0
+    # Requests with the same key, e.g. the same prompt prefix, stay on one backend to
+    # reuse its caches, while it has at most this many more requests in flight than
+    # the least loaded backend.
+    affinity_slack: int = 1
+    max_affinity_keys: int = 1024
+
+    def __post_init__(self):
+        if not self.urls:
+            raise ValueError("BackendPool needs at least one url")
+        self.backends = [Backend(url=url) for url in self.urls]
+        self._lock = threading.Lock()
+        # { key: url } of the last backend each key was routed to, oldest first.
+        self._affinity: OrderedDict[str, str] = OrderedDict()
+        # Rotates between equally loaded backends.
+        self._next = 0
+        self._stop_event = threading.Event()
+        self._health_thread: threading.Thread | None = None
+
+    def start(self) -> "BackendPool":
+        # Start probing in the background. Safe to call more than once.
+        with self._lock:
+            if self._health_thread is None and self.health_check_interval is not None:
+                self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+                self._health_thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+
+    @contextmanager
+    def acquire(self, key: str | None = None) -> Iterator[BackendLease]:
+        backend = self._select(key)
+        lease = BackendLease(url=backend.url)
+        try:
+            yield lease
+        except Overloaded:
+            # Rejected before reaching the backend, which says nothing about its health.
+            raise
+        except Exception:
+            lease.fail()
+            raise
+        finally:
+            self._release(backend, lease.failed)
+
+    def check(self, backend: Backend) -> bool:
+        # Probe backend once, ejecting or readmitting it.
+        parts = urlsplit(backend.url)
+        try:
+            response = requests.get(
+                f"{parts.scheme}://{parts.netloc}{self.health_check_path}",
+                timeout=self.health_check_timeout,
+            )
+            healthy = response.status_code < 500
+        except Exception:
+            healthy = False
+        with self._lock:
+            if not healthy:
+                self._eject(backend, "health check failed")
+            elif backend.ejected_until > now():
+                backend.ejected_until = 0.0
+                print(f"INFO: readmitted backend {backend.url}")
+                METRICS.increment("backend_pool.readmitted", backend=backend.url)
+        return healthy
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {
+                    "url": backend.url,
+                    "in_flight": backend.in_flight,
+                    "requests": backend.num_requests,
+                    "failures": backend.num_failures,
+                    "ejected": backend.ejected_until > now(),
+                }
+                for backend in self.backends
+            ]
+
+    def _select(self, key: str | None) -> Backend:
+        with self._lock:
+            available = [
+                backend for backend in self.backends if backend.ejected_until <= now()
+            ]
+            if not available:
+                # Everything is ejected, try the backend coming back first rather than failing.
+                available = [min(self.backends, key=lambda backend: backend.ejected_until)]
+            least = min(backend.in_flight for backend in available)
+            backend = None
+            if key is not None and key in self._affinity:
+                backend = next(
+                    (b for b in available if b.url == self._affinity[key]), None
+                )
+                if backend is not None and backend.in_flight > least + self.affinity_slack:
+                    backend = None
+            if backend is None:
+                candidates = [b for b in available if b.in_flight == least]
+                backend = candidates[self._next % len(candidates)]
+                self._next += 1
+            backend.in_flight += 1
+            backend.num_requests += 1
+            if key is not None:
+                self._affinity[key] = backend.url
+                self._affinity.move_to_end(key)
+                while len(self._affinity) > self.max_affinity_keys:
+                    self._affinity.popitem(last=False)
+            return backend
+
+    def _release(self, backend: Backend, failed: bool) -> None:
+        with self._lock:
+            backend.in_flight -= 1
+            if not failed:
+                backend.consecutive_failures = 0
+                backend.num_ejections = 0
+                return
+            backend.num_failures += 1
+            backend.consecutive_failures += 1
+            METRICS.increment("backend_pool.failures", backend=backend.url)
+            if backend.consecutive_failures >= self.max_failures:
+                self._eject(backend, f"{backend.consecutive_failures} requests failed")
+
+    def _eject(self, backend: Backend, reason: str) -> None:
+        if backend.ejected_until > now():
+            return
+        seconds = min(
+            self.eject_seconds * 2**backend.num_ejections, self.max_eject_seconds
+        )
+        backend.ejected_until = now() + seconds
+        backend.num_ejections += 1
+        backend.consecutive_failures = 0
+        print(f"INFO: ejected backend {backend.url} for {seconds:.1f}s: {reason}")
+        METRICS.increment("backend_pool.ejected", backend=backend.url)
+
+    def _health_loop(self) -> None:
+        while not self._stop_event.wait(self.health_check_interval):
+            for backend in self.backends:
+                if self._stop_event.is_set():
+                    return
+                self.check(backend)
+
+
+def create_backend_pool(urls: List[str] | None) -> BackendPool | None:
+    # A single backend is used directly.
+    if urls is None or len(urls) < 2:
+        return None
+    return BackendPool(urls=urls).start()
+
+
+@contextmanager
+def lease_backend(
+    pool: BackendPool | None,
+    url: str,
+    key: str | None = None,
+    limits: AdmissionLimits | None = None,
+) -> Iterator[BackendLease]:
+    # Services without a pool always use their own url. With limits, the request waits
+    # for admission to the backend and raises Overloaded if it is not admitted.
+    if pool is None:
+        with _admit(url, limits):
+            yield BackendLease(url=url)
+        return
+    with pool.acquire(key) as lease:
+        with _admit(lease.url, limits):
+            yield lease
+
+
+@asynccontextmanager
+async def alease_backend(
+    pool: BackendPool | None,
+    url: str,
+    key: str | None = None,
+    limits: AdmissionLimits | None = None,
+) -> AsyncIterator[BackendLease]:
+    # Same as lease_backend, waiting for admission without blocking the event loop.
+    with lease_backend(pool, url, key) as lease:
+        if limits is None:
+            yield lease
+        else:
+            async with get_admission(lease.url, limits).aadmit():
+                yield lease
+
+
+@contextmanager
+def _admit(url: str, limits: AdmissionLimits | None) -> Iterator[None]:
+    if limits is None:
+        yield
+        return
+    with get_admission(url, limits).admit():
+        yield
@@ -0,0 +1,191 @@
+import asyncio
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+import math
+import threading
+from typing import Any, Awaitable, Callable, Deque, Dict, List, TypeVar
+
+from common.metrics import METRICS, now
+
+T = TypeVar("T")
+
+
+def _is_not_none(result: Any) -> bool:
+    return result is not None
+
+
+@dataclass
+class HedgePolicy:
+    """
+    Opt-in request hedging against slow backend calls. If a call has not returned
+    after the given percentile of recent call latencies, a duplicate is sent, which
+    a backend pool routes to the least busy backend. The first successful response
+    wins and the other one is cancelled.
+    At most max_hedge_rate of all calls are hedged, which bounds the extra load.
+    Counters are exported as hedge.<name>.requests, .hedged, .hedge_wins and
+    .cancelled.
+    """
+
+    # Metrics prefix, e.g. the service.
+    name: str
+    percentile: float = 95.0
+    # No hedging until this many latencies were seen, the percentile would be noise.
+    min_samples: int = 20
+    # Lower bound of the hedge delay, so fast calls are never duplicated.
+    min_delay: float = 0.05
+    max_hedge_rate: float = 0.1
+    # Number of most recent call latencies the percentile is computed over.
+    window: int = 256
+    # Threads running the attempts of blocking calls.
+    max_workers: int = 32
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=self.window)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix=f"hedge_{self.name}"
+        )
+        self.num_requests = 0
+        self.num_hedged = 0
+        self.num_hedge_wins = 0
+
+    def hedge_delay(self) -> float | None:
+        # Seconds after which a call is hedged, None if it should not be.
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            if self.num_hedged >= self.max_hedge_rate * self.num_requests:
+                return None
+            samples = sorted(self._latencies)
+        index = min(math.ceil(self.percentile / 100 * len(samples)) - 1, len(samples) - 1)
+        return max(samples[index], self.min_delay)
+
+    def call(
+        self,
+        attempt: Callable[[], T],
+        discard: Callable[[T], None] | None = None,
+        succeeded: Callable[[T], bool] = _is_not_none,
+    ) -> T:
+        """
+        Run attempt, and once more if it is slow. Returns the first result for which
+        succeeded is true, otherwise the last result. Blocking calls cannot be
+        interrupted, so the losing attempt runs to completion in the background and
+        its result is passed to discard, e.g. to close a response.
+        """
+        start = now()
+        delay = self._start_request()
+        attempts: List[Future] = [self._executor.submit(attempt)]
+        if delay is not None and not wait(attempts, timeout=delay).done:
+            attempts.append(self._executor.submit(attempt))
+            self._record_hedge()
+        pending = set(attempts)
+        winner = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # Primary first, if both finished at once.
+            for future in sorted(done, key=attempts.index):
+                if future.exception() is None and succeeded(future.result()):
+                    winner = future
+                    break
+        for future in pending:
+            self._cancel(future, discard)
+        if winner is None:
+            # Nothing succeeded, the last failed response is returned as is, else the
+            # error raised.
+            returned = [future for future in attempts if future.exception() is None]
+            if not returned:
+                raise attempts[0].exception()
+            self._discard_others(attempts, returned[-1], discard)
+            return returned[-1].result()
+        self._discard_others(attempts, winner, discard)
+        self._finish_request(start, hedge_won=winner is not attempts[0])
+        return winner.result()
+
+    async def acall(
+        self,
+        attempt: Callable[[], Awaitable[T]],
+        succeeded: Callable[[T], bool] = _is_not_none,
+    ) -> T:
+        # Same as call, for coroutines. The losing attempt is cancelled right away.
+        start = now()
+        delay = self._start_request()
+        attempts: List[asyncio.Task] = [asyncio.ensure_future(attempt())]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(attempts, timeout=delay)
+                if not done:
+                    attempts.append(asyncio.ensure_future(attempt()))
+                    self._record_hedge()
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=attempts.index):
+                    if task.exception() is None and succeeded(task.result()):
+                        self._finish_request(start, hedge_won=task is not attempts[0])
+                        return task.result()
+            # Nothing succeeded, the last attempt to finish decides.
+            return task.result()
+        finally:
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+                    METRICS.increment(f"hedge.{self.name}.cancelled")
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "requests": self.num_requests,
+                "hedged": self.num_hedged,
+                "hedge_wins": self.num_hedge_wins,
+                "hedge_rate": self.num_hedged / max(self.num_requests, 1),
+                "win_rate": self.num_hedge_wins / max(self.num_hedged, 1),
+            }
+
+    def _start_request(self) -> float | None:
+        delay = self.hedge_delay()
+        with self._lock:
+            self.num_requests += 1
+        METRICS.increment(f"hedge.{self.name}.requests")
+        return delay
+
+    def _record_hedge(self) -> None:
+        with self._lock:
+            self.num_hedged += 1
+        METRICS.increment(f"hedge.{self.name}.hedged")
+
+    def _finish_request(self, start: float, hedge_won: bool) -> None:
+        # Only successful calls count towards the latency the delay is based on.
+        with self._lock:
+            self._latencies.append(now() - start)
+            if hedge_won:
+                self.num_hedge_wins += 1
+        if hedge_won:
+            METRICS.increment(f"hedge.{self.name}.hedge_wins")
+
+    def _discard_others(
+        self,
+        attempts: List[Future],
+        returned: Future,
+        discard: Callable[[Any], None] | None,
+    ) -> None:
+        # Finished attempts besides the returned one, e.g. leases of failed responses.
+        for future in attempts:
+            if future is not returned and future.done() and future.exception() is None:
+                if discard is not None:
+                    discard(future.result())
+
+    def _cancel(self, future: Future, discard: Callable[[Any], None] | None) -> None:
+        METRICS.increment(f"hedge.{self.name}.cancelled")
+
+        def _discard(future: Future) -> None:
+            if discard is not None and future.exception() is None:
+                discard(future.result())
+
+        future.add_done_callback(_discard)
+
+
+def create_hedge_policy(name: str, percentile: float | None) -> HedgePolicy | None:
+    if percentile is None:
+        return None
+    return HedgePolicy(name=name, percentile=percentile)
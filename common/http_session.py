@@ -0,0 +1,89 @@
+from dataclasses import dataclass
+import threading
+from typing import Dict, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+@dataclass(frozen=True)
+class HttpSessionConfig:
+    # Max number of keep-alive connections kept open per backend.
+    pool_size: int = 10
+    # Seconds to wait for a connection to the backend.
+    connect_timeout: float = 3.05
+    # Seconds to wait between bytes received from the backend.
+    read_timeout: float = 60.0
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout)
+
+
+DEFAULT_HTTP_SESSION_CONFIG = HttpSessionConfig()
+
+# One session per backend, i.e. scheme + host + port. Sessions are shared by all threads.
+_sessions: Dict[Tuple[str, HttpSessionConfig], requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def _backend(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(
+    url: str, config: HttpSessionConfig = DEFAULT_HTTP_SESSION_CONFIG
+) -> requests.Session:
+    """
+    Return the shared keep-alive session for the backend serving url.
+    The underlying urllib3 connection pool is thread safe, so the session can be
+    used from several worker threads at once.
+    """
+    key = (_backend(url), config)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=config.pool_size, pool_block=False
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return session
+
+
+def create_httpx_client(
+    config: HttpSessionConfig = DEFAULT_HTTP_SESSION_CONFIG,
+) -> httpx.Client:
+    # Used by clients built on httpx, e.g. OpenAI.
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=config.pool_size,
+            max_keepalive_connections=config.pool_size,
+        ),
+        timeout=httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+    )
+
+
+def create_async_httpx_client(
+    config: HttpSessionConfig = DEFAULT_HTTP_SESSION_CONFIG,
+) -> httpx.AsyncClient:
+    # Async counterpart of create_httpx_client, used by the asyncio pipeline.
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config.pool_size,
+            max_keepalive_connections=config.pool_size,
+        ),
+        timeout=httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+    )
+
+
+def close_sessions() -> None:
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,247 @@
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import threading
+import time
+from typing import Deque, Dict, Iterator, List, Tuple
+
+PERCENTILES = (50, 95, 99)
+
+# Events recorded for every conversation turn, in the order they usually happen.
+TURN_EVENTS = [
+    "turn_start",
+    "recording_end",
+    "clipboard_read",
+    "stt_done",
+    "llm_first_token",
+    "llm_done",
+    "first_tts_result",
+    "first_audio_played",
+    "last_audio_played",
+]
+
+# { stage: (start event, end event) }
+TURN_STAGES = {
+    "recording": ("turn_start", "recording_end"),
+    # Runs alongside recording, except in astart_conversation, which reads the
+    # clipboard once recording ended.
+    "clipboard": ("turn_start", "clipboard_read"),
+    "stt": ("recording_end", "stt_done"),
+    "llm_first_token": ("stt_done", "llm_first_token"),
+    "llm": ("stt_done", "llm_done"),
+    "first_tts_result": ("llm_first_token", "first_tts_result"),
+    "first_audio": ("recording_end", "first_audio_played"),
+    "playback": ("first_audio_played", "last_audio_played"),
+    "turn": ("recording_end", "last_audio_played"),
+}
+
+
+def now() -> float:
+    return time.perf_counter()
+
+
+@dataclass
+class LatencyHistogram:
+    # Number of most recent samples the percentiles are computed over.
+    window: int = 1024
+
+    def __post_init__(self):
+        self._samples: Deque[float] = deque(maxlen=self.window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentiles(self) -> Dict[str, float]:
+        samples = sorted(self._samples)
+        if not samples:
+            return {}
+        return {
+            f"p{p}": samples[min(math.ceil(p / 100 * len(samples)) - 1, len(samples) - 1)]
+            for p in PERCENTILES
+        }
+
+    def snapshot(self) -> Dict[str, float]:
+        return {"count": self.count, "sum": self.total, **self.percentiles()}
+
+
+@dataclass
+class TurnTimeline:
+    turn_id: str
+    # { event: timestamp from now() }
+    events: Dict[str, float] = field(default_factory=dict)
+
+    def mark(self, event: str, timestamp: float | None = None) -> None:
+        # Keep the first timestamp, e.g. first_tts_result is only marked once.
+        self.events.setdefault(event, now() if timestamp is None else timestamp)
+
+    def stages(self) -> Dict[str, float]:
+        # Seconds spent in every stage whose start and end events were recorded.
+        return {
+            stage: self.events[end] - self.events[start]
+            for stage, (start, end) in TURN_STAGES.items()
+            if start in self.events and end in self.events
+        }
+
+
+@dataclass
+class MetricsRegistry:
+    """
+    Process wide rolling latency histograms and counters.
+    Names may carry a backend label, so each backend gets its own histogram.
+    """
+
+    window: int = 1024
+    # Last turns kept for inspection.
+    max_turns: int = 20
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._counters: Dict[str, float] = {}
+        self._turns: Deque[TurnTimeline] = deque(maxlen=self.max_turns)
+
+    def observe(self, name: str, seconds: float, backend: str | None = None) -> None:
+        key = _key(name, backend)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram(window=self.window)
+            histogram.observe(seconds)
+
+    def increment(self, name: str, value: float = 1, backend: str | None = None) -> None:
+        key = _key(name, backend)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, backend: str | None = None) -> Iterator[None]:
+        start = now()
+        try:
+            yield
+        finally:
+            self.observe(name, now() - start, backend=backend)
+
+    def record_turn(self, timeline: TurnTimeline) -> Dict[str, float]:
+        stages = timeline.stages()
+        for stage, seconds in stages.items():
+            self.observe(f"turn.{stage}", seconds)
+        with self._lock:
+            self._turns.append(timeline)
+        return stages
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "histograms": {
+                    key: histogram.snapshot() for key, histogram in self._histograms.items()
+                },
+                "counters": dict(self._counters),
+                "turns": [
+                    {"turn_id": turn.turn_id, "stages": turn.stages()} for turn in self._turns
+                ],
+            }
+
+    def to_text(self) -> str:
+        # Prometheus style text exposition.
+        lines: List[str] = []
+        snapshot = self.snapshot()
+        for key, histogram in sorted(snapshot["histograms"].items()):
+            name, labels = _split_key(key)
+            for stat in ("count", "sum"):
+                lines.append(f"{name}_{stat}{_labels(labels)} {histogram[stat]:.6f}")
+            for p in PERCENTILES:
+                if f"p{p}" in histogram:
+                    quantile = labels + [("quantile", str(p / 100))]
+                    lines.append(f"{name}{_labels(quantile)} {histogram[f'p{p}']:.6f}")
+        for key, value in sorted(snapshot["counters"].items()):
+            name, labels = _split_key(key)
+            lines.append(f"{name}_total{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _key(name: str, backend: str | None) -> str:
+    return name if backend is None else f"{name}|{backend}"
+
+
+def _split_key(key: str) -> Tuple[str, List[Tuple[str, str]]]:
+    name, _, backend = key.partition("|")
+    name = name.replace(".", "_")
+    return name, [("backend", backend)] if backend else []
+
+
+def _labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+# Default registry used by the services.
+METRICS = MetricsRegistry()
+
+
+def start_metrics_server(
+    registry: MetricsRegistry = METRICS,
+    host: str = "127.0.0.1",
+    port: int | None = 9464,
+) -> ThreadingHTTPServer | None:
+    """
+    Serve metrics as text on /metrics and as json on /metrics.json.
+    Call shutdown() on the returned server to stop it. Returns None if port is None, or
+    if the port can not be bound, e.g. it is used by another instance: metrics are
+    optional, the conversation runs without them.
+    """
+    if port is None:
+        return None
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                content, content_type = registry.to_text().encode("utf-8"), "text/plain"
+            elif self.path == "/metrics.json":
+                content = json.dumps(registry.snapshot()).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        print(f"WARNING: metrics are not served, can not listen on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_metrics_dump(
+    path: str, interval: float = 60.0, registry: MetricsRegistry = METRICS
+) -> threading.Event:
+    # Write a json snapshot to path every interval seconds. Set the returned event to stop.
+    stop_event = threading.Event()
+
+    def _dump():
+        while not stop_event.wait(interval):
+            try:
+                with open(path, "w") as f:
+                    json.dump(registry.snapshot(), f)
+            except OSError as e:
+                print(f"Error dumping metrics: {e}")
+
+    threading.Thread(target=_dump, daemon=True).start()
+    return stop_event
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+
+def _no_size(value: Any) -> int:
+    return 0
+
+
+@dataclass
+class ResultStore:
+    """
+    Dict like store for results waiting to be consumed, keyed by task id.
+    Consumers pop results once they are done with them. Results nobody consumes, e.g.
+    after a wait timed out, are evicted oldest first once older than ttl, or while
+    the store holds more than max_entries results or max_bytes as measured by size_of.
+    Eviction happens on insert, so an idle store costs nothing.
+    """
+
+    # Seconds a result is kept after it is saved. None keeps results until consumed.
+    ttl: float | None = 600.0
+    max_entries: int | None = None
+    max_bytes: int | None = None
+    size_of: Callable[[Any], int] = field(default=_no_size, repr=False)
+    clock: Callable[[], float] = field(default=time.monotonic, repr=False)
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        # { key: (saved at, size, value) }, oldest first.
+        self._entries: OrderedDict[str, Tuple[float, int, Any]] = OrderedDict()
+        self.total_bytes = 0
+        self.num_released = 0
+        self.num_evicted = 0
+        self.bytes_evicted = 0
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        size = self.size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (self.clock(), size, value)
+            self.total_bytes += size
+            self._evict()
+
+    def __getitem__(self, key: str) -> Any:
+        return self._entries[key][2]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            return iter(list(self._entries))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        return default if entry is None else entry[2]
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        # Release a consumed result.
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.total_bytes -= entry[1]
+            self.num_released += 1
+            return entry[2]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "released": self.num_released,
+                "evicted": self.num_evicted,
+                "bytes_evicted": self.bytes_evicted,
+            }
+
+    def _evict(self) -> None:
+        now = self.clock()
+        # The newest result is always kept, even if it alone exceeds max_bytes.
+        while len(self._entries) > 1:
+            key, (saved_at, size, _) = next(iter(self._entries.items()))
+            if not (
+                (self.ttl is not None and now - saved_at > self.ttl)
+                or (self.max_entries is not None and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            ):
+                return
+            del self._entries[key]
+            self.total_bytes -= size
+            self.num_evicted += 1
+            self.bytes_evicted += size
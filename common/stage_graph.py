@@ -0,0 +1,155 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from common.metrics import METRICS, now
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    # Called with the results of the inputs as keyword arguments, named after the stages.
+    run: Callable[..., Any]
+    inputs: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class StageTiming:
+    name: str
+    # See common.metrics.now.
+    start: float
+    end: float
+
+    @property
+    def seconds(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class StageGraphRun:
+    results: Dict[str, Any]
+    timings: Dict[str, StageTiming]
+    # Stages that ended last, each started by the one before it, first stage first.
+    critical_path: List[StageTiming]
+    # Stages not started because the run was cancelled or one of their inputs failed.
+    skipped: List[str]
+    start: float
+    end: float
+
+    def describe(self) -> str:
+        path = " > ".join(f"{timing.name} {timing.seconds:.3f}s" for timing in self.critical_path)
+        busy = sum(timing.seconds for timing in self.timings.values())
+        return f"{path}, {self.end - self.start:.3f}s wall for {busy:.3f}s of stages"
+
+
+@dataclass
+class StageGraph:
+    """
+    Dependency graph of the stages of a turn. Every stage runs on its own thread as
+    soon as all of its inputs have finished, so independent stages overlap and the
+    wall time of a run is its critical path rather than the sum of its stages.
+    Stage durations and how often each stage is on the critical path are recorded
+    as metrics under name.
+    """
+
+    name: str = "stage"
+    stages: Dict[str, Stage] = field(default_factory=dict)
+
+    def add(
+        self, name: str, run: Callable[..., Any], inputs: Iterable[str] = ()
+    ) -> None:
+        # Inputs have to be added first, which keeps the graph acyclic.
+        inputs = tuple(inputs)
+        if name in self.stages:
+            raise ValueError(f"stage {name} already added")
+        missing = [stage for stage in inputs if stage not in self.stages]
+        if missing:
+            raise ValueError(f"stage {name} has unknown inputs {missing}")
+        self.stages[name] = Stage(name=name, run=run, inputs=inputs)
+
+    def run(self, cancel_event: threading.Event | None = None) -> StageGraphRun:
+        """
+        Run all stages and return their results and timings. Once cancel_event is set,
+        stages that have not started yet are skipped. If a stage fails, the stages
+        depending on it are skipped and its exception is raised once the stages
+        already running have finished.
+        """
+        start = now()
+        results: Dict[str, Any] = {}
+        timings: Dict[str, StageTiming] = {}
+        errors: Dict[str, Exception] = {}
+        skipped: List[str] = []
+        waiting = dict(self.stages)
+        running: Dict[Future, str] = {}
+        with ThreadPoolExecutor(
+            max_workers=max(len(self.stages), 1), thread_name_prefix=self.name
+        ) as executor:
+            while waiting or running:
+                # Stages are in insertion order, so inputs are always visited first.
+                for name, stage in list(waiting.items()):
+                    if (cancel_event is not None and cancel_event.is_set()) or any(
+                        stage_input in errors or stage_input in skipped
+                        for stage_input in stage.inputs
+                    ):
+                        skipped.append(name)
+                        del waiting[name]
+                    elif all(stage_input in results for stage_input in stage.inputs):
+                        kwargs = {stage_input: results[stage_input] for stage_input in stage.inputs}
+                        running[executor.submit(_run_stage, stage, kwargs)] = name
+                        del waiting[name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    result, error, timings[name] = future.result()
+                    if error is not None:
+                        print(f"Error running stage {name}: {error}")
+                        errors[name] = error
+                    else:
+                        results[name] = result
+        graph_run = StageGraphRun(
+            results=results,
+            timings=timings,
+            critical_path=self._critical_path(timings),
+            skipped=skipped,
+            start=start,
+            end=now(),
+        )
+        self._record(graph_run)
+        if errors:
+            raise next(iter(errors.values()))
+        return graph_run
+
+    def _critical_path(self, timings: Dict[str, StageTiming]) -> List[StageTiming]:
+        # Walk back from the stage that ended last, through the input each stage waited for.
+        if not timings:
+            return []
+        timing = max(timings.values(), key=lambda timing: timing.end)
+        path = [timing]
+        while inputs := [
+            timings[stage_input]
+            for stage_input in self.stages[timing.name].inputs
+            if stage_input in timings
+        ]:
+            timing = max(inputs, key=lambda timing: timing.end)
+            path.append(timing)
+        return path[::-1]
+
+    def _record(self, graph_run: StageGraphRun) -> None:
+        for timing in graph_run.timings.values():
+            METRICS.observe(f"{self.name}.{timing.name}", timing.seconds)
+        for timing in graph_run.critical_path:
+            METRICS.increment(f"{self.name}.critical_path.{timing.name}")
+
+
+def _run_stage(
+    stage: Stage, kwargs: Dict[str, Any]
+) -> Tuple[Any, Exception | None, StageTiming]:
+    start = now()
+    try:
+        result, error = stage.run(**kwargs), None
+    except Exception as e:
+        result, error = None, e
+    return result, error, StageTiming(name=stage.name, start=start, end=now())
@@ -0,0 +1,219 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, List, Tuple
+
+from audio.audio_manager import SpeechToTextTask, TextToSpeechTask
+from audio.stt_service import STTService
+from audio.tts_service import TTSServiceMeloTTS
+from common.http_session import create_async_httpx_client
+from common.metrics import METRICS
+from llm.llm_manager import LlmGenerationTask, LlmPrefillTask
+from llm.llm_service import LLMService
+from llm.response_cache import LlmResponseCache
+
+
+@dataclass
+class AsyncPipeline:
+    """
+    Asyncio alternative to the threaded services started by start_services.
+    Every stage runs as worker coroutines on one event loop, fed by asyncio queues. The
+    number of workers bounds the requests in flight per stage, so one process can drive
+    many concurrent requests per backend without a thread per stage.
+    Cancelling a caller, e.g. a turn interrupted by the user, cancels its requests in
+    flight, so the backends stop working on an answer nobody will hear.
+    Stage queues are bounded, callers wait for room when a stage falls behind.
+    """
+
+    stt_service: STTService
+    tts_service: TTSServiceMeloTTS
+    llm_service: LLMService
+    num_stt_workers: int = 2
+    num_llm_workers: int = 2
+    num_tts_workers: int = 4
+    # Requests waiting for a worker, per stage.
+    max_queued_requests: int = 64
+    # Responses synthesized ahead of the one speak's caller is consuming. Generation
+    # waits while they are not consumed, so a slow player holds back tts and the llm.
+    max_synthesis_ahead: int = 4
+    # Prefills sent at once, None for num_llm_workers. Further prefills are skipped,
+    # a busy backend would answer them too late to help.
+    max_concurrent_prefills: int | None = None
+    llm_response_cache: LlmResponseCache | None = None
+    _workers: List[asyncio.Task] = field(default_factory=list, init=False, repr=False)
+
+    async def start(self) -> None:
+        self._stt_queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queued_requests)
+        self._llm_queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queued_requests)
+        self._tts_queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queued_requests)
+        self._tts_client = create_async_httpx_client(self.tts_service.http_config)
+        self._prefills = asyncio.Semaphore(
+            self.max_concurrent_prefills or self.num_llm_workers
+        )
+        if self.llm_response_cache is not None:
+            self.llm_response_cache.namespace = self.llm_service.generation_config
+        for queue, handler, num_workers in [
+            (self._stt_queue, self._transcribe, self.num_stt_workers),
+            (self._llm_queue, self._generate, self.num_llm_workers),
+            (self._tts_queue, self._synthesize, self.num_tts_workers),
+        ]:
+            for _ in range(num_workers):
+                self._workers.append(asyncio.create_task(_worker(queue, handler)))
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        await self._tts_client.aclose()
+        # Stops the health checks of their backend pools.
+        for service in (self.stt_service, self.tts_service, self.llm_service):
+            service.stop()
+
+    async def transcribe(self, task: SpeechToTextTask) -> str | None:
+        return await (await self._submit(self._stt_queue, task))
+
+    async def synthesize(self, task: TextToSpeechTask) -> bytes | None:
+        return await (await self._submit(self._tts_queue, task))
+
+    async def prefill(self, task: LlmPrefillTask) -> None:
+        # Skips the prefill rather than wait, once it could run the generation would too.
+        if self._prefills.locked():
+            METRICS.increment("llm.prefill.skipped")
+            return
+        async with self._prefills:
+            await self.llm_service.aprefill(task)
+
+    async def generate(self, task: LlmGenerationTask) -> AsyncIterator[str]:
+        # Yield responses as the llm streams them.
+        key = None
+        if self.llm_response_cache is not None:
+            key = self.llm_response_cache.make_key(task)
+            cached_responses = self.llm_response_cache.get(key)
+            if cached_responses is not None:
+                for response in cached_responses:
+                    yield response
+                return
+        # Bounded, so the llm worker stops streaming while the caller is behind.
+        responses: asyncio.Queue = asyncio.Queue(maxsize=self.max_synthesis_ahead)
+        done = await self._submit(self._llm_queue, (task, responses))
+        generated = []
+        try:
+            while (response := await responses.get()) is not None:
+                generated.append(response)
+                yield response
+            # Raises if generation failed, so failed responses are not cached.
+            await done
+        finally:
+            # Stops generation if the caller stopped early or was cancelled.
+            done.cancel()
+        if key is not None and generated:
+            self.llm_response_cache.put(key, tuple(generated))
+
+    async def speak(self, task: LlmGenerationTask) -> AsyncIterator[Tuple[str, bytes | None]]:
+        """
+        Yield (response, audio) in generation order. Each response is sent to tts as soon
+        as it is generated, so synthesis of earlier responses overlaps generation of later ones.
+        """
+        pending: asyncio.Queue = asyncio.Queue(maxsize=self.max_synthesis_ahead)
+
+        async def _produce():
+            cancelled = False
+            try:
+                index = 0
+                async for response in self.generate(task):
+                    index += 1
+                    tts_task = TextToSpeechTask(task_id=f"{task.task_id}_{index}", text=response)
+                    synthesis = asyncio.ensure_future(self.synthesize(tts_task))
+                    try:
+                        # Waits while max_synthesis_ahead responses are not consumed.
+                        await pending.put((response, synthesis))
+                    except asyncio.CancelledError:
+                        synthesis.cancel()
+                        raise
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                # A cancelled producer's consumer is gone, nobody waits for the end.
+                if not cancelled:
+                    await pending.put(None)
+
+        producer = asyncio.create_task(_produce())
+        try:
+            while (item := await pending.get()) is not None:
+                response, synthesis = item
+                yield response, await synthesis
+            await producer
+        finally:
+            producer.cancel()
+            # Drop synthesis of responses that will not be played.
+            while not pending.empty():
+                if (item := pending.get_nowait()) is not None:
+                    item[1].cancel()
+
+    async def _submit(self, queue: asyncio.Queue, item) -> asyncio.Future:
+        # Waits while the stage's queue is full.
+        future = asyncio.get_running_loop().create_future()
+        if queue.full():
+            METRICS.increment("backpressure.pipeline")
+        await queue.put((item, future))
+        return future
+
+    async def _transcribe(self, task: SpeechToTextTask) -> str | None:
+        return await self.stt_service.aconvert(task)
+
+    async def _generate(self, item: Tuple[LlmGenerationTask, asyncio.Queue]) -> None:
+        task, responses = item
+        cancelled = False
+        try:
+            async for response in self.llm_service.aconvert(task):
+                # Waits while the caller has max_synthesis_ahead responses to read.
+                await responses.put(response)
+        except asyncio.CancelledError:
+            cancelled = True
+            METRICS.increment("cancelled.llm", backend=self.llm_service.ollama_base_url)
+            raise
+        finally:
+            if not cancelled:
+                await responses.put(None)
+            else:
+                # The caller may still be reading, end its stream right away, a
+                # response of a cancelled answer can be dropped for it.
+                if responses.full():
+                    responses.get_nowait()
+                responses.put_nowait(None)
+
+    async def _synthesize(self, task: TextToSpeechTask) -> bytes | None:
+        try:
+            result = await self.tts_service.asynthesize(task, self._tts_client)
+        except asyncio.CancelledError:
+            METRICS.increment("cancelled.tts")
+            raise
+        return result.content
+
+
+async def _worker(queue: asyncio.Queue, handler: Callable[..., Awaitable]) -> None:
+    while True:
+        item, future = await queue.get()
+        if future.cancelled():
+            continue
+        handling = asyncio.ensure_future(handler(item))
+        # Cancelling the request cancels the work in flight.
+        future.add_done_callback(
+            lambda future, handling=handling: handling.cancel() if future.cancelled() else None
+        )
+        try:
+            result = await handling
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # The worker itself is stopped.
+                future.cancel()
+                raise
+            # Only the request was cancelled, serve the next one.
+            continue
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+        else:
+            if not future.cancelled():
+                future.set_result(result)
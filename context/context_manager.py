@@ -1,19 +1,34 @@
+import asyncio
+from collections import deque
 from dataclasses import dataclass
 from enum import Enum
+from queue import Queue
 import threading
-import time
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Deque, Dict, Iterable, List, Tuple
 import uuid
 
 import speech_recognition as sr
 from audio.stt_service import STTService
-from audio.tts_service import (
-    TTSServiceChatTTS,
-    TTSServiceMeloTTS,
-    TTSServiceType,
+from audio.tts_cache import TTSCache
+from audio.tts_service import TTSServiceMeloTTS, TTSServiceType, start_tts_pool
+from audio.audio_player import AudioPlayer
+from audio.speech_preprocess import SpeechPreprocessConfig, preprocess_speech
+from context.async_pipeline import AsyncPipeline
+from context.conversation_history import (
+    ConversationHistory,
+    prefill_context,
+    prompt_context,
 )
-from audio.util import play_audio, record_audio
+from audio.util import fetch_audio_from_url, record_audio, record_audio_segments
+from common.admission import AdmissionLimits
+from common.backend_pool import create_backend_pool
+from common.hedging import create_hedge_policy
+from common.http_session import close_sessions
+from common.metrics import METRICS, TurnTimeline
+from common.stage_graph import StageGraph, StageGraphRun
 from audio.audio_manager import (
+    MAX_UNPLAYED_TEXT_TO_AUDIO_RESULTS,
+    TASK_WAIT_TIMEOUT,
     AudioManager,
     SpeechToTextTask,
     TextToSpeechResultChatTTS,
@@ -21,11 +36,12 @@ from audio.audio_manager import (
     TextToSpeechTask,
 )
 from llm.llm_service import LLMService
+from llm.response_cache import LlmResponseCache
 from text.text_manager import (
     CopyFromClipboardTask,
     TextManager,
 )
-from llm.llm_manager import LlmGenerationTask, LlmManager, TaskStatus
+from llm.llm_manager import LlmGenerationTask, LlmManager, LlmPrefillTask
 
 
 class TaskType(Enum):
@@ -33,28 +49,108 @@ class TaskType(Enum):
     TEXT_TO_AUDIO = 2
     LLM_GEN = 3
     COPY_FROM_CLIPBOARD = 4
+    LLM_PREFILL = 5
 
 
 @dataclass
 class ContextManager:
     # Default question to use when audio to text fails.
     default_question: str = "Please summarize the context"
+    # Seconds to wait for speech to text before falling back to the default question.
+    audio_to_text_timeout: float | None = 60.0
+    # Start playing synthesized chunks while the llm is still generating.
+    # If False, the whole response is generated before playback starts.
+    pipeline_playback: bool = True
+    # Transcribe speech segments in the background while the user is still speaking.
+    streaming_audio_to_text: bool = False
+    # Only send the passages most relevant to the question, within this many tokens.
+    # None sends the whole clipboard context.
+    max_context_tokens: int | None = 2048
+    # Watch the clipboard in the background and prepare contexts before the turn starts.
+    watch_clipboard: bool = False
+    # Send previous turns about the same clipboard context along with the question.
+    # The prompt keeps system prompt and context as a stable prefix, so ollama can
+    # reuse its prompt cache for follow up questions.
+    multi_turn: bool = False
+    # Max tokens of previous turns sent in multi turn mode.
+    history_max_tokens: int = 1024
+    # Yields the speech segments of a turn in streaming mode. None records from the
+    # microphone, set it to replay recorded audio, e.g. in benchmarks.
+    record_segments: Callable[[], Iterable[bytes]] | None = None
+    # Trim silence and downsample recorded speech before uploading it for speech to
+    # text. None uploads the recording as is.
+    speech_preprocess: SpeechPreprocessConfig | None = SpeechPreprocessConfig()
+    # Turns of tasks and prompts kept for inspection, at least 2 for multi turn mode.
+    max_turns_kept: int = 2
+    # Send the prompt without the question to the llm while speech to text is still
+    # running, so the backend has prefilled the context when the question arrives.
+    speculative_prefill: bool = True
+    # Chunks handed to the audio player ahead of playback. Further results are held
+    # back, which in turn holds back synthesis and the llm chunks feeding it, so a
+    # fast llm does not buffer a whole answer of audio. None hands chunks over at once.
+    max_queued_chunks: int | None = 3
 
     def __post_init__(self):
         self._conversation_id = str(uuid.uuid4())
-        self.audio_manager = AudioManager()
+        if self.pipeline_playback:
+            # Played results are cleaned up, synthesis keeps pace with playback.
+            self.audio_manager = AudioManager(
+                max_unplayed_text_to_audio_results=MAX_UNPLAYED_TEXT_TO_AUDIO_RESULTS
+            )
+        else:
+            # Playback only starts once generation is done, so synthesis cannot wait for it.
+            self.audio_manager = AudioManager(
+                text_to_audio_tasks=Queue(), max_unplayed_text_to_audio_results=None
+            )
         self.text_manager = TextManager()
         self.llm_manager = LlmManager()
+        self.audio_player = AudioPlayer()
+        if self.watch_clipboard:
+            self.text_manager.start_clipboard_watcher()
 
         self._conversation_turn: int = 0
-        self._audio_to_text_tasks: List[SpeechToTextTask] = []
-        self._copy_from_clipboard_tasks: List[CopyFromClipboardTask] = []
-        self._llm_gen_tasks: List[LlmGenerationTask] = []
-        self._text_to_audio_tasks: List[List[TextToSpeechTask]] = []
-        self._prompts: List[Dict] = []
+        # Only the last turns are kept, so a long running session does not keep every
+        # recording and response.
+        max_turns_kept = max(self.max_turns_kept, 2)
+        self._audio_to_text_tasks: Deque[List[SpeechToTextTask]] = deque(
+            maxlen=max_turns_kept
+        )
+        self._copy_from_clipboard_tasks: Deque[CopyFromClipboardTask] = deque(
+            maxlen=max_turns_kept
+        )
+        self._llm_gen_tasks: Deque[LlmGenerationTask] = deque(maxlen=max_turns_kept)
+        self._text_to_audio_tasks: Deque[List[TextToSpeechTask]] = deque(
+            maxlen=max_turns_kept
+        )
+        self._prompts: Deque[Dict] = deque(maxlen=max_turns_kept)
+        # Previous turns about the clipboard context in multi turn mode. Kept apart
+        # from _prompts, whose last turns may have been cancelled before their context
+        # was prepared.
+        self._history = (
+            ConversationHistory(max_tokens=self.history_max_tokens)
+            if self.multi_turn
+            else None
+        )
+        # Latency timeline of the current turn.
+        self._timeline: TurnTimeline | None = None
+        # Set by cancel_conversation, cleared when the next turn starts.
+        self._cancel_event = threading.Event()
+        # Set by end_recording, cleared when the next turn starts.
+        self._end_recording_event = threading.Event()
+        # Whether the current turn is still recording or transcribing the question.
+        self._listening = False
+        self._listening_lock = threading.Lock()
+        # Stage timings and critical path of the last turn.
+        self.last_turn_stages: StageGraphRun | None = None
 
     def start_conversation(self):
         self._conversation_turn += 1
+        self._cancel_event.clear()
+        self._start_listening()
+        self._timeline = TurnTimeline(
+            turn_id=f"{self._conversation_id}_{self._conversation_turn}"
+        )
+        self._timeline.mark("turn_start")
 
         print(
             "================================================================================="
@@ -63,17 +159,241 @@ class ContextManager:
         )
 
         self._prompts.append({})
+        graph_run = self._build_turn_graph().run(cancel_event=self._cancel_event)
+        self.last_turn_stages = graph_run
+        print(f"INFO: turn critical path: {graph_run.describe()}")
+        if self._cancel_event.is_set():
+            print("INFO: conversation cancelled")
+            return
+        self._record_turn()
+
+    def _build_turn_graph(self) -> StageGraph:
+        """
+        Stages of a turn and the stages they wait for:
+
+            record ---> stt -------.
+                                    +--> prompt --> llm --> playback
+            clipboard --> context -'
+
+        The clipboard is read and its context prepared and prefilled while the user
+        is still speaking. With pipeline_playback, playback waits for prompt instead
+        of llm and plays the chunks as they are generated.
+        """
+        graph = StageGraph(name="turn_stage")
+        graph.add("record", self._record_stage)
+        graph.add("clipboard", self._copy_from_clipboard)
+        graph.add("context", self._context_stage, inputs=["clipboard"])
+        graph.add("stt", self._stt_stage, inputs=["record"])
+        graph.add(
+            "prompt",
+            lambda context, stt: self._prepare_context(context, stt),
+            inputs=["context", "stt"],
+        )
+        if not self.pipeline_playback:
+            graph.add("llm", lambda prompt: self._generate_response(), inputs=["prompt"])
+            graph.add("playback", lambda llm: self._play_response(), inputs=["llm"])
+            return graph
+
+        # Tasks are handed to the player in the order they are created, so
+        # playback order matches generation order.
+        play_queue: Queue[TextToSpeechTask | None] = Queue()
+
+        def generate(prompt: None) -> None:
+            try:
+                self._generate_response(on_text_to_audio_task=play_queue.put)
+            finally:
+                play_queue.put(None)
+
+        graph.add("llm", generate, inputs=["prompt"])
+        graph.add(
+            "playback",
+            lambda prompt: self._play_response(tasks=iter(play_queue.get, None)),
+            inputs=["prompt"],
+        )
+        return graph
+
+    def _record_stage(self) -> List[SpeechToTextTask]:
         print("INFO: recording user audio input ...")
-        audio_content = record_audio(device_index=1)
+        if self.streaming_audio_to_text:
+            audio_to_text_tasks = self._record_and_add_audio_to_text_tasks()
+        else:
+            # A barge in stops recording right away.
+            audio_content = record_audio(
+                device_index=1,
+                stop_event=self._cancel_event,
+                end_event=self._end_recording_event,
+            )
+            audio_to_text_tasks = []
+            if audio_content is not None and not self._cancel_event.is_set():
+                audio_to_text_tasks.append(
+                    SpeechToTextTask(
+                        task_id=self._get_task_id(
+                            TaskType.AUDIO_TO_TEXT, self._conversation_turn
+                        ),
+                        audio_data=self._preprocess_speech(audio_content),
+                    )
+                )
+                print("INFO: adding speech to text task ...")
+                self.audio_manager.add_audio_to_text_task(audio_to_text_tasks[0])
+        self._timeline.mark("recording_end")
+        self._audio_to_text_tasks.append(audio_to_text_tasks)
+        return audio_to_text_tasks
+
+    def _context_stage(self, clipboard: str) -> str:
+        # Prepares the context artifacts and warms up the llm, returns the clipboard text.
+        prefill_task = self._create_prefill_task(clipboard)
+        if prefill_task is not None:
+            self.llm_manager.add_prefill_task(prefill_task)
+        return clipboard
+
+    def _stt_stage(self, record: List[SpeechToTextTask]) -> str:
+        user_question = (
+            self._wait_for_audio_to_text_results(record) or self.default_question
+        )
+        self._stop_listening()
+        self._timeline.mark("stt_done")
+        self._prompts[-1]["question"] = user_question
+        print(f"INFO: user question: {user_question}")
+        return user_question
+
+    def end_recording(self) -> bool:
+        """
+        End the recording of the current turn as if the user stopped speaking, e.g. when
+        the user presses the hotkey while asking the question. Returns False once the
+        question is transcribed, the hotkey barges in then.
+        Called from another thread than the one running the turn.
+        """
+        with self._listening_lock:
+            if not self._listening:
+                return False
+            self._end_recording_event.set()
+            return True
+
+    def _start_listening(self) -> None:
+        with self._listening_lock:
+            self._end_recording_event.clear()
+            self._listening = True
 
-        audio_to_text_task = SpeechToTextTask(
-            task_id=self._get_task_id(TaskType.AUDIO_TO_TEXT, self._conversation_turn),
-            audio_data=audio_content,
+    def _stop_listening(self) -> None:
+        with self._listening_lock:
+            self._listening = False
+
+    def cancel_conversation(self) -> None:
+        """
+        Barge in: stop the current turn, e.g. when the user presses the hotkey while
+        the answer is playing. Generation is aborted, queued synthesis is dropped and
+        playback stops, so the backends are free for the next question.
+        Called from another thread than the one running start_conversation.
+        """
+        self._cancel_event.set()
+        METRICS.increment("cancelled.turns")
+        if self._llm_gen_tasks:
+            self.llm_manager.cancel_text_gen_task(self._llm_gen_tasks[-1].task_id)
+        self._cancel_text_to_audio_tasks()
+        self.audio_player.clear()
+
+    def _cancel_text_to_audio_tasks(self) -> None:
+        if self._text_to_audio_tasks:
+            self.audio_manager.cancel_text_to_audio_tasks(
+                [task.task_id for task in list(self._text_to_audio_tasks[-1])]
+            )
+
+    async def astart_conversation(self, pipeline: AsyncPipeline):
+        # Same turn as start_conversation, with stt, llm and tts run by the asyncio pipeline.
+        self._conversation_turn += 1
+        self._start_listening()
+        self._timeline = TurnTimeline(
+            turn_id=f"{self._conversation_id}_{self._conversation_turn}"
+        )
+        self._timeline.mark("turn_start")
+        print(
+            f"INFO: start conversation: id={self._conversation_id}, turn={self._conversation_turn} ..."
         )
-        self._audio_to_text_tasks.append(audio_to_text_task)
-        print("INFO: adding speech to text task ...")
-        self.audio_manager.add_audio_to_text_task(audio_to_text_task)
 
+        self._prompts.append({})
+        print("INFO: recording user audio input ...")
+        # Cancelling the turn does not stop the recording thread, the event does.
+        stop_recording = threading.Event()
+        try:
+            audio_content = await asyncio.to_thread(
+                record_audio,
+                device_index=1,
+                stop_event=stop_recording,
+                end_event=self._end_recording_event,
+            )
+        except asyncio.CancelledError:
+            stop_recording.set()
+            raise
+        self._timeline.mark("recording_end")
+        transcription = None
+        if audio_content is not None:
+            audio_content = await asyncio.to_thread(self._preprocess_speech, audio_content)
+            audio_to_text_task = SpeechToTextTask(
+                task_id=self._get_task_id(TaskType.AUDIO_TO_TEXT, self._conversation_turn),
+                audio_data=audio_content,
+            )
+            transcription = asyncio.ensure_future(pipeline.transcribe(audio_to_text_task))
+        # Reading the clipboard and indexing its context block, keep the loop serving
+        # the transcription meanwhile.
+        clipboard_text = await asyncio.to_thread(self._copy_from_clipboard)
+        prefill_task = await asyncio.to_thread(self._create_prefill_task, clipboard_text)
+        prefill = None
+        if prefill_task is not None:
+            # Not awaited, the generation request waits for it on the backend anyway.
+            prefill = asyncio.create_task(pipeline.prefill(prefill_task))
+        try:
+            # Nothing was recorded if recording failed.
+            user_question = (
+                transcription is not None and await transcription
+            ) or self.default_question
+            self._stop_listening()
+            self._timeline.mark("stt_done")
+            self._prompts[-1]["question"] = user_question
+            print(f"INFO: user question: {user_question}")
+
+            await asyncio.to_thread(self._prepare_context, clipboard_text, user_question)
+            llm_gen_task = LlmGenerationTask(
+                task_id=self._get_task_id(TaskType.LLM_GEN, self._conversation_turn),
+                **self._prompts[-1],
+            )
+            responses = []
+            try:
+                async for response, content in pipeline.speak(llm_gen_task):
+                    print(response)
+                    self._timeline.mark("first_tts_result")
+                    responses.append(response)
+                    if content is not None:
+                        await asyncio.to_thread(self._wait_for_audio_player)
+                        self.audio_player.enqueue(content, on_start=self._on_audio_start)
+            except asyncio.CancelledError:
+                # Barge in: cancelling the turn cancels generation and synthesis in the
+                # pipeline, drop what is already queued for playback.
+                print("INFO: conversation cancelled")
+                METRICS.increment("cancelled.turns")
+                self.audio_player.clear()
+                self.llm_manager.clean_up_text_gen_task(llm_gen_task)
+                raise
+            self._timeline.mark("llm_done")
+            first_token_time = self.llm_manager.get_first_token_time(llm_gen_task.task_id)
+            if first_token_time is not None:
+                self._timeline.mark("llm_first_token", first_token_time)
+            self.llm_manager.clean_up_text_gen_task(llm_gen_task)
+            if self._history is not None:
+                self._history.add(llm_gen_task.question, "".join(responses))
+            try:
+                await asyncio.to_thread(self.audio_player.wait_until_done)
+            except asyncio.CancelledError:
+                print("INFO: conversation cancelled")
+                METRICS.increment("cancelled.turns")
+                self.audio_player.clear()
+                raise
+            self._record_turn()
+        finally:
+            # Still running only if the turn was cancelled.
+            if prefill is not None:
+                prefill.cancel()
+
+    def _copy_from_clipboard(self) -> str:
         # Add copy from clipboard task. This copies context from clipboard.
         print("INFO: adding copy from clipboard task ...")
         copy_from_clipboard_task = CopyFromClipboardTask(
@@ -86,25 +406,92 @@ class ContextManager:
             task=copy_from_clipboard_task
         )
         self._prompts[-1]["context"] = clipboard_text
+        if self._timeline is not None:
+            self._timeline.mark("clipboard_read")
         print(f"INFO: context: {clipboard_text[:50]}")
+        return clipboard_text
 
-        # Get speech to text results.
-        # TODO: add a timeout.
-        while not self.audio_manager.has_audio_to_text_results(task=audio_to_text_task):
-            time.sleep(0.1)
-        user_question = (
-            self.audio_manager.get_audio_to_text_result(
-                task_id=audio_to_text_task.task_id
+    def _prepare_context(self, clipboard_text: str, question: str) -> None:
+        # The context is usually prepared by the clipboard watcher already.
+        context, history, follow_up_context = prompt_context(
+            clipboard_text,
+            question,
+            self._history,
+            self.text_manager.get_context_artifacts,
+            self.max_context_tokens,
+        )
+        self._prompts[-1]["context"] = context
+        if history is not None:
+            self._prompts[-1]["history"] = history
+            self._prompts[-1]["follow_up_context"] = follow_up_context
+
+    def _create_prefill_task(self, clipboard_text: str) -> LlmPrefillTask | None:
+        if not self.speculative_prefill:
+            return None
+        prefill = prefill_context(
+            clipboard_text,
+            self._history,
+            self.text_manager.get_context_artifacts,
+            self.max_context_tokens,
+        )
+        if prefill is None:
+            return None
+        context, history = prefill
+        return LlmPrefillTask(
+            task_id=self._get_task_id(TaskType.LLM_PREFILL, self._conversation_turn),
+            context=context,
+            history=history,
+        )
+
+    def _record_and_add_audio_to_text_tasks(self) -> List[SpeechToTextTask]:
+        # Each segment is queued as soon as it is recorded, so it is transcribed
+        # while the user keeps speaking.
+        tasks = []
+        segments = (
+            record_audio_segments(
+                device_index=1,
+                stop_event=self._cancel_event,
+                end_event=self._end_recording_event,
             )
-            or self.default_question
+            if self.record_segments is None
+            else self.record_segments()
         )
-        self._prompts[-1]["question"] = user_question
-        print(f"INFO: user question: {user_question}")
+        for index, audio_content in enumerate(segments, start=1):
+            if self._cancel_event.is_set():
+                # Barged in, nobody waits for the transcription.
+                break
+            task = SpeechToTextTask(
+                task_id=self._get_task_id(
+                    TaskType.AUDIO_TO_TEXT, self._conversation_turn, index
+                ),
+                audio_data=self._preprocess_speech(audio_content),
+            )
+            print(f"INFO: adding speech to text task for segment {index} ...")
+            self.audio_manager.add_audio_to_text_task(task)
+            tasks.append(task)
+        return tasks
 
-        self._generate_response()
-        self._play_response()
+    def _preprocess_speech(self, audio_content: bytes | None) -> bytes | None:
+        if self.speech_preprocess is None:
+            return audio_content
+        return preprocess_speech(audio_content, self.speech_preprocess)
 
-    def _generate_response(self):
+    def _wait_for_audio_to_text_results(self, tasks: List[SpeechToTextTask]) -> str:
+        texts = []
+        for task in tasks:
+            result = self.audio_manager.wait_for_audio_to_text_result(
+                task_id=task.task_id, timeout=self.audio_to_text_timeout
+            )
+            if result is None:
+                continue
+            if result.text:
+                texts.append(result.text.strip())
+            self.audio_manager.clean_up_audio_to_text_task(result)
+        return " ".join(texts)
+
+    def _generate_response(
+        self, on_text_to_audio_task: Callable[[TextToSpeechTask], None] | None = None
+    ):
         print("Info: generate response from llm ...")
         llm_gen_task = LlmGenerationTask(
             task_id=self._get_task_id(TaskType.LLM_GEN, self._conversation_turn),
@@ -112,45 +499,122 @@ class ContextManager:
         )
         self._llm_gen_tasks.append(llm_gen_task)
         self.llm_manager.add_text_gen_task(llm_gen_task)
+        if self._cancel_event.is_set():
+            # cancel_conversation ran before the task was appended, and cancelled the
+            # previous turn's task instead.
+            self.llm_manager.cancel_text_gen_task(llm_gen_task.task_id)
 
-        index, response = 0, ""
-        task_status = TaskStatus.UNKNOWN
         self._text_to_audio_tasks.append([])
-        while (
-            task_status := self.llm_manager.get_task_status(
-                task_id=llm_gen_task.task_id
-            )
-        ) and task_status != TaskStatus.UNKNOWN:
-            response = self.llm_manager.get_text_gen_result(
-                task_id=llm_gen_task.task_id, index=index
+        responses = []
+        for index, response in enumerate(
+            self.llm_manager.iter_text_gen_results(task_id=llm_gen_task.task_id),
+            start=1,
+        ):
+            if self._cancel_event.is_set():
+                break
+            print(response)
+            responses.append(response)
+            text_speech_task = TextToSpeechTask(
+                task_id=self._get_task_id(
+                    TaskType.TEXT_TO_AUDIO, self._conversation_turn, index
+                ),
+                text=response,
             )
-            if response is not None:
-                index += 1
-                print(response)
-                text_speech_task = TextToSpeechTask(
-                    task_id=self._get_task_id(
-                        TaskType.TEXT_TO_AUDIO, self._conversation_turn, index
-                    ),
-                    text=response,
-                )
-                self._text_to_audio_tasks[-1].append(text_speech_task)
-                self.audio_manager.add_text_to_audio_task(task=text_speech_task)
-            elif task_status == TaskStatus.FINISHED:
+            self._text_to_audio_tasks[-1].append(text_speech_task)
+            if not self._add_text_to_audio_task(text_speech_task):
                 break
+            if on_text_to_audio_task is not None:
+                on_text_to_audio_task(text_speech_task)
+        if self._cancel_event.is_set():
+            # Tasks added while cancel_conversation was running.
+            self._cancel_text_to_audio_tasks()
+            # Stops the llm from streaming an answer nobody hears.
+            self.llm_manager.cancel_text_gen_task(llm_gen_task.task_id)
+            self.llm_manager.clean_up_text_gen_task(llm_gen_task)
+            return
+        self._timeline.mark("llm_done")
+        first_token_time = self.llm_manager.get_first_token_time(llm_gen_task.task_id)
+        if first_token_time is not None:
+            self._timeline.mark("llm_first_token", first_token_time)
+        self.llm_manager.clean_up_text_gen_task(llm_gen_task)
+        if self._history is not None:
+            self._history.add(llm_gen_task.question, "".join(responses))
+
+    def _add_text_to_audio_task(self, task: TextToSpeechTask) -> bool:
+        # Blocks while the tts queue is full. Returns False if the turn was cancelled meanwhile.
+        while not self.audio_manager.add_text_to_audio_task(
+            task, timeout=TASK_WAIT_TIMEOUT
+        ):
+            if self._cancel_event.is_set():
+                return False
+        return True
 
-    def _play_response(self):
-        tasks = self._text_to_audio_tasks[-1]
+    def _wait_for_audio_player(self) -> None:
+        # Blocks while max_queued_chunks wait to be played, or until the turn is cancelled.
+        if self.max_queued_chunks is None:
+            return
+        while not self.audio_player.wait_until_queue_below(
+            self.max_queued_chunks, timeout=TASK_WAIT_TIMEOUT
+        ):
+            if self._cancel_event.is_set():
+                return
+
+    def _play_response(self, tasks: Iterable[TextToSpeechTask] | None = None):
+        if tasks is None:
+            tasks = self._text_to_audio_tasks[-1]
         for task in tasks:
-            while not self.audio_manager.has_text_to_audio_results(task=task):
-                time.sleep(0.1)
-            result = self.audio_manager.get_text_to_audio_result(task.task_id)
+            self._wait_for_audio_player()
+            result = self.audio_manager.wait_for_text_to_audio_result(task.task_id)
+            if self._cancel_event.is_set():
+                break
+            self._timeline.mark("first_tts_result")
             if isinstance(result, TextToSpeechResultChatTTS):
                 print(f"Info: total #{len(result.file_urls)} generated")
                 for j, url in enumerate(result.file_urls):
                     print(f"Info: play audio file {j}th, url: {url}...")
-                    play_audio(url=url)
+                    content = fetch_audio_from_url(url=url)
+                    if content is not None:
+                        self.audio_player.enqueue(
+                            content, on_start=self._on_audio_start
+                        )
             elif isinstance(result, TextToSpeechResultMeloTTS):
-                play_audio(url=None, content=result.content)
+                if result.audio_stream is not None:
+                    # Still downloading, plays as it arrives.
+                    self.audio_player.enqueue_stream(
+                        result.audio_stream, on_start=self._on_audio_start
+                    )
+                elif result.content is not None:
+                    self.audio_player.enqueue(
+                        result.content, on_start=self._on_audio_start
+                    )
+            if result is not None:
+                # The player holds its own reference to the audio.
+                self.audio_manager.clean_up_text_to_audio_task(result)
+        if self._cancel_event.is_set():
+            # Drop chunks enqueued while cancel_conversation was running.
+            self.audio_player.clear()
+        # Chunks play back to back in the background, wait for the last one.
+        self.audio_player.wait_until_done()
+        print(f"INFO: playback stats: {self.audio_player.stats()}")
+
+    def result_store_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            **self.audio_manager.result_store_stats(),
+            **self.llm_manager.result_store_stats(),
+            "copy_results": self.text_manager.copy_results.stats(),
+        }
+
+    def _on_audio_start(self) -> None:
+        # Called by the audio player when a chunk starts playing.
+        self._timeline.mark("first_audio_played")
+
+    def _record_turn(self) -> None:
+        self._timeline.mark("last_audio_played")
+        stages = METRICS.record_turn(self._timeline)
+        print(
+            "INFO: turn latencies: "
+            + ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in stages.items())
+        )
 
     def _get_task_id(
         self, task_type: TaskType, turn: int, index: None | int = None
@@ -162,41 +626,122 @@ class ContextManager:
 
     def clear(self) -> None:
         # Clean up resources used.
-        pass
+        self.text_manager.stop_clipboard_watcher()
+        self.audio_player.stop()
 
 
 def start_services(
     context_manager: ContextManager,
     tts_service_type: TTSServiceType = TTSServiceType.CHAT_TTS,
+    num_tts_workers: int = 1,
+    tts_urls: List[str] | None = None,
+    tts_cache: TTSCache | None = None,
+    llm_response_cache: LlmResponseCache | None = None,
+    stt_urls: List[str] | None = None,
+    llm_urls: List[str] | None = None,
+    stream_tts_audio: bool = True,
+    hedge_percentile: float | None = None,
+    stt_admission: AdmissionLimits | None = None,
+    tts_admission: AdmissionLimits | None = None,
+    llm_admission: AdmissionLimits | None = None,
 ) -> List[Tuple[Any, threading.Thread]]:
-    stt_service = STTService(context_manager.audio_manager)
+    # Services use their default backend urls unless given. Requests to several urls
+    # of a service are balanced by a backend pool. With hedge_percentile, stt and tts
+    # requests slower than that percentile of recent ones are sent a second time.
+    # The admission limits cap the requests in flight and per second to each backend.
+    stt_service = STTService(
+        context_manager.audio_manager,
+        backend_pool=create_backend_pool(stt_urls),
+        hedge=create_hedge_policy("stt", hedge_percentile),
+        admission=stt_admission,
+        **({} if not stt_urls else {"url": stt_urls[0]}),
+    )
     stt_thread = threading.Thread(target=stt_service.run)
     stt_thread.start()
 
-    if tts_service_type == TTSServiceType.CHAT_TTS:
-        tts_service = TTSServiceChatTTS(context_manager.audio_manager)
-    elif tts_service_type == TTSServiceType.MELO_TTS:
-        tts_service = TTSServiceMeloTTS(context_manager.audio_manager)
-    else:
-        raise Exception(f"TTSServiceType: {tts_service_type.Name} not supported")
-    tts_thread = threading.Thread(target=tts_service.run)
-    tts_thread.start()
+    tts_backend_pool = (
+        create_backend_pool(tts_urls)
+        if tts_service_type == TTSServiceType.MELO_TTS
+        else None
+    )
+    tts_services = start_tts_pool(
+        audio_manager=context_manager.audio_manager,
+        tts_service_type=tts_service_type,
+        num_workers=num_tts_workers,
+        urls=tts_urls,
+        cache=tts_cache,
+        stream_audio=stream_tts_audio,
+        backend_pool=tts_backend_pool,
+        hedge=create_hedge_policy("tts", hedge_percentile),
+        admission=tts_admission,
+    )
 
-    llm_service = LLMService(context_manager.llm_manager)
+    llm_service = LLMService(
+        context_manager.llm_manager,
+        backend_pool=create_backend_pool(llm_urls),
+        admission=llm_admission,
+        **({} if not llm_urls else {"ollama_base_url": llm_urls[0]}),
+    )
+    if llm_response_cache is not None:
+        llm_response_cache.namespace = llm_service.generation_config
+        context_manager.llm_manager.response_cache = llm_response_cache
     llm_thread = threading.Thread(target=llm_service.run)
     llm_thread.start()
 
     return [
         (stt_service, stt_thread),
-        (tts_service, tts_thread),
+        *tts_services,
         (llm_service, llm_thread),
     ]
 
 
+def create_async_pipeline(
+    context_manager: ContextManager,
+    tts_cache: TTSCache | None = None,
+    llm_response_cache: LlmResponseCache | None = None,
+    stt_urls: List[str] | None = None,
+    tts_urls: List[str] | None = None,
+    llm_urls: List[str] | None = None,
+    hedge_percentile: float | None = None,
+    stt_admission: AdmissionLimits | None = None,
+    tts_admission: AdmissionLimits | None = None,
+    llm_admission: AdmissionLimits | None = None,
+) -> AsyncPipeline:
+    # Asyncio alternative to start_services. Call AsyncPipeline.start on the event loop.
+    stt_kwargs = {} if not stt_urls else {"url": stt_urls[0]}
+    tts_kwargs = {} if not tts_urls else {"url": tts_urls[0]}
+    llm_kwargs = {} if not llm_urls else {"ollama_base_url": llm_urls[0]}
+    return AsyncPipeline(
+        stt_service=STTService(
+            context_manager.audio_manager,
+            backend_pool=create_backend_pool(stt_urls),
+            hedge=create_hedge_policy("stt", hedge_percentile),
+            admission=stt_admission,
+            **stt_kwargs,
+        ),
+        tts_service=TTSServiceMeloTTS(
+            context_manager.audio_manager,
+            cache=tts_cache,
+            backend_pool=create_backend_pool(tts_urls),
+            hedge=create_hedge_policy("tts", hedge_percentile),
+            admission=tts_admission,
+            **tts_kwargs,
+        ),
+        llm_service=LLMService(
+            context_manager.llm_manager,
+            backend_pool=create_backend_pool(llm_urls),
+            admission=llm_admission,
+            **llm_kwargs,
+        ),
+        llm_response_cache=llm_response_cache,
+    )
+
+
 def stop_services(services: List[Tuple[Any, threading.Thread]]) -> None:
     for service, thread in services:
         service.stop()
         thread.join()
+    close_sessions()
 
 
 def stop_stt(stt_service: STTService, thread: threading.Thread) -> None:
@@ -0,0 +1,125 @@
+from dataclasses import dataclass
+from typing import Callable, List, Tuple
+
+from common.metrics import METRICS
+from text.retrieval import (
+    ContextArtifacts,
+    estimate_num_tokens,
+    hash_text,
+    retrieve_context,
+    retrieve_follow_up_context,
+)
+
+# Previous (question, response) turns sent with a question, oldest first.
+History = Tuple[Tuple[str, str], ...]
+# Share of the context budget kept for passages retrieved for follow up questions, when
+# the context does not fit as a whole.
+FOLLOW_UP_CONTEXT_SHARE = 0.25
+
+
+@dataclass
+class ConversationHistory:
+    """
+    Previous turns about one context, sent along with follow up questions in multi turn
+    mode. The context the first turn was answered with is reused as is for follow ups,
+    so the prompt keeps system prompt and context as a stable prefix, and ollama can
+    reuse its prompt cache. Passages a follow up question needs beyond that context are
+    sent along with the question.
+    """
+
+    # Max tokens of previous turns sent with a question.
+    max_tokens: int = 1024
+
+    def __post_init__(self):
+        self.turns: List[Tuple[str, str]] = []
+        # Context sent with the turns, and the hash of the text it was prepared from.
+        self.context: str | None = None
+        self._context_hash: str | None = None
+
+    def is_follow_up(self, context_text: str) -> bool:
+        return self.context is not None and hash_text(context_text) == self._context_hash
+
+    def start(self, context_text: str, context: str) -> None:
+        # A new context, previous turns are about something else.
+        self.turns = []
+        self.context = context
+        self._context_hash = hash_text(context_text)
+
+    def add(self, question: str, response: str) -> None:
+        self.turns.append((question, response))
+
+    def get(self) -> History:
+        # Once over budget, drop the oldest turns down to half the budget, so the
+        # prompt after the context only changes every few turns.
+        num_tokens = sum(
+            estimate_num_tokens(question) + estimate_num_tokens(response)
+            for question, response in self.turns
+        )
+        if num_tokens > self.max_tokens:
+            while self.turns and num_tokens > self.max_tokens // 2:
+                question, response = self.turns.pop(0)
+                num_tokens -= estimate_num_tokens(question) + estimate_num_tokens(
+                    response
+                )
+        return tuple(self.turns)
+
+
+def prompt_context(
+    context_text: str,
+    question: str,
+    history: ConversationHistory | None,
+    get_artifacts: Callable[[str], ContextArtifacts],
+    max_context_tokens: int | None,
+) -> Tuple[str, History | None, str | None]:
+    """
+    Context, history and follow up context of the prompt answering question about
+    context_text. Only the passages most relevant to the question are sent, within
+    max_context_tokens, and the history starts over. A follow up reuses the history's
+    context, and adds the passages relevant to the new question that it lacks.
+    history is None in single turn mode, max_context_tokens None sends the whole context.
+    """
+    if history is not None and history.is_follow_up(context_text):
+        follow_up_context = None
+        if max_context_tokens is not None:
+            follow_up_context = retrieve_follow_up_context(
+                artifacts=get_artifacts(context_text),
+                question=question,
+                sent_context=history.context,
+                max_tokens=max_context_tokens - estimate_num_tokens(history.context),
+            )
+        return history.context, history.get(), follow_up_context or None
+    context = context_text
+    if max_context_tokens is not None:
+        artifacts = get_artifacts(context_text)
+        max_tokens = max_context_tokens
+        if history is not None and artifacts.num_tokens > max_context_tokens:
+            # Leave room for the passages of follow up questions.
+            max_tokens -= int(max_context_tokens * FOLLOW_UP_CONTEXT_SHARE)
+        context = retrieve_context(
+            artifacts=artifacts, question=question, max_tokens=max_tokens
+        )
+    if history is None:
+        return context, None, None
+    history.start(context_text, context)
+    return context, (), None
+
+
+def prefill_context(
+    context_text: str,
+    history: ConversationHistory | None,
+    get_artifacts: Callable[[str], ContextArtifacts],
+    max_context_tokens: int | None,
+) -> Tuple[str, History | None] | None:
+    # Mirrors prompt_context before the question is known. The prompt prefix is only
+    # known if the context does not depend on the question: a follow up on the same
+    # context, or a context that fits without retrieval. Returns None otherwise.
+    if history is not None and history.is_follow_up(context_text):
+        return history.context, history.get()
+    context = context_text
+    if max_context_tokens is not None:
+        artifacts = get_artifacts(context_text)
+        if artifacts.num_tokens > max_context_tokens:
+            METRICS.increment("llm.prefill.skipped")
+            return None
+        context = artifacts.text
+    return context, () if history is not None else None
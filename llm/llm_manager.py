@@ -1,14 +1,39 @@
 from asyncio import Task
 from dataclasses import dataclass, field
 from enum import Enum
-from queue import Queue
-from typing import Dict, List
+from queue import Empty, Full, Queue
+import threading
+from typing import Dict, Iterator, Tuple
+
+from common.metrics import METRICS
+from common.result_store import ResultStore
+from llm.response_cache import LlmResponseCache
+
+# How long workers block waiting for a task before re-checking their stop event.
+TASK_WAIT_TIMEOUT = 0.5
+# Max tasks waiting for the llm. Further tasks are rejected rather than queued for minutes.
+MAX_PENDING_TEXT_GEN_TASKS = 32
 
 @dataclass(frozen=True)
 class LlmGenerationTask:
     task_id: str
     context: str
     question: str
+    # Previous (question, response) turns about the same context, oldest first.
+    # None uses the single turn prompt.
+    history: Tuple[Tuple[str, str], ...] | None = None
+    # Passages retrieved for a follow up question which are not in context, sent along
+    # with the question, so the prompt up to the question stays the same.
+    follow_up_context: str | None = None
+
+@dataclass(frozen=True)
+class LlmPrefillTask:
+    # Speculative warm-up: the prompt of a generation task without its question, sent
+    # while the question is still being transcribed, so the backend has loaded the
+    # model and cached the prompt prefix by the time the question arrives.
+    task_id: str
+    context: str
+    history: Tuple[Tuple[str, str], ...] | None = None
 
 @dataclass(frozen=True)
 class LlmGenerationResult:
@@ -20,30 +45,100 @@ class TaskStatus(Enum):
     RUNNING = 2
     FINISHED = 3
     UNKNOWN = 4
+    FAILED = 5
+    CANCELLED = 6
+
+
+# Statuses after which no more results are saved for a task.
+FINAL_TASK_STATUSES = (
+    TaskStatus.FINISHED,
+    TaskStatus.UNKNOWN,
+    TaskStatus.FAILED,
+    TaskStatus.CANCELLED,
+)
 
 @dataclass
 class LlmManager:
-    # Buffer for text generation tasks. We pop up the front element to process.
-    text_gen_tasks: Queue[LlmGenerationTask] = field(default_factory=Queue)
+    # Buffer for text generation and prefill tasks. We pop up the front element to process.
+    text_gen_tasks: Queue[LlmGenerationTask | LlmPrefillTask] = field(default_factory=lambda: Queue(maxsize=MAX_PENDING_TEXT_GEN_TASKS))
     # Buffer for generated responsese. We use id to consume the response.
     # { task_id: [LlmGenerationResult] ...}
-    text_gen_results: Dict[str, List[LlmGenerationResult]] = field(default_factory=dict)
+    text_gen_results: ResultStore = field(default_factory=lambda: ResultStore(ttl=600.0, max_entries=256))
     # Buffer for task status.
-    text_gen_tasks_status: Dict[str, TaskStatus] = field(default_factory=dict)
+    # { task_id: TaskStatus ...}
+    text_gen_tasks_status: ResultStore = field(default_factory=lambda: ResultStore(ttl=600.0, max_entries=1024))
+    # Ids of cancelled tasks. Kept apart from the statuses, which consumers release.
+    cancelled_text_gen_tasks: ResultStore = field(default_factory=lambda: ResultStore(ttl=600.0, max_entries=1024))
+    # Notified whenever a result or a status is saved, so consumers can block instead of polling.
+    results_condition: threading.Condition = field(default_factory=threading.Condition, repr=False)
+    # When the first token of each task arrived, see common.metrics.now.
+    # { task_id: timestamp ...}
+    text_gen_first_token_times: ResultStore = field(default_factory=lambda: ResultStore(ttl=600.0, max_entries=1024))
+    # Cache of finished responses. None disables caching.
+    response_cache: LlmResponseCache | None = None
+    # Cache keys of tasks that missed the cache, to store their responses once finished.
+    # { task_id: key ...}
+    response_cache_keys: Dict[str, str] = field(default_factory=dict)
+    # Seconds a generation task waits for room in a full queue before it fails.
+    admission_timeout: float = 5.0
+    # Responses generated ahead of the consumer of a task. The service waits while
+    # they are not consumed, so a consumer held back by tts holds back the llm.
+    # None does not wait.
+    max_unconsumed_text_gen_results: int | None = 4
+    # Responses the consumer of each task has read.
+    # { task_id: count ...}
+    text_gen_results_consumed: ResultStore = field(default_factory=lambda: ResultStore(ttl=600.0, max_entries=1024))
 
     def add_text_gen_task(self, task: LlmGenerationTask) -> None:
-        self.text_gen_tasks.put(task)
-        self.text_gen_results[task.task_id] = []
+        if self.response_cache is not None:
+            key = self.response_cache.make_key(task)
+            cached_responses = self.response_cache.get(key)
+            if cached_responses is not None:
+                # Replay the cached responses, the task never reaches the llm.
+                with self.results_condition:
+                    self.text_gen_results[task.task_id] = [
+                        LlmGenerationResult(task=task, response=response) for response in cached_responses
+                    ]
+                self.set_task_status(task_id=task.task_id, status=TaskStatus.FINISHED)
+                return
+            self.response_cache_keys[task.task_id] = key
+        with self.results_condition:
+            self.text_gen_results[task.task_id] = []
         self.set_task_status(task_id=task.task_id, status=TaskStatus.PENDING)
+        try:
+            self.text_gen_tasks.put(task, timeout=self.admission_timeout)
+        except Full:
+            # Overloaded: fail fast, consumers waiting on the task see it failed.
+            print(f"Error adding text generation task {task.task_id}: llm queue full")
+            METRICS.increment("admission.rejected.llm_tasks")
+            self.response_cache_keys.pop(task.task_id, None)
+            self.set_task_status(task_id=task.task_id, status=TaskStatus.FAILED)
     
-    def get_text_gen_task(self) -> None | LlmGenerationTask:
-        if self.has_pending_text_gen_tasks():
-            return self.text_gen_tasks.get()
-        else:
+    def add_prefill_task(self, task: LlmPrefillTask) -> None:
+        # Queued ahead of the generation task it warms up, no results or status are kept.
+        # Only speculative, dropped if the queue is full.
+        try:
+            self.text_gen_tasks.put_nowait(task)
+        except Full:
+            METRICS.increment("admission.rejected.llm_prefill")
+
+    def get_text_gen_task(self, timeout: float | None = None) -> None | LlmGenerationTask | LlmPrefillTask:
+        # Non-blocking when timeout is None, otherwise wait up to timeout seconds.
+        try:
+            if timeout is None:
+                return self.text_gen_tasks.get_nowait()
+            return self.text_gen_tasks.get(timeout=timeout)
+        except Empty:
             return None
     
     def save_text_gen_task(self, result: LlmGenerationResult) -> None:
-        self.text_gen_results[result.task.task_id].append(result)
+        with self.results_condition:
+            results = self.text_gen_results.get(result.task.task_id)
+            if results is None:
+                # Already released, e.g. the task was cancelled and cleaned up.
+                return
+            results.append(result)
+            self.results_condition.notify_all()
     
     def has_pending_text_gen_tasks(self) -> bool:
         return self.num_pending_text_gen_tasks() > 0
@@ -62,17 +157,104 @@ class LlmManager:
             return self.text_gen_results[task_id][index].response
         else:
             return None
+
+    def wait_for_text_gen_result(self, task_id: str, index: int, timeout: float | None = None) -> None | str:
+        # Block until the index-th response is saved or the task finishes. Returns None if there is no such response.
+        def _ready() -> bool:
+            return (
+                len(self.text_gen_results.get(task_id, [])) > index
+                or self.get_task_status(task_id) in FINAL_TASK_STATUSES
+            )
+
+        with self.results_condition:
+            self.results_condition.wait_for(_ready, timeout=timeout)
+            result = self.get_text_gen_result(task_id=task_id, index=index)
+            if result is not None and self.max_unconsumed_text_gen_results is not None:
+                self.text_gen_results_consumed[task_id] = index + 1
+                self.results_condition.notify_all()
+            return result
+
+    def wait_for_text_gen_room(self, task_id: str, timeout: float | None = None) -> bool:
+        # Block while max_unconsumed_text_gen_results responses of the task wait for its
+        # consumer. Returns False on timeout. Released and cancelled tasks never wait.
+        if self.max_unconsumed_text_gen_results is None:
+            return True
+
+        def _has_room() -> bool:
+            results = self.text_gen_results.get(task_id)
+            return (
+                results is None
+                or self.is_cancelled(task_id)
+                or len(results) - self.text_gen_results_consumed.get(task_id, 0)
+                < self.max_unconsumed_text_gen_results
+            )
+
+        with self.results_condition:
+            return self.results_condition.wait_for(_has_room, timeout=timeout)
+
+    def iter_text_gen_results(self, task_id: str, timeout: float | None = None) -> Iterator[str]:
+        # Yield responses in order as they are generated, until the task finishes.
+        # timeout applies to the wait for each response.
+        index = 0
+        while (response := self.wait_for_text_gen_result(task_id=task_id, index=index, timeout=timeout)) is not None:
+            index += 1
+            yield response
     
+    def set_first_token_time(self, task_id: str, timestamp: float) -> None:
+        self.text_gen_first_token_times[task_id] = timestamp
+
+    def get_first_token_time(self, task_id: str) -> None | float:
+        return self.text_gen_first_token_times.get(task_id)
+
     def set_task_status(self, task_id: str, status: TaskStatus) -> None:
-        self.text_gen_tasks_status[task_id] = status
+        with self.results_condition:
+            if self.is_cancelled(task_id):
+                # A cancelled task stays cancelled, whatever the service reports afterwards.
+                return
+            # Cache before notifying, consumers may release the results right after.
+            if status in FINAL_TASK_STATUSES and task_id in self.response_cache_keys:
+                key = self.response_cache_keys.pop(task_id)
+                # Only complete responses are cached.
+                if status == TaskStatus.FINISHED and self.text_gen_results.get(task_id):
+                    self.response_cache.put(
+                        key, tuple(result.response for result in self.text_gen_results[task_id])
+                    )
+            self.text_gen_tasks_status[task_id] = status
+            self.results_condition.notify_all()
     
+    def cancel_text_gen_task(self, task_id: str) -> bool:
+        # Stop generation, e.g. when the user interrupts the answer. Consumers stop
+        # waiting right away, the service stops at the next streamed token.
+        # Returns False if the task had already ended.
+        with self.results_condition:
+            if self.get_task_status(task_id) in FINAL_TASK_STATUSES:
+                return False
+            self.set_task_status(task_id=task_id, status=TaskStatus.CANCELLED)
+            self.cancelled_text_gen_tasks[task_id] = True
+            return True
+
+    def is_cancelled(self, task_id: str) -> bool:
+        return task_id in self.cancelled_text_gen_tasks
+
     def get_task_status(self, task_id: str) -> TaskStatus:
         if task_id in self.text_gen_tasks_status:
             return self.text_gen_tasks_status[task_id]
         return TaskStatus.UNKNOWN
     
-    def clean_up_text_gen_task(self, result: LlmGenerationResult) -> None:
-        # Delete responses.
-        task_id = result.task.task_id
-        if task_id in self.text_gen_results:
-            del self.text_gen_results
\ No newline at end of file
+    def clean_up_text_gen_task(self, task: LlmGenerationTask) -> None:
+        # Release responses and bookkeeping of a consumed task.
+        with self.results_condition:
+            self.text_gen_results.pop(task.task_id)
+            self.text_gen_tasks_status.pop(task.task_id)
+            self.text_gen_first_token_times.pop(task.task_id)
+            self.text_gen_results_consumed.pop(task.task_id)
+            # The service may wait for room in the released results.
+            self.results_condition.notify_all()
+
+    def result_store_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            "text_gen_results": self.text_gen_results.stats(),
+            "text_gen_tasks_status": self.text_gen_tasks_status.stats(),
+            "text_gen_first_token_times": self.text_gen_first_token_times.stats(),
+            "text_gen_results_consumed": self.text_gen_results_consumed.stats(),
+        }
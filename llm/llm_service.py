@@ -1,15 +1,29 @@
 from dataclasses import dataclass, field
+import hashlib
 import re
 import threading
-from typing import Tuple
+from typing import Dict, List, Tuple
 from langchain_community.chat_models import ChatOllama
-from llm.prompt_util import ASSISTANT_PROMPT, SYSTEM_PROMPT, SYSTEM_ROLE, USER_INPUT, USER_PROMPT
-from llm.llm_manager import LlmManager, LlmGenerationTask, LlmGenerationResult, TaskStatus
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from llm.prompt_util import (
+    ASSISTANT_PROMPT,
+    ASSISTANT_RESPONSE,
+    CONTEXT_INPUT,
+    FOLLOW_UP_INPUT,
+    QUESTION_INPUT,
+    SYSTEM_PROMPT,
+    SYSTEM_ROLE,
+    USER_INPUT,
+    USER_PROMPT,
+)
+from common.admission import AdmissionLimits, Overloaded
+from common.backend_pool import BackendPool, alease_backend, lease_backend
+from common.metrics import METRICS, now
+from llm.segmenter import SentenceSegmenter
+from llm.llm_manager import TASK_WAIT_TIMEOUT, LlmManager, LlmGenerationTask, LlmGenerationResult, LlmPrefillTask, TaskStatus
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
-SENTENCE_END_PATTERN = r'[A-Za-z]+[\.\?\!]$'
-
 # Remove list numbering, e.g. 1., 2. etc.
 # Remove '*'
 CLEAN_LLM_RESPONSE_PATTERN = r'^\d+\.\s*|\*'
@@ -22,11 +36,25 @@ class LLMService:
     model_temparature: float = field(default=0.7)
     stop_event: threading.Event = field(default_factory=threading.Event)
     system_prompt: str = field(default=SYSTEM_ROLE)
-    stream_first_chunk_min_num_tokens_to_emit: int = field(default=50)
-    stream_min_num_tokens_to_emit: int = field(default=1000)
+    # Target seconds from sending the request until the first chunk is synthesized.
+    # The first chunk is cut short (a clause, or even mid clause) to meet it.
+    first_audio_latency: float = field(default=1.0)
+    # Estimated tts synthesis speed, used to size the first chunk.
+    tts_chars_per_second: float = field(default=100.0)
+    # Max characters of one emitted chunk.
+    max_chunk_chars: int = field(default=600)
+    # How long ollama keeps the model, and with it the prompt cache, loaded after a request.
+    model_keep_alive: str = field(default="30m")
+    # Tokens generated by a prefill request. ollama needs at least one to process the prompt.
+    prefill_num_predict: int = field(default=1)
+    # Routes each request to one of several ollama backends instead of ollama_base_url.
+    # Requests about the same context stick to one backend, which has it cached.
+    backend_pool: BackendPool | None = field(default=None)
+    # Concurrency and rate limits per backend. Requests not admitted in time fail the task.
+    admission: AdmissionLimits | None = field(default=None)
 
     def __post_init__(self):
-        self.llm = ChatOllama(model=self.model_name, temperaturaaae=self.model_temparature, base_url=self.ollama_base_url)
+        self.llm = ChatOllama(model=self.model_name, temperature=self.model_temparature, base_url=self.ollama_base_url, keep_alive=self.model_keep_alive)
         self.prompt = ChatPromptTemplate.from_messages(
             [
                 ("system", SYSTEM_PROMPT.format(prompt=self.system_prompt)),
@@ -35,49 +63,179 @@ class LLMService:
             ]
         )
         self.chain = self.prompt | self.llm | StrOutputParser()
+        # { base url: model } for the backends of backend_pool.
+        self._llms: Dict[str, ChatOllama] = {self.ollama_base_url: self.llm}
 
     def run(self, streaming=False):
         while not self.stop_event.is_set():
-            if self.llm_manager.has_pending_text_gen_tasks():
-                task = self.llm_manager.get_text_gen_task()
-                if task is not None:
-                    self.llm_manager.set_task_status(task_id=task.task_id, status=TaskStatus.RUNNING)
+            task = self.llm_manager.get_text_gen_task(timeout=TASK_WAIT_TIMEOUT)
+            if isinstance(task, LlmPrefillTask):
+                if self.llm_manager.has_pending_text_gen_tasks():
+                    # The question is already queued and prefills the same prefix itself.
+                    METRICS.increment("llm.prefill.skipped", backend=self.ollama_base_url)
+                else:
+                    self.prefill(task)
+            elif task is not None and self.llm_manager.is_cancelled(task.task_id):
+                # Cancelled while queued.
+                METRICS.increment("cancelled.llm", backend=self.ollama_base_url)
+            elif task is not None:
+                self.llm_manager.set_task_status(task_id=task.task_id, status=TaskStatus.RUNNING)
+                # Always end in a final status, otherwise consumers waiting on the task block forever.
+                try:
                     for response in self.convert(task):
                         self.llm_manager.save_text_gen_task(
                             LlmGenerationResult(task=task, response=response)
                         )
+                except Exception as e:
+                    print(f"Error generating response: {e}")
+                    self.llm_manager.set_task_status(task_id=task.task_id, status=TaskStatus.FAILED)
+                else:
                     self.llm_manager.set_task_status(task_id=task.task_id, status=TaskStatus.FINISHED)
 
     def convert(self, task: LlmGenerationTask):
-        text = ""
-        num_tokens, index = 0, 0
-        for chunk in self.chain.stream({"context": task.context, "question": task.question}):
-            text += chunk
-            num_tokens += 1
-            if self._should_emit(text, num_tokens, index):
-                yield self._process_text(text)
-                text = ""
-                num_tokens = 0
-                index += 1
-        if text:
-            yield text
+        with lease_backend(self.backend_pool, self.ollama_base_url, key=_affinity_key(task.context), limits=self.admission) as lease:
+            segmenter = self._create_segmenter()
+            start = now()
+            # Streams from the model directly: closing a chain's stream drains it, while
+            # closing the model's stream drops the connection, so ollama stops generating.
+            stream = self._get_llm(lease.url).stream(self._build_prompt(task))
+            try:
+                for num_chunks, chunk in enumerate(stream):
+                    if self.llm_manager.is_cancelled(task.task_id):
+                        METRICS.increment("cancelled.llm", backend=lease.url)
+                        return
+                    if num_chunks == 0:
+                        self._record_first_token(task, start, lease.url)
+                    for text in segmenter.feed(chunk.content):
+                        if (text := self._process_text(text)).strip():
+                            # Pauses the stream from the backend while the consumer
+                            # falls behind.
+                            self._wait_for_consumer(task)
+                            yield text
+            finally:
+                stream.close()
+            METRICS.observe("backend.llm", now() - start, backend=lease.url)
+        if (text := segmenter.flush()) is not None:
+            if (text := self._process_text(text)).strip():
+                yield text
+
+    def _wait_for_consumer(self, task: LlmGenerationTask) -> None:
+        while not self.llm_manager.wait_for_text_gen_room(task.task_id, timeout=TASK_WAIT_TIMEOUT):
+            if self.stop_event.is_set():
+                return
+
+    async def aconvert(self, task: LlmGenerationTask):
+        # Same as convert, streaming from the backend without blocking the event loop.
+        async with alease_backend(self.backend_pool, self.ollama_base_url, key=_affinity_key(task.context), limits=self.admission) as lease:
+            segmenter = self._create_segmenter()
+            start, num_chunks = now(), 0
+            async for chunk in self._get_llm(lease.url).astream(self._build_prompt(task)):
+                if num_chunks == 0:
+                    self._record_first_token(task, start, lease.url)
+                num_chunks += 1
+                for text in segmenter.feed(chunk.content):
+                    if (text := self._process_text(text)).strip():
+                        yield text
+            METRICS.observe("backend.llm", now() - start, backend=lease.url)
+        if (text := segmenter.flush()) is not None:
+            if (text := self._process_text(text)).strip():
+                yield text
+
+    def prefill(self, task: LlmPrefillTask) -> None:
+        # Errors are only logged, the generation task that follows will run into them anyway.
+        try:
+            with lease_backend(self.backend_pool, self.ollama_base_url, key=_affinity_key(task.context), limits=self.admission) as lease:
+                try:
+                    with METRICS.timer("backend.llm.prefill", backend=lease.url):
+                        self._get_llm(lease.url).invoke(self._build_prefill_prompt(task), num_predict=self.prefill_num_predict)
+                except Exception as e:
+                    print(f"Error prefilling prompt: {e}")
+                    METRICS.increment("backend.llm.prefill.errors", backend=lease.url)
+                    lease.fail()
+        except Overloaded:
+            # Only speculative, dropped rather than adding to the load.
+            METRICS.increment("llm.prefill.rejected", backend=self.ollama_base_url)
+
+    async def aprefill(self, task: LlmPrefillTask) -> None:
+        try:
+            async with alease_backend(self.backend_pool, self.ollama_base_url, key=_affinity_key(task.context), limits=self.admission) as lease:
+                try:
+                    with METRICS.timer("backend.llm.prefill", backend=lease.url):
+                        await self._get_llm(lease.url).ainvoke(self._build_prefill_prompt(task), num_predict=self.prefill_num_predict)
+                except Exception as e:
+                    print(f"Error prefilling prompt: {e}")
+                    METRICS.increment("backend.llm.prefill.errors", backend=lease.url)
+                    lease.fail()
+        except Overloaded:
+            METRICS.increment("llm.prefill.rejected", backend=self.ollama_base_url)
+
+    @property
+    def generation_config(self) -> Tuple[str, str, float]:
+        # Everything besides the task that determines the response.
+        return (self.model_name, self.system_prompt, self.model_temparature)
+
+    def _record_first_token(self, task: LlmGenerationTask, start: float, url: str) -> None:
+        first_token_time = now()
+        METRICS.observe("backend.llm.first_token", first_token_time - start, backend=url)
+        self.llm_manager.set_first_token_time(task_id=task.task_id, timestamp=first_token_time)
+
+    def _get_llm(self, url: str) -> ChatOllama:
+        if url not in self._llms:
+            self._llms[url] = ChatOllama(model=self.model_name, temperature=self.model_temparature, base_url=url, keep_alive=self.model_keep_alive)
+        return self._llms[url]
+
+    def _create_segmenter(self) -> SentenceSegmenter:
+        return SentenceSegmenter(
+            first_audio_latency=self.first_audio_latency,
+            tts_chars_per_second=self.tts_chars_per_second,
+            max_chunk_chars=self.max_chunk_chars,
+        )
+
+    def _build_prompt(self, task: LlmGenerationTask) -> List[BaseMessage]:
+        if task.history is None:
+            return self.prompt.format_messages(context=task.context, question=task.question)
+        return self._build_messages(task)
+
+    def _build_prefill_prompt(self, task: LlmPrefillTask) -> List[BaseMessage]:
+        # The generation prompt with an empty question. Everything up to the question is
+        # the same, so the backend's prompt cache covers it for the real request.
+        return self._build_prompt(
+            LlmGenerationTask(task_id=task.task_id, context=task.context, question="", history=task.history)
+        )
+
+    def _build_messages(self, task: LlmGenerationTask) -> List[BaseMessage]:
+        # System prompt, context, previous turns, then the question. Everything before the
+        # question is identical to the previous turn's prompt plus its answer, so the
+        # backend can reuse its cache for that prefix.
+        messages = [
+            SystemMessage(content=SYSTEM_PROMPT.format(prompt=self.system_prompt)),
+            HumanMessage(content=USER_PROMPT.format(prompt=CONTEXT_INPUT.format(context=task.context))),
+        ]
+        for question, response in task.history:
+            messages.append(HumanMessage(content=USER_PROMPT.format(prompt=QUESTION_INPUT.format(question=question))))
+            messages.append(AIMessage(content=ASSISTANT_RESPONSE.format(response=response)))
+        if task.follow_up_context:
+            question = FOLLOW_UP_INPUT.format(context=task.follow_up_context, question=task.question)
+        else:
+            question = QUESTION_INPUT.format(question=task.question)
+        messages.append(HumanMessage(content=USER_PROMPT.format(prompt=question)))
+        messages.append(AIMessage(content=ASSISTANT_PROMPT))
+        return messages
 
     def _process_text(self, text: str) -> str:
         # Remove the pattern from the beginning of each line
         cleaned_text = re.sub(CLEAN_LLM_RESPONSE_PATTERN, '', text, flags=re.MULTILINE)
         return cleaned_text
 
-    def _should_emit(self, text: str, num_tokens: int, index: int) -> bool:
-        min_num_tokens_to_emit = self.stream_first_chunk_min_num_tokens_to_emit if index > 0 else self.stream_first_chunk_min_num_tokens_to_emit
-        if num_tokens >= min_num_tokens_to_emit and self._is_end_of_sentence(text):
-            return True
-        return False
-    
-    def _is_end_of_sentence(self, text: str) -> bool:
-        return bool(re.search(SENTENCE_END_PATTERN, text))
-    
     def stop(self):
         self.stop_event.set()
+        if self.backend_pool is not None:
+            self.backend_pool.stop()
+
+
+def _affinity_key(context: str) -> str:
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()
+
     
 def start_llm(llm_manager: LlmManager) -> Tuple[LLMService, threading.Thread]:
     llm_service = LLMService(llm_manager)
@@ -92,8 +250,6 @@ def stop_llm(llm_service: LLMService, thread: threading.Thread) -> None:
 
 
 if __name__ == "__main__":
-    import time
-
     context = """LangChain is a framework designed to facilitate the development of applications that leverage large language models (LLMs). It is particularly useful for building complex and dynamic applications that need to integrate language models with other computational and data-handling processes. LangChain provides a suite of tools and abstractions to streamline the development of such applications, enabling developers to harness the power of LLMs in a more structured and scalable way.
 
 ### Key Features of LangChain
@@ -201,16 +357,9 @@ LangChain provides a powerful framework for building sophisticated applications
         task = LlmGenerationTask(task_id=str(i), context=context, question=question)
         llm_manager.add_text_gen_task(task)
 
-        index, response = 0, ""
-        task_status = TaskStatus.UNKNOWN
-        while (task_status := llm_manager.get_task_status(task_id=task.task_id)) and task_status != TaskStatus.UNKNOWN:
-            response = llm_manager.get_text_gen_result(task_id=task.task_id, index=index)
-            if response is not None:
-                index += 1
-                print(response, end="")
-            elif task_status == TaskStatus.FINISHED:
-                print("\n")
-                break
+        for response in llm_manager.iter_text_gen_results(task_id=task.task_id):
+            print(response, end="")
+        print("\n")
         print("----------------------------------------------------------------------------------")
 
     stop_llm(llm_service=llm_service, thread=thread)
@@ -24,3 +24,19 @@ QUESTION:
 <|eot_id|>"""
 
 ASSISTANT_PROMPT = """<|start_header_id|>assistant<|end_header_id|>"""
+
+
+# Multi turn layout: the context goes in its own message ahead of the questions, so the
+# system prompt and context form a prefix that stays the same across turns.
+CONTEXT_INPUT = """CONTEXTS:
+{context}"""
+QUESTION_INPUT = """QUESTION:
+{question}"""
+# A follow up question along with the passages retrieved for it, which are not part of
+# the context message.
+FOLLOW_UP_INPUT = """MORE CONTEXTS:
+{context}
+
+QUESTION:
+{question}"""
+ASSISTANT_RESPONSE = """<|start_header_id|>assistant<|end_header_id|>{response}<|eot_id|>"""
\ No newline at end of file
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Tuple
+
+from text.retrieval import hash_text
+
+if TYPE_CHECKING:
+    # llm_manager imports this module.
+    from llm.llm_manager import LlmGenerationTask
+
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+
+def normalize_question(question: str) -> str:
+    # "Summarize this." and "summarize  this" ask the same thing.
+    return " ".join(PUNCTUATION_PATTERN.sub(" ", question.lower()).split())
+
+
+@dataclass
+class LlmResponseCache:
+    """
+    Exact match cache of streamed responses, keyed on the context hash, the normalized
+    question, the history and the generation setup. Entries expire after ttl seconds and
+    the total size is bounded by max_bytes, evicting least recently used entries.
+    """
+
+    # Identifies the generation setup, e.g. (model name, system prompt, temperature).
+    namespace: Tuple = ()
+    ttl: float = 3600.0
+    max_bytes: int = 16 * 1024 * 1024
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        # { key: (expires at, chunks, size) } least recently used first.
+        self._entries: OrderedDict[str, Tuple[float, Tuple[str, ...], int]] = OrderedDict()
+        self._num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, task: "LlmGenerationTask") -> str:
+        raw_key = repr(
+            (
+                self.namespace,
+                hash_text(task.context),
+                normalize_question(task.question),
+                task.history,
+                task.follow_up_context,
+            )
+        )
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Tuple[str, ...] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, chunks: Tuple[str, ...]) -> None:
+        size = sum(len(chunk.encode("utf-8")) for chunk in chunks)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, chunks, size)
+            self._num_bytes += size
+            while self._num_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._num_bytes,
+            }
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self._num_bytes -= size
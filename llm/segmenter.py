@@ -0,0 +1,153 @@
+from dataclasses import dataclass, field
+from enum import Enum
+import time
+from typing import Callable, List
+
+CLAUSE_END_CHARS = frozenset(",;:")
+# Characters that may follow a sentence end, e.g. closing quotes or markdown emphasis.
+CLOSING_CHARS = "\"')]*_"
+
+# Words ending with "." that do not end a sentence. Lower case, without the last ".".
+ABBREVIATIONS = frozenset(
+    [
+        "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g", "i.e",
+        "eg", "ie", "fig", "no", "approx", "inc", "ltd", "co", "u.s", "a.m", "p.m",
+    ]
+)
+
+
+class Boundary(Enum):
+    WORD = 1
+    CLAUSE = 2
+    SENTENCE = 3
+
+
+@dataclass
+class SentenceSegmenter:
+    """
+    Incrementally splits streamed llm output into chunks for text to speech.
+
+    The first chunk is kept short so speech starts early: it ends at the first clause or
+    sentence boundary after min_first_chunk_chars, or at a word boundary after
+    min_word_chunk_chars once waiting longer would miss first_audio_latency. Later chunks end at sentence boundaries and grow
+    by chunk_growth up to max_chunk_chars, so synthesis stays ahead of playback while
+    each request carries more text.
+
+    Every character is scanned once, so segmenting a response is linear in its length.
+    """
+
+    # Target seconds from the first token until the first chunk is synthesized. Time to
+    # first token is not counted, waiting on a slow prefill is no reason to cut the
+    # first chunk short.
+    first_audio_latency: float = 1.0
+    # Estimated synthesis speed of the tts backend, in characters per second.
+    tts_chars_per_second: float = 100.0
+    min_first_chunk_chars: int = 12
+    # Shortest first chunk cut mid clause to meet first_audio_latency, a few words
+    # rather than a single one, which sounds choppy and costs a tts round trip.
+    min_word_chunk_chars: int = 40
+    chunk_growth: float = 2.0
+    max_chunk_chars: int = 600
+    clock: Callable[[], float] = field(default=time.monotonic, repr=False)
+
+    def __post_init__(self):
+        self._buffer: List[str] = []
+        # Whether _buffer has anything besides whitespace.
+        self._has_content = False
+        # Index in _buffer where the current word starts.
+        self._word_start = 0
+        # Whether the current word is the first one on its line, e.g. a list marker.
+        self._first_word_on_line = True
+        self._num_emitted = 0
+        self._target_chars = self.min_first_chunk_chars
+        # When the first text arrived.
+        self._start_time: float | None = None
+
+    def feed(self, text: str) -> List[str]:
+        # Add streamed text and return the chunks completed by it.
+        if self._start_time is None:
+            self._start_time = self.clock()
+        chunks = []
+        for char in text:
+            self._buffer.append(char)
+            if not char.isspace():
+                self._has_content = True
+                continue
+            boundary = self._end_word()
+            if char == "\n" and self._has_content:
+                # Line breaks separate paragraphs and list items.
+                boundary = Boundary.SENTENCE
+                self._first_word_on_line = True
+            if boundary is not None and self._has_content and self._should_emit(boundary):
+                chunks.append(self._emit())
+        return chunks
+
+    def flush(self) -> str | None:
+        # Return the remaining text at the end of the stream.
+        if not self._has_content:
+            self._buffer = []
+            self._word_start = 0
+            return None
+        return self._emit()
+
+    def _end_word(self) -> Boundary | None:
+        # Called on whitespace. Classify the word that just ended.
+        word = "".join(self._buffer[self._word_start : -1]).rstrip(CLOSING_CHARS)
+        first_word_on_line = self._first_word_on_line
+        self._word_start = len(self._buffer)
+        if not word:
+            return None
+        self._first_word_on_line = False
+        last_char = word[-1]
+        if last_char in "?!":
+            return Boundary.SENTENCE
+        if last_char == ".":
+            return Boundary.SENTENCE if self._is_sentence_end(word, first_word_on_line) else Boundary.WORD
+        if last_char in CLAUSE_END_CHARS:
+            return Boundary.CLAUSE
+        return Boundary.WORD
+
+    def _is_sentence_end(self, word: str, first_word_on_line: bool) -> bool:
+        stem = word.rstrip(".")
+        if word.endswith("..."):
+            # Ellipsis, the sentence usually goes on.
+            return False
+        if stem.lower() in ABBREVIATIONS:
+            return False
+        if len(stem) == 1 and stem.isalpha() and stem.isupper():
+            # Initial, e.g. "J. Smith".
+            return False
+        if first_word_on_line and stem.isdigit():
+            # List marker, e.g. "1. First step".
+            return False
+        return True
+
+    def _should_emit(self, boundary: Boundary) -> bool:
+        num_chars = len(self._buffer)
+        if self._num_emitted == 0:
+            if boundary != Boundary.WORD:
+                return num_chars >= self.min_first_chunk_chars
+            # Emit mid clause rather than miss the first audio latency target.
+            if num_chars < self.min_word_chunk_chars:
+                return False
+            elapsed = self.clock() - self._start_time
+            synthesis_time = num_chars / self.tts_chars_per_second
+            return elapsed + synthesis_time >= self.first_audio_latency
+        if boundary == Boundary.SENTENCE:
+            return num_chars >= self._target_chars
+        if boundary == Boundary.CLAUSE:
+            return num_chars >= self.max_chunk_chars
+        # Very long sentence without punctuation.
+        return num_chars >= 2 * self.max_chunk_chars
+
+    def _emit(self) -> str:
+        text = "".join(self._buffer)
+        self._target_chars = min(
+            max(int(len(text) * self.chunk_growth), self.min_first_chunk_chars),
+            self.max_chunk_chars,
+        )
+        self._num_emitted += 1
+        self._buffer = []
+        self._has_content = False
+        self._word_start = 0
+        return text
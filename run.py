@@ -1,24 +1,56 @@
+import asyncio
 import threading
-import time
+from typing import List
+from audio.tts_cache import TTSCache
 from audio.tts_service import TTSServiceType
-from context.context_manager import ContextManager, start_services, stop_services
+from common.metrics import start_metrics_server
+from llm.response_cache import LlmResponseCache
+from context.context_manager import (
+    ContextManager,
+    create_async_pipeline,
+    start_services,
+    stop_services,
+)
 from keys.util import (
     CONVERSATION_INPUT_START_STR,
     CONVERSATION_INPUT_START,
     monitor_keyboard_and_execute_func,
 )
 
+# Backend urls of each service. Requests to several urls are balanced between them,
+# e.g. ["http://192.168.1.26:11434", "http://192.168.1.27:11434"]. None uses the
+# service's default url.
+STT_URLS: List[str] | None = None
+TTS_URLS: List[str] | None = None
+LLM_URLS: List[str] | None = None
+# Port of the metrics server on 127.0.0.1, None disables it.
+METRICS_PORT: int | None = 9464
+
+
+def main(
+    tts_service_type: TTSServiceType = TTSServiceType.MELO_TTS, use_asyncio: bool = False
+):
+    if use_asyncio:
+        asyncio.run(main_async())
+        return
 
-def main(tts_service_type: TTSServiceType = TTSServiceType.MELO_TTS):
-    context_manager = ContextManager()
+    context_manager = ContextManager(
+        streaming_audio_to_text=True, watch_clipboard=True, multi_turn=True
+    )
     services = start_services(
-        context_manager=context_manager, tts_service_type=tts_service_type
+        context_manager=context_manager,
+        tts_service_type=tts_service_type,
+        tts_cache=TTSCache(),
+        llm_response_cache=LlmResponseCache(),
+        stt_urls=STT_URLS,
+        tts_urls=TTS_URLS,
+        llm_urls=LLM_URLS,
     )
+    # Per stage latencies on http://127.0.0.1:<METRICS_PORT>/metrics
+    metrics_server = start_metrics_server(port=METRICS_PORT)
     start_conversation_flag = threading.Event()
-
-    def _wait():
-        while not start_conversation_flag.is_set():
-            time.sleep(0.1)
+    # Turns run in the background, so the hotkey can interrupt them.
+    conversation: threading.Thread | None = None
 
     try:
         while True:
@@ -26,14 +58,75 @@ def main(tts_service_type: TTSServiceType = TTSServiceType.MELO_TTS):
             monitor_keyboard_and_execute_func(
                 expected_keys=CONVERSATION_INPUT_START,
                 stop_flag=start_conversation_flag,
-                func=_wait,
+                func=start_conversation_flag.wait,
             )
+            if conversation is not None and conversation.is_alive():
+                if context_manager.end_recording():
+                    # Still asking the question, the key ends the recording.
+                    start_conversation_flag.clear()
+                    continue
+                # Barge in: drop the current answer and listen right away.
+                context_manager.cancel_conversation()
+                conversation.join()
             # Start conversation
-            context_manager.start_conversation()
+            conversation = threading.Thread(target=context_manager.start_conversation)
+            conversation.start()
             start_conversation_flag.clear()
     finally:
+        if conversation is not None and conversation.is_alive():
+            context_manager.cancel_conversation()
+            conversation.join()
         stop_services(services=services)
         context_manager.clear()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+
+async def main_async():
+    # Runs stt, llm and tts on one event loop instead of a thread per service.
+    context_manager = ContextManager(watch_clipboard=True, multi_turn=True)
+    pipeline = create_async_pipeline(
+        context_manager=context_manager,
+        tts_cache=TTSCache(),
+        llm_response_cache=LlmResponseCache(),
+        stt_urls=STT_URLS,
+        tts_urls=TTS_URLS,
+        llm_urls=LLM_URLS,
+    )
+    await pipeline.start()
+    metrics_server = start_metrics_server(port=METRICS_PORT)
+    start_conversation_flag = threading.Event()
+    conversation: asyncio.Task | None = None
+
+    try:
+        while True:
+            print(f"print key '{CONVERSATION_INPUT_START_STR}' to start conversation!")
+            await asyncio.to_thread(
+                monitor_keyboard_and_execute_func,
+                expected_keys=CONVERSATION_INPUT_START,
+                stop_flag=start_conversation_flag,
+                func=start_conversation_flag.wait,
+            )
+            if conversation is not None and not conversation.done():
+                if context_manager.end_recording():
+                    # Still asking the question, the key ends the recording.
+                    start_conversation_flag.clear()
+                    continue
+                # Barge in: cancelling the turn cancels its requests in the pipeline.
+                conversation.cancel()
+                await asyncio.gather(conversation, return_exceptions=True)
+            conversation = asyncio.create_task(
+                context_manager.astart_conversation(pipeline)
+            )
+            start_conversation_flag.clear()
+    finally:
+        if conversation is not None and not conversation.done():
+            conversation.cancel()
+            await asyncio.gather(conversation, return_exceptions=True)
+        await pipeline.stop()
+        context_manager.clear()
+        if metrics_server is not None:
+            metrics_server.shutdown()
 
 
 if __name__ == "__main__":
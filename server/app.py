@@ -0,0 +1,405 @@
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+from typing import List
+
+from aiohttp import WSMsgType, web
+
+from audio.audio_manager import AudioManager, SpeechToTextTask
+from audio.speech_preprocess import SpeechPreprocessConfig, preprocess_speech
+from audio.stt_service import STTService
+from audio.tts_cache import TTSCache
+from audio.tts_service import TTSServiceMeloTTS
+from common.admission import AdmissionLimits
+from common.backend_pool import create_backend_pool
+from common.hedging import create_hedge_policy
+from common.http_session import HttpSessionConfig
+from common.metrics import METRICS, TurnTimeline, now
+from context.async_pipeline import AsyncPipeline
+from llm.llm_manager import LlmManager
+from llm.llm_service import LLMService
+from llm.response_cache import LlmResponseCache
+from server.session import Session, SessionStore
+
+# Largest websocket message accepted, i.e. one speech segment, about 90 s of 44.1 kHz
+# 16 bit mono wav.
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+
+
+@dataclass
+class ConversationServer:
+    """
+    Serve many concurrent conversations from one process. Every session has its own
+    context and history, while stt, llm and tts requests of all sessions go through one
+    AsyncPipeline, whose workers, backend pools and admission limits are shared.
+
+    HTTP:
+        POST   /sessions                 {"context": ...} -> {"session_id": ...}
+        PUT    /sessions/{id}/context    context as text/plain
+        DELETE /sessions/{id}
+        GET    /health, /metrics
+
+    WebSocket /sessions/{id}/ws, client to server:
+        binary                           a speech segment (wav) of the question,
+                                         transcribed while the user keeps speaking
+        {"type": "end_of_speech"}        answer the segments sent so far
+        {"type": "question", "text": ..} answer a typed question
+        {"type": "context", "text": ..}  set the context
+        {"type": "cancel"}               barge in, stop the current answer
+    Server to client:
+        {"type": "transcript", "turn", "text"}
+        {"type": "response", "turn", "index", "text", "audio"}, followed by the
+        chunk's wav as a binary message if audio is true
+        {"type": "done", "turn", "latencies"}, {"type": "cancelled", "turn"}
+        {"type": "error", "message"}
+    Starting a new question cancels the answer in progress, like the hotkey does.
+    """
+
+    pipeline: AsyncPipeline
+    sessions: SessionStore
+    # Trim silence and downsample speech segments before speech to text. None uploads
+    # them as is.
+    speech_preprocess: SpeechPreprocessConfig | None = SpeechPreprocessConfig()
+    # Seconds to wait for speech to text before falling back to the default question.
+    audio_to_text_timeout: float = 60.0
+    # Seconds between checks for idle sessions.
+    expire_interval: float = 60.0
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/sessions", self._create_session),
+                web.put("/sessions/{session_id}/context", self._set_context),
+                web.delete("/sessions/{session_id}", self._delete_session),
+                web.get("/sessions/{session_id}/ws", self._handle_websocket),
+                web.get("/health", self._health),
+                web.get("/metrics", self._metrics),
+            ]
+        )
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app: web.Application) -> None:
+        await self.pipeline.start()
+        self._expire_task = asyncio.create_task(self._expire_sessions())
+
+    async def _on_cleanup(self, app: web.Application) -> None:
+        self._expire_task.cancel()
+        for session_id in list(self.sessions.sessions):
+            await self.sessions.remove(session_id)
+        await self.pipeline.stop()
+
+    async def _expire_sessions(self) -> None:
+        while True:
+            await asyncio.sleep(self.expire_interval)
+            self.sessions.expire()
+
+    async def _create_session(self, request: web.Request) -> web.Response:
+        try:
+            body = await request.json() if request.can_read_body else {}
+        except ValueError:
+            raise web.HTTPBadRequest(text="expected a json object")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="expected a json object")
+        session = self.sessions.create()
+        if session is None:
+            raise web.HTTPServiceUnavailable(text="too many sessions")
+        context = body.get("context")
+        if context:
+            await asyncio.to_thread(session.set_context, context)
+        print(f"INFO: created session {session.session_id}")
+        return web.json_response({"session_id": session.session_id}, status=201)
+
+    async def _set_context(self, request: web.Request) -> web.Response:
+        session = self._get_session(request)
+        await asyncio.to_thread(session.set_context, await request.text())
+        return web.Response(status=204)
+
+    async def _delete_session(self, request: web.Request) -> web.Response:
+        if not await self.sessions.remove(request.match_info["session_id"]):
+            raise web.HTTPNotFound(text="unknown session")
+        return web.Response(status=204)
+
+    async def _health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "sessions": len(self.sessions)})
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=METRICS.to_text())
+
+    def _get_session(self, request: web.Request) -> Session:
+        session = self.sessions.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text="unknown session")
+        return session
+
+    async def _handle_websocket(self, request: web.Request) -> web.WebSocketResponse:
+        session = self._get_session(request)
+        ws = web.WebSocketResponse(heartbeat=30.0, max_msg_size=MAX_MESSAGE_BYTES)
+        await ws.prepare(request)
+        session.num_connections += 1
+        METRICS.increment("server.connections")
+        # Transcriptions of the speech segments of the question being asked.
+        transcriptions: List[asyncio.Future] = []
+        try:
+            async for message in ws:
+                session.last_active = now()
+                if message.type == WSMsgType.BINARY:
+                    if not transcriptions:
+                        await self._start_turn(session)
+                    transcriptions.append(
+                        asyncio.ensure_future(
+                            self._transcribe(session, message.data, len(transcriptions) + 1)
+                        )
+                    )
+                elif message.type == WSMsgType.TEXT:
+                    transcriptions = await self._handle_command(
+                        session, ws, message.data, transcriptions
+                    )
+        finally:
+            session.num_connections -= 1
+            for transcription in transcriptions:
+                transcription.cancel()
+            if session.num_connections == 0:
+                # Nobody is listening to the answer anymore.
+                await session.cancel_turn()
+        return ws
+
+    async def _handle_command(
+        self,
+        session: Session,
+        ws: web.WebSocketResponse,
+        data: str,
+        transcriptions: List[asyncio.Future],
+    ) -> List[asyncio.Future]:
+        # Returns the transcriptions of the question still being asked.
+        try:
+            command = json.loads(data)
+            command_type = command["type"]
+        except (ValueError, TypeError, KeyError):
+            await _send_error(ws, "expected a json object with a type")
+            return transcriptions
+        if command_type == "context":
+            await asyncio.to_thread(session.set_context, command.get("text", ""))
+        elif command_type in ("end_of_speech", "question"):
+            if command_type == "question":
+                for transcription in transcriptions:
+                    transcription.cancel()
+                transcriptions = []
+            if not transcriptions:
+                await self._start_turn(session)
+            session.current_turn = asyncio.create_task(
+                self._run_turn(session, ws, transcriptions, command.get("text"))
+            )
+            return []
+        elif command_type == "cancel":
+            for transcription in transcriptions:
+                transcription.cancel()
+            await session.cancel_turn()
+            await ws.send_json({"type": "cancelled", "turn": session.turn})
+            return []
+        else:
+            await _send_error(ws, f"unknown message type {command_type}")
+        return transcriptions
+
+    async def _start_turn(self, session: Session) -> None:
+        # Barge in: the user speaks again, drop the answer in progress.
+        await session.cancel_turn()
+        session.start_turn()
+        prefill_task = session.create_prefill_task()
+        if prefill_task is not None:
+            # Not awaited, the generation request waits for it on the backend anyway.
+            # Cancelled along with the turn on barge in.
+            session.current_prefill = asyncio.create_task(
+                self.pipeline.prefill(prefill_task)
+            )
+
+    async def _transcribe(self, session: Session, audio: bytes, index: int) -> str | None:
+        if self.speech_preprocess is not None:
+            audio = await asyncio.to_thread(preprocess_speech, audio, self.speech_preprocess)
+        task = SpeechToTextTask(
+            task_id=session.task_id("AUDIO_TO_TEXT", index), audio_data=audio
+        )
+        return await self.pipeline.transcribe(task)
+
+    async def _run_turn(
+        self,
+        session: Session,
+        ws: web.WebSocketResponse,
+        transcriptions: List[asyncio.Future],
+        question: str | None,
+    ) -> None:
+        turn = session.turn
+        timeline = TurnTimeline(turn_id=f"{session.session_id}_{turn}")
+        timeline.mark("recording_end")
+        llm_manager = self.pipeline.llm_service.llm_manager
+        llm_gen_task = None
+        try:
+            if question is None:
+                question = await self._wait_for_transcriptions(transcriptions)
+            timeline.mark("stt_done")
+            llm_gen_task = session.create_generation_task(question)
+            await ws.send_json(
+                {"type": "transcript", "turn": turn, "text": llm_gen_task.question}
+            )
+            responses = []
+            async for response, content in self.pipeline.speak(llm_gen_task):
+                timeline.mark("first_tts_result")
+                responses.append(response)
+                await ws.send_json(
+                    {
+                        "type": "response",
+                        "turn": turn,
+                        "index": len(responses),
+                        "text": response,
+                        "audio": content is not None,
+                    }
+                )
+                if content is not None:
+                    # Waits while the client reads slower than audio is synthesized,
+                    # which holds back synthesis and generation of this turn.
+                    await ws.send_bytes(content)
+                    timeline.mark("first_audio_played")
+            timeline.mark("llm_done")
+            first_token_time = llm_manager.get_first_token_time(llm_gen_task.task_id)
+            if first_token_time is not None:
+                timeline.mark("llm_first_token", first_token_time)
+            session.add_turn(llm_gen_task.question, "".join(responses))
+            timeline.mark("last_audio_played")
+            stages = METRICS.record_turn(timeline)
+            await ws.send_json({"type": "done", "turn": turn, "latencies": stages})
+            METRICS.increment("server.turns")
+        except asyncio.CancelledError:
+            METRICS.increment("cancelled.turns")
+            raise
+        except ConnectionResetError:
+            print(f"INFO: session {session.session_id} disconnected during turn {turn}")
+        except Exception as e:
+            print(f"Error running turn {turn} of session {session.session_id}: {e}")
+            METRICS.increment("server.turns.errors")
+            await _send_error(ws, f"turn {turn} failed")
+        finally:
+            for transcription in transcriptions:
+                transcription.cancel()
+            if llm_gen_task is not None:
+                llm_manager.clean_up_text_gen_task(llm_gen_task)
+
+    async def _wait_for_transcriptions(self, transcriptions: List[asyncio.Future]) -> str:
+        try:
+            texts = await asyncio.wait_for(
+                asyncio.gather(*transcriptions), timeout=self.audio_to_text_timeout
+            )
+        except asyncio.TimeoutError:
+            print("Error waiting for speech to text: timed out")
+            return ""
+        return " ".join(text.strip() for text in texts if text)
+
+
+async def _send_error(ws: web.WebSocketResponse, message: str) -> None:
+    if not ws.closed:
+        try:
+            await ws.send_json({"type": "error", "message": message})
+        except ConnectionResetError:
+            pass
+
+
+def create_server_pipeline(
+    stt_urls: List[str] | None = None,
+    tts_urls: List[str] | None = None,
+    llm_urls: List[str] | None = None,
+    num_stt_workers: int = 8,
+    num_llm_workers: int = 8,
+    num_tts_workers: int = 16,
+    tts_cache: TTSCache | None = None,
+    llm_response_cache: LlmResponseCache | None = None,
+    hedge_percentile: float | None = None,
+    admission: AdmissionLimits | None = None,
+) -> AsyncPipeline:
+    # Same services as create_async_pipeline, without the devices of a ContextManager.
+    stt_kwargs = {} if not stt_urls else {"url": stt_urls[0]}
+    tts_kwargs = {} if not tts_urls else {"url": tts_urls[0]}
+    llm_kwargs = {} if not llm_urls else {"ollama_base_url": llm_urls[0]}
+    audio_manager = AudioManager()
+    # Connection pools as large as the workers, so every worker has a request in flight.
+    return AsyncPipeline(
+        stt_service=STTService(
+            audio_manager,
+            backend_pool=create_backend_pool(stt_urls),
+            hedge=create_hedge_policy("stt", hedge_percentile),
+            admission=admission,
+            http_config=HttpSessionConfig(pool_size=num_stt_workers),
+            **stt_kwargs,
+        ),
+        tts_service=TTSServiceMeloTTS(
+            audio_manager,
+            cache=tts_cache,
+            backend_pool=create_backend_pool(tts_urls),
+            hedge=create_hedge_policy("tts", hedge_percentile),
+            admission=admission,
+            http_config=HttpSessionConfig(pool_size=num_tts_workers),
+            **tts_kwargs,
+        ),
+        llm_service=LLMService(
+            LlmManager(),
+            backend_pool=create_backend_pool(llm_urls),
+            admission=admission,
+            **llm_kwargs,
+        ),
+        num_stt_workers=num_stt_workers,
+        num_llm_workers=num_llm_workers,
+        num_tts_workers=num_tts_workers,
+        llm_response_cache=llm_response_cache,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    # Repeat to balance requests between several backends of a service.
+    parser.add_argument("--stt-url", action="append", dest="stt_urls")
+    parser.add_argument("--tts-url", action="append", dest="tts_urls")
+    parser.add_argument("--llm-url", action="append", dest="llm_urls")
+    parser.add_argument("--num-stt-workers", type=int, default=8)
+    parser.add_argument("--num-llm-workers", type=int, default=8)
+    parser.add_argument("--num-tts-workers", type=int, default=16)
+    parser.add_argument("--max-sessions", type=int, default=1000)
+    parser.add_argument("--idle-timeout", type=float, default=1800.0)
+    parser.add_argument("--hedge-percentile", type=float, default=None)
+    # Requests in flight per backend, further requests wait up to --max-wait seconds.
+    parser.add_argument("--backend-concurrency", type=int, default=None)
+    parser.add_argument("--max-wait", type=float, default=5.0)
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    pipeline = create_server_pipeline(
+        stt_urls=args.stt_urls,
+        tts_urls=args.tts_urls,
+        llm_urls=args.llm_urls,
+        num_stt_workers=args.num_stt_workers,
+        num_llm_workers=args.num_llm_workers,
+        num_tts_workers=args.num_tts_workers,
+        tts_cache=None if args.no_cache else TTSCache(),
+        llm_response_cache=None if args.no_cache else LlmResponseCache(),
+        hedge_percentile=args.hedge_percentile,
+        admission=(
+            AdmissionLimits(
+                max_concurrency=args.backend_concurrency, max_wait=args.max_wait
+            )
+            if args.backend_concurrency is not None
+            else None
+        ),
+    )
+    server = ConversationServer(
+        pipeline=pipeline,
+        sessions=SessionStore(
+            max_sessions=args.max_sessions, idle_timeout=args.idle_timeout
+        ),
+    )
+    web.run_app(server.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict
+import uuid
+
+from common.metrics import METRICS, now
+from context.conversation_history import (
+    ConversationHistory,
+    prefill_context,
+    prompt_context,
+)
+from llm.llm_manager import LlmGenerationTask, LlmPrefillTask
+from text.retrieval import ContextArtifacts, prepare_context
+
+
+@dataclass
+class Session:
+    """
+    Conversation state of one client of the server: its context, previous turns and
+    the turn in progress. Prompts are built like ContextManager builds them for the
+    clipboard, so a session's follow up questions keep a stable prompt prefix.
+    Sessions share the server's pipeline and backends, nothing else.
+    """
+
+    session_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    # Question used when speech to text returns nothing.
+    default_question: str = "Please summarize the context"
+    # Only send the passages most relevant to the question, within this many tokens.
+    # None sends the whole context.
+    max_context_tokens: int | None = 2048
+    # Send previous turns about the same context along with the question.
+    multi_turn: bool = True
+    # Max tokens of previous turns sent in multi turn mode.
+    history_max_tokens: int = 1024
+    # Send the prompt without the question while speech to text is still running.
+    speculative_prefill: bool = True
+
+    def __post_init__(self):
+        self.context_text = ""
+        self._artifacts: ContextArtifacts | None = None
+        self.turn = 0
+        self._history = (
+            ConversationHistory(max_tokens=self.history_max_tokens)
+            if self.multi_turn
+            else None
+        )
+        # Running turn and its speculative prefill, cancelled when the user barges in.
+        self.current_turn: asyncio.Task | None = None
+        self.current_prefill: asyncio.Task | None = None
+        self.num_connections = 0
+        self.last_active = now()
+
+    def set_context(self, text: str) -> None:
+        # Prepares retrieval artifacts right away, like the clipboard watcher does, so
+        # turns do not wait for them. Call from a thread, indexing a long text takes a while.
+        artifacts = prepare_context(text) if self.max_context_tokens is not None else None
+        self.context_text, self._artifacts = text, artifacts
+
+    def start_turn(self) -> None:
+        self.turn += 1
+        self.last_active = now()
+
+    def task_id(self, kind: str, index: int | None = None) -> str:
+        task_id = f"TASK_{self.session_id}_{kind}_{self.turn}"
+        if index is not None:
+            task_id += f"_{index}"
+        return task_id
+
+    def create_prefill_task(self) -> LlmPrefillTask | None:
+        if not self.speculative_prefill:
+            return None
+        prefill = prefill_context(
+            self.context_text,
+            self._history,
+            self._get_artifacts,
+            self.max_context_tokens,
+        )
+        if prefill is None:
+            return None
+        context, history = prefill
+        return LlmPrefillTask(
+            task_id=self.task_id("LLM_PREFILL"), context=context, history=history
+        )
+
+    def create_generation_task(self, question: str | None) -> LlmGenerationTask:
+        question = question or self.default_question
+        context, history, follow_up_context = prompt_context(
+            self.context_text,
+            question,
+            self._history,
+            self._get_artifacts,
+            self.max_context_tokens,
+        )
+        return LlmGenerationTask(
+            task_id=self.task_id("LLM_GEN"),
+            context=context,
+            question=question,
+            history=history,
+            follow_up_context=follow_up_context,
+        )
+
+    def add_turn(self, question: str, response: str) -> None:
+        if self._history is not None:
+            self._history.add(question, response)
+
+    async def cancel_turn(self) -> None:
+        for task in (self.current_turn, self.current_prefill):
+            if task is not None and not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self.current_turn = None
+        self.current_prefill = None
+
+    def _get_artifacts(self, text: str) -> ContextArtifacts:
+        # Prepared by set_context already.
+        return self._artifacts
+
+
+@dataclass
+class SessionStore:
+    """
+    Sessions of the server by id. At most max_sessions are kept, sessions without a
+    connection are expired after idle_timeout seconds.
+    """
+
+    max_sessions: int = 1000
+    idle_timeout: float = 1800.0
+    sessions: Dict[str, Session] = field(default_factory=dict)
+
+    def create(self, **kwargs) -> Session | None:
+        # Returns None once max_sessions are open.
+        if len(self.sessions) >= self.max_sessions:
+            self.expire()
+            if len(self.sessions) >= self.max_sessions:
+                METRICS.increment("server.sessions.rejected")
+                return None
+        session = Session(**kwargs)
+        self.sessions[session.session_id] = session
+        METRICS.increment("server.sessions.created")
+        return session
+
+    def get(self, session_id: str) -> Session | None:
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.last_active = now()
+        return session
+
+    async def remove(self, session_id: str) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        await session.cancel_turn()
+        return True
+
+    def expire(self) -> int:
+        # Drop idle sessions. Returns the number of sessions dropped.
+        expired = [
+            session_id
+            for session_id, session in self.sessions.items()
+            if session.num_connections == 0
+            and (session.current_turn is None or session.current_turn.done())
+            and now() - session.last_active > self.idle_timeout
+        ]
+        for session_id in expired:
+            del self.sessions[session_id]
+        if expired:
+            METRICS.increment("server.sessions.expired", len(expired))
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
@@ -0,0 +1,54 @@
+import threading
+
+from common.hedging import HedgePolicy
+
+
+def _hedged_policy() -> HedgePolicy:
+    # Hedges every call right away.
+    policy = HedgePolicy(name="test", min_samples=0, min_delay=0.01, max_hedge_rate=1.0)
+    policy.hedge_delay = lambda: 0.01
+    return policy
+
+
+def test_failed_attempts_are_discarded_except_the_returned_one():
+    policy = _hedged_policy()
+    release = threading.Event()
+    results = iter(["first", "second"])
+    lock = threading.Lock()
+
+    def attempt():
+        with lock:
+            result = next(results)
+        if result == "first":
+            # Slow enough to be hedged, finishes after the hedge.
+            release.wait(1.0)
+        else:
+            release.set()
+        return result
+
+    discarded = []
+    result = policy.call(attempt, discard=discarded.append, succeeded=lambda r: False)
+    # The hedge is the last attempt, its response is returned, the primary's discarded.
+    assert result == "second"
+    assert discarded == ["first"]
+
+
+def test_winner_discards_the_failed_attempt():
+    policy = _hedged_policy()
+    release = threading.Event()
+    results = iter(["ok", "failed"])
+    lock = threading.Lock()
+
+    def attempt():
+        with lock:
+            result = next(results)
+        if result == "ok":
+            release.wait(1.0)
+        else:
+            release.set()
+        return result
+
+    discarded = []
+    result = policy.call(attempt, discard=discarded.append, succeeded=lambda r: r == "ok")
+    assert result == "ok"
+    assert discarded == ["failed"]
@@ -0,0 +1,232 @@
+from dataclasses import dataclass
+import hashlib
+import math
+import re
+from typing import AbstractSet, Dict, List
+
+import numpy as np
+
+WORD_PATTERN = re.compile(r"\w+")
+PARAGRAPH_SPLIT_PATTERN = re.compile(r"\n\s*\n")
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[\.\?\!])\s+")
+# Control characters other than tab and newline.
+CONTROL_CHARS_PATTERN = re.compile(r"[\x00-\x08\x0b-\x1f\x7f]")
+TRAILING_SPACES_PATTERN = re.compile(r"[ \t]+$", flags=re.MULTILINE)
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+
+# Common words that carry no signal for ranking.
+STOP_WORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it me my of on or "
+    "should so that the this to was what when where which who why will with you your".split()
+)
+
+# Rough number of characters per token for llama style tokenizers.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_num_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def clean_text(text: str) -> str:
+    # Normalize line endings and whitespace left over from copying web pages.
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = CONTROL_CHARS_PATTERN.sub("", text)
+    text = TRAILING_SPACES_PATTERN.sub("", text)
+    text = BLANK_LINES_PATTERN.sub("\n\n", text)
+    return text.strip()
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        word for word in WORD_PATTERN.findall(text.lower()) if word not in STOP_WORDS
+    ]
+
+
+def split_passages(text: str, max_passage_tokens: int = 128) -> List[str]:
+    # Split on paragraphs, break long paragraphs on sentences and merge short ones,
+    # so passages are close to max_passage_tokens.
+    pieces = []
+    for paragraph in PARAGRAPH_SPLIT_PATTERN.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_num_tokens(paragraph) <= max_passage_tokens:
+            pieces.append(paragraph)
+            continue
+        for sentence in SENTENCE_SPLIT_PATTERN.split(paragraph):
+            pieces.extend(split_words(sentence, max_passage_tokens))
+
+    passages, current, current_tokens = [], [], 0
+    for piece in pieces:
+        piece_tokens = estimate_num_tokens(piece)
+        if current and current_tokens + piece_tokens > max_passage_tokens:
+            passages.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+def split_words(text: str, max_tokens: int) -> List[str]:
+    # Break text without sentence punctuation on word boundaries, words longer than
+    # max_tokens on characters, so no piece is over max_tokens.
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return [text]
+    pieces, current = [], ""
+    for word in text.split():
+        while len(word) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(word[:max_chars])
+            word = word[max_chars:]
+        if current and len(current) + 1 + len(word) > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current} {word}" if current else word
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+@dataclass
+class BM25Index:
+    """
+    Okapi BM25 over passages. Term frequencies are stored as flat (passage, term, count)
+    arrays, so scoring a query is a few vectorized NumPy operations.
+    """
+
+    passages: List[str]
+    k1: float = 1.5
+    b: float = 0.75
+
+    def __post_init__(self):
+        # { word: term id }
+        self.vocabulary: Dict[str, int] = {}
+        passage_ids, term_ids, counts = [], [], []
+        passage_lengths = np.zeros(len(self.passages), dtype=np.float32)
+        for passage_id, passage in enumerate(self.passages):
+            words = tokenize(passage)
+            passage_lengths[passage_id] = len(words)
+            term_counts = {}
+            for word in words:
+                term_id = self.vocabulary.setdefault(word, len(self.vocabulary))
+                term_counts[term_id] = term_counts.get(term_id, 0) + 1
+            passage_ids.extend([passage_id] * len(term_counts))
+            term_ids.extend(term_counts.keys())
+            counts.extend(term_counts.values())
+
+        self._passage_ids = np.asarray(passage_ids, dtype=np.int32)
+        self._term_ids = np.asarray(term_ids, dtype=np.int32)
+        counts = np.asarray(counts, dtype=np.float32)
+        num_passages = max(len(self.passages), 1)
+        document_frequency = np.bincount(self._term_ids, minlength=len(self.vocabulary))
+        self._idf = np.log(
+            (num_passages - document_frequency + 0.5) / (document_frequency + 0.5) + 1.0
+        ).astype(np.float32)
+        average_length = max(float(passage_lengths.mean()) if len(self.passages) else 0.0, 1.0)
+        # The BM25 term weight only depends on the passage, so precompute it.
+        norm = self.k1 * (1 - self.b + self.b * passage_lengths / average_length)
+        self._weights = counts * (self.k1 + 1) / (counts + norm[self._passage_ids])
+
+    def score(self, query: str) -> np.ndarray:
+        query_term_ids = np.asarray(
+            sorted({self.vocabulary[w] for w in tokenize(query) if w in self.vocabulary}),
+            dtype=np.int32,
+        )
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        if len(query_term_ids) == 0:
+            return scores
+        mask = np.isin(self._term_ids, query_term_ids)
+        np.add.at(
+            scores,
+            self._passage_ids[mask],
+            self._idf[self._term_ids[mask]] * self._weights[mask],
+        )
+        return scores
+
+    def top_passages(
+        self, query: str, max_tokens: int, exclude: AbstractSet[str] = frozenset()
+    ) -> List[str]:
+        # Best scoring passages that fit in max_tokens, in their original order.
+        # Passages in exclude are skipped, e.g. those sent already.
+        scores = self.score(query)
+        selected, num_tokens = [], 0
+        # Stable sort keeps earlier passages first among equal scores.
+        for passage_id in np.argsort(-scores, kind="stable"):
+            if self.passages[passage_id] in exclude:
+                continue
+            passage_tokens = estimate_num_tokens(self.passages[passage_id])
+            if num_tokens + passage_tokens > max_tokens:
+                continue
+            selected.append(int(passage_id))
+            num_tokens += passage_tokens
+        if not selected and self.passages and not exclude:
+            # Every passage is over budget, send the start of the best one rather than
+            # no context at all.
+            best = self.passages[int(np.argmax(scores))]
+            return [best[: max_tokens * CHARS_PER_TOKEN]]
+        return [self.passages[i] for i in sorted(selected)]
+
+
+@dataclass(frozen=True)
+class ContextArtifacts:
+    # Everything a turn needs from a context, computed once per distinct context.
+    content_hash: str
+    text: str
+    num_tokens: int
+    passages: List[str]
+    index: BM25Index
+
+
+def prepare_context(text: str, max_passage_tokens: int = 128) -> ContextArtifacts:
+    cleaned = clean_text(text)
+    passages = split_passages(cleaned, max_passage_tokens=max_passage_tokens)
+    return ContextArtifacts(
+        content_hash=hash_text(text),
+        text=cleaned,
+        num_tokens=estimate_num_tokens(cleaned),
+        passages=passages,
+        index=BM25Index(passages),
+    )
+
+
+def retrieve_context(artifacts: ContextArtifacts, question: str, max_tokens: int) -> str:
+    """
+    Return the parts of the context most relevant to question, within max_tokens.
+    Context that already fits is returned unchanged.
+    """
+    if artifacts.num_tokens <= max_tokens:
+        return artifacts.text
+    return "\n\n".join(artifacts.index.top_passages(question, max_tokens=max_tokens))
+
+
+def retrieve_follow_up_context(
+    artifacts: ContextArtifacts, question: str, sent_context: str, max_tokens: int
+) -> str:
+    """
+    Return the passages relevant to a follow up question that are not in sent_context,
+    the context retrieved for an earlier question, within max_tokens. Empty if the
+    sent context has them all, e.g. it is the whole context.
+    """
+    if max_tokens <= 0 or sent_context == artifacts.text:
+        return ""
+    scores = artifacts.index.score(question)
+    # Passages without a query word do not help, unlike on the first question there is
+    # context to answer from already.
+    exclude = {
+        passage
+        for passage, score in zip(artifacts.passages, scores)
+        if score <= 0 or passage in sent_context
+    }
+    return "\n\n".join(
+        artifacts.index.top_passages(question, max_tokens=max_tokens, exclude=exclude)
+    )
@@ -1,7 +1,12 @@
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Dict
+import threading
+from typing import Callable
 import pyperclip
 
+from common.result_store import ResultStore
+from text.retrieval import ContextArtifacts, hash_text, prepare_context
+
 @dataclass(frozen=True)
 class CopyFromClipboardTask:
     task_id: str
@@ -14,17 +19,81 @@ class CopyFromClipboardResult:
 @dataclass
 class TextManager:
 
-    copy_results: Dict[str, CopyFromClipboardResult] = field(default_factory=dict)
+    # { task_id: CopyFromClipboardResult }, only the most recent copies are kept.
+    copy_results: ResultStore = field(
+        default_factory=lambda: ResultStore(
+            ttl=600.0,
+            max_entries=16,
+            max_bytes=16 * 1024 * 1024,
+            size_of=lambda result: len(result.text),
+        )
+    )
+    # Prepared contexts by content hash, least recently used first.
+    context_artifacts: OrderedDict[str, ContextArtifacts] = field(default_factory=OrderedDict)
+    max_context_artifacts: int = 8
+    # Seconds between clipboard checks of the background watcher.
+    clipboard_watch_interval: float = 0.5
+    # Reads the clipboard text. Replaceable, e.g. to feed a fixed context in benchmarks.
+    paste: Callable[[], str] = pyperclip.paste
+
+    def __post_init__(self):
+        self._context_artifacts_lock = threading.Lock()
+        self._watcher_stop_event = threading.Event()
+        self._watcher_thread: threading.Thread | None = None
 
     def copy_from_clipboard(self, task: CopyFromClipboardTask) -> str:
         # TODO: lost format when copying from clipboard.
-        text = pyperclip.paste()
+        text = self.paste()
         result = CopyFromClipboardResult(task=task, text=text)
         self.copy_results[task.task_id] = result
         return result.text
+
+    def get_context_artifacts(self, text: str) -> ContextArtifacts:
+        # Prepared artifacts for text, reused if the same text was seen before.
+        content_hash = hash_text(text)
+        with self._context_artifacts_lock:
+            artifacts = self.context_artifacts.get(content_hash)
+            if artifacts is not None:
+                self.context_artifacts.move_to_end(content_hash)
+                return artifacts
+        # Prepare outside the lock, preparing a large context takes a while.
+        artifacts = prepare_context(text)
+        with self._context_artifacts_lock:
+            self.context_artifacts[content_hash] = artifacts
+            while len(self.context_artifacts) > self.max_context_artifacts:
+                self.context_artifacts.popitem(last=False)
+        return artifacts
+
+    def start_clipboard_watcher(self) -> None:
+        # Prepare artifacts in the background whenever the clipboard changes,
+        # so they are ready before the user asks about it.
+        if self._watcher_thread is not None:
+            return
+        self._watcher_stop_event.clear()
+        self._watcher_thread = threading.Thread(target=self._watch_clipboard, daemon=True)
+        self._watcher_thread.start()
+
+    def stop_clipboard_watcher(self) -> None:
+        if self._watcher_thread is None:
+            return
+        self._watcher_stop_event.set()
+        self._watcher_thread.join()
+        self._watcher_thread = None
+
+    def _watch_clipboard(self) -> None:
+        last_text = None
+        while not self._watcher_stop_event.is_set():
+            try:
+                text = self.paste()
+                if text and text != last_text:
+                    self.get_context_artifacts(text)
+                    last_text = text
+            except Exception as e:
+                print(f"Error watching clipboard: {e}")
+            self._watcher_stop_event.wait(self.clipboard_watch_interval)
     
 if __name__ == "__main__":
     task = CopyFromClipboardTask(task_id="test")
     text_manager = TextManager()
     text = text_manager.copy_from_clipboard(task)
-    print(f"copied from clipboard: {text}")
\ No newline at end of file
+    print(f"copied from clipboard: {text}")